@@ -0,0 +1,129 @@
+import time
+import argparse
+import psycopg2
+from etl import DSN
+from sql_queries import plays_per_hour_rollup_select, plays_per_hour_select, plays_per_day_rollup_select, \
+    plays_per_day_select, plays_per_user_rollup_select, plays_per_user_select, top_songs_rollup_select, \
+    top_songs_select, top_artists_rollup_select, top_artists_select, top_songs_select_surrogate, \
+    top_artists_select_surrogate
+from rollups import rollups_fresh, rebuild_rollups
+from surrogate_keys import has_surrogate_keys
+
+
+def is_aligned(value, unit):
+    """
+    This function returns whether a bound is unset or falls on an hour or day boundary,
+    so that it matches rollup buckets. Dates fall on both.
+    """
+    if value is None:
+        return True
+    if unit == 'day' and (getattr(value, 'hour', 0) or getattr(value, 'tzinfo', None)):
+        return False
+    return not (getattr(value, 'minute', 0) or getattr(value, 'second', 0) or getattr(value, 'microsecond', 0))
+
+
+def run_query(cur, rollup_query, fact_query, params, use_rollup):
+    """
+    This function answers a question from the rollup tables if they can answer it, from songplays otherwise.
+
+    Parameters
+    ----------
+    cur         : Cursor object
+                    Cursor connected to postgreSQL session
+    rollup_query : string
+                    Query on the rollup tables
+    fact_query  : string
+                    Equivalent query on songplays
+    params      : dictionary
+                    Query parameters
+    use_rollup  : boolean
+                    Whether the rollups can answer the question, they are only used if they are fresh too
+
+    Returns
+    -------
+    (list of rows, 'rollup' or 'songplays')
+    """
+    if use_rollup and rollups_fresh(cur):
+        cur.execute(rollup_query, params)
+        return cur.fetchall(), 'rollup'
+
+    cur.execute(fact_query, params)
+    return cur.fetchall(), 'songplays'
+
+
+def plays_per_hour(cur, start=None, end=None):
+    """
+    Returns (hour, plays) rows of the songplays in [start, end), from plays_by_hour if both bounds are whole hours.
+    """
+    return run_query(cur, plays_per_hour_rollup_select, plays_per_hour_select, {'start': start, 'end': end},
+                     is_aligned(start, 'hour') and is_aligned(end, 'hour'))
+
+
+def plays_per_day(cur, start=None, end=None):
+    """
+    Returns (day, plays) rows of the songplays in [start, end), from plays_by_hour if both bounds are whole days.
+    """
+    return run_query(cur, plays_per_day_rollup_select, plays_per_day_select, {'start': start, 'end': end},
+                     is_aligned(start, 'day') and is_aligned(end, 'day'))
+
+
+def plays_per_user(cur, level=None, limit=None):
+    """
+    Returns (user_id, level, plays) rows by decreasing plays, of one level if `level` is set.
+    """
+    return run_query(cur, plays_per_user_rollup_select, plays_per_user_select, {'level': level, 'limit': limit}, True)
+
+
+def top_songs(cur, limit=10):
+    """
+    Returns (song_id, title, plays) rows of the most played songs.
+    """
+    fact_query = top_songs_select_surrogate if has_surrogate_keys(cur) else top_songs_select
+    return run_query(cur, top_songs_rollup_select, fact_query, {'limit': limit}, True)
+
+
+def top_artists(cur, limit=10):
+    """
+    Returns (artist_id, name, plays) rows of the most played artists.
+    """
+    fact_query = top_artists_select_surrogate if has_surrogate_keys(cur) else top_artists_select
+    return run_query(cur, top_artists_rollup_select, fact_query, {'limit': limit}, True)
+
+
+def main():
+    """
+    Prints the dashboard questions with the source and time of each answer,
+    after rebuilding the rollups if `--rebuild` is set.
+    """
+    parser = argparse.ArgumentParser(description='Answer dashboard questions from the rollup tables or songplays.')
+    parser.add_argument('--rebuild', action='store_true', help='recompute the rollup tables from songplays first')
+    parser.add_argument('--limit', type=int, default=5, help='number of rows printed per question')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(DSN)
+    cur = conn.cursor()
+
+    if args.rebuild:
+        start = time.perf_counter()
+        rebuild_rollups(cur, conn)
+        print('Rollups rebuilt in {:.2f}s.'.format(time.perf_counter() - start))
+
+    questions = [
+        ('Plays per day', lambda: plays_per_day(cur)),
+        ('Plays per hour', lambda: plays_per_hour(cur)),
+        ('Plays per user and level', lambda: plays_per_user(cur, limit=args.limit)),
+        ('Top songs', lambda: top_songs(cur, args.limit)),
+        ('Top artists', lambda: top_artists(cur, args.limit)),
+    ]
+    for title, question in questions:
+        start = time.perf_counter()
+        rows, source = question()
+        print('\n{} ({} rows from {} in {:.1f}ms)'.format(title, len(rows), source, (time.perf_counter() - start) * 1000))
+        for row in rows[:args.limit]:
+            print('    ' + ' | '.join(str(value) for value in row))
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import time
+import argparse
+import threading
+import psycopg2
+from psycopg2.extras import execute_values
+from sql_queries import songplay_unresolved_insert, songplay_backfill, songplay_backfill_surrogate, \
+    songplay_unresolved_count_select
+from surrogate_keys import has_surrogate_keys
+from rollups import RollupDelta, rollups_fresh
+
+
+def record_unresolved(cur, songplay_df):
+    """
+    This function records songplays written without a song in songplays_unresolved table,
+    with the event fields needed to resolve them once their song is loaded.
+
+    Parameters
+    ----------
+    cur         : Cursor object
+                    Cursor connected to postgreSQL session
+    songplay_df : DataFrame
+                    Unresolved songplay records with start_time, userId, sessionId, song, artist and length columns
+
+    Returns
+    -------
+    Number of records
+    """
+    if songplay_df.empty:
+        return 0
+
+    df = songplay_df[["start_time", "userId", "sessionId", "song", "artist", "length"]].astype(object)
+    records = list(df.where(df.notna(), None).itertuples(index=False, name=None))
+    execute_values(cur, songplay_unresolved_insert, records, page_size=len(records))
+    return len(records)
+
+
+def backfill_songplays(cur, song_ids=None, tolerance=0.01, rollups=False):
+    """
+    This function resolves the unresolved songplays matching songs loaded after them with a single set-based update,
+    touching only the songplays it resolves, and removes them from songplays_unresolved table.
+
+    Parameters
+    ----------
+    cur         : Cursor object
+                    Cursor connected to postgreSQL session
+    song_ids    : iterable
+                    If set, songplays are only matched against these songs, typically the songs of a run
+    tolerance   : float
+                    Duration rounding step in seconds, as in the song lookup index
+    rollups     : boolean
+                    If set, the resolved songplays are added to plays_by_song and plays_by_artist
+
+    Returns
+    -------
+    Number of songplays resolved
+    """
+    query = songplay_backfill_surrogate if has_surrogate_keys(cur) else songplay_backfill
+    cur.execute(query, {'song_ids': sorted(song_ids) if song_ids is not None else None, 'tolerance': tolerance})
+    rows = cur.fetchall()
+
+    if rollups and rows:
+        delta = RollupDelta()
+        delta.songs.update(song_id for song_id, artist_id in rows)
+        delta.artists.update(artist_id for song_id, artist_id in rows)
+        delta.apply(cur)
+
+    return len(rows)
+
+
+class SongBackfill:
+    """
+    Songs loaded during a run, against which the songplays left unresolved by earlier runs
+    are matched once song data is processed.
+
+    Attributes
+    ----------
+    song_ids    : set
+                    Ids of the songs loaded so far
+    resolved    : integer
+                    Number of songplays resolved
+    """
+
+    def __init__(self, tolerance=0.01):
+        self.tolerance = tolerance
+        self.song_ids = set()
+        self.resolved = 0
+        self._lock = threading.Lock()
+
+    def add(self, song_df):
+        """
+        Records loaded songs.
+
+        Parameters
+        ----------
+        song_df     : DataFrame
+                        Song records with a song_id column
+        """
+        with self._lock:
+            self.song_ids.update(song_df["song_id"].dropna())
+
+    def run(self, cur, conn, rollups=False):
+        """
+        Resolves the unresolved songplays matching the loaded songs in one transaction.
+
+        Returns
+        -------
+        Number of songplays resolved
+        """
+        if not self.song_ids:
+            return 0
+        resolved = backfill_songplays(cur, self.song_ids, self.tolerance, rollups)
+        conn.commit()
+        self.resolved += resolved
+        return resolved
+
+
+def main():
+    """
+    Resolves the unresolved songplays against all loaded songs and artists, for songs loaded outside of etl.py,
+    then prints the number of songplays resolved and still unresolved.
+    """
+    parser = argparse.ArgumentParser(description='Resolve songplays whose song was loaded after them.')
+    parser.add_argument('--duration-tolerance', type=float, default=0.01,
+                        help='duration rounding step in seconds, as in the song lookup index')
+    args = parser.parse_args()
+
+    # etl imports this module, its connection settings are only imported once both are loaded
+    from etl import DSN
+
+    conn = psycopg2.connect(DSN)
+    cur = conn.cursor()
+
+    start = time.perf_counter()
+    resolved = backfill_songplays(cur, tolerance=args.duration_tolerance, rollups=rollups_fresh(cur))
+    conn.commit()
+
+    cur.execute(songplay_unresolved_count_select)
+    print('{} songplays resolved in {:.2f}s, {} still unresolved.'.format(
+        resolved, time.perf_counter() - start, cur.fetchone()[0]))
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import pandas as pd
+from etl import get_files, transform_song_data
+from song_reader import iter_song_batches
+
+
+def build_song_tree(source, target, scale):
+    """
+    This function writes a scaled-up copy of a song_data tree: every song file is copied
+    `scale` times with new song, artist and track ids, in the same `A/B/C/TR....json` layout.
+
+    Parameters
+    ----------
+    source      : string
+                    Path to the song_data directory to scale up
+    target      : string
+                    Path to the directory to write the song files to
+    scale       : integer
+                    Number of copies of every song file
+
+    Returns
+    -------
+    List of the written file paths
+    """
+    records = []
+    for filepath in get_files(source):
+        with open(filepath) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+
+    filepaths = []
+    for copy in range(scale):
+        for i, record in enumerate(records):
+            suffix = hashlib.md5('{}-{}'.format(copy, i).encode()).hexdigest()[:16].upper()
+            record = dict(record, song_id='SO' + suffix, artist_id='AR' + suffix)
+            track_id = 'TR' + suffix
+            directory = os.path.join(target, track_id[2], track_id[3], track_id[4])
+            os.makedirs(directory, exist_ok=True)
+            filepath = os.path.join(directory, track_id + '.json')
+            with open(filepath, 'w') as f:
+                json.dump(record, f)
+            filepaths.append(filepath)
+
+    return sorted(filepaths)
+
+
+def read_per_file(filepaths):
+    """
+    This function reads and transforms song files one by one, as `process_song_file` used to.
+    """
+    for filepath in filepaths:
+        transform_song_data(pd.read_json(filepath, lines=True))
+
+
+def read_batched(filepaths, batch_size):
+    """
+    This function reads and transforms song files in batches with the song reader.
+    """
+    for batch, df, counts in iter_song_batches(filepaths, batch_size):
+        transform_song_data(df)
+
+
+def main():
+    """
+    Builds a scaled-up song tree in a temporary directory then times reading and transforming it
+    file by file with `pd.read_json` against the batched song reader.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the batched song reader against pd.read_json per file.')
+    parser.add_argument('--source', default='data/song_data', help='song_data directory to scale up')
+    parser.add_argument('--scale', type=int, default=100, help='number of copies of every song file')
+    parser.add_argument('--batch-size', type=int, default=5000, help='number of files per batch')
+    args = parser.parse_args()
+
+    target = tempfile.mkdtemp(prefix='song_data_')
+    try:
+        filepaths = build_song_tree(args.source, target, args.scale)
+        print('{} song files written to {}'.format(len(filepaths), target))
+
+        timings = {}
+        for name, func in [('pd.read_json per file', lambda: read_per_file(filepaths)),
+                           ('batched song reader', lambda: read_batched(filepaths, args.batch_size))]:
+            start = time.perf_counter()
+            func()
+            timings[name] = time.perf_counter() - start
+            print('{:<24} {:8.2f}s {:10.0f} files/sec'.format(name, timings[name], len(filepaths) / timings[name]))
+
+        print('speedup: {:.1f}x'.format(timings['pd.read_json per file'] / timings['batched song reader']))
+    finally:
+        shutil.rmtree(target)
+
+
+if __name__ == "__main__":
+    main()
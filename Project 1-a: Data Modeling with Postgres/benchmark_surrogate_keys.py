@@ -0,0 +1,181 @@
+import time
+import argparse
+import psycopg2
+from sql_queries import songplay_table_create, song_table_create, artist_table_create, \
+    songplay_table_create_surrogate, song_table_create_surrogate, artist_table_create_surrogate
+from etl import DSN
+
+
+# schemas holding the natural ids and the surrogate keys variants of the star schema
+SCHEMAS = {
+    'natural_ids': [songplay_table_create, song_table_create, artist_table_create],
+    'surrogate_keys': [songplay_table_create_surrogate, song_table_create_surrogate, artist_table_create_surrogate],
+}
+
+# synthetic songs and artists with 18-character natural ids, the same in both schemas
+ARTISTS_FILL = ("""
+    INSERT INTO {schema}.artists (artist_id, name, location, latitude, longitude)
+    SELECT 'AR' || upper(substr(md5('artist' || i), 1, 16)), 'Artist ' || i, 'Location ' || i, 0.0, 0.0
+    FROM generate_series(1, %(artists)s) i
+    ORDER BY i
+""")
+
+SONGS_FILL = ("""
+    INSERT INTO {schema}.songs (song_id, title, artist_id, year, duration)
+    SELECT 'SO' || upper(substr(md5('song' || i), 1, 16)), 'Song ' || i,
+        'AR' || upper(substr(md5('artist' || (i %% %(artists)s + 1)), 1, 16)), 2000 + i %% 20, 120 + i %% 300
+    FROM generate_series(1, %(songs)s) i
+    ORDER BY i
+""")
+
+# every songplay plays a song, the surrogate keys are resolved from the natural ids
+NATURAL_SONGPLAYS_FILL = ("""
+    INSERT INTO natural_ids.songplays
+        (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+    SELECT timestamp '2018-11-01' + i * interval '1 second', i %% 1000, 'paid', songs.song_id, songs.artist_id,
+        i / 50, 'Location', 'Mozilla/5.0'
+    FROM generate_series(1, %(plays)s) i
+        JOIN natural_ids.songs
+            ON songs.song_id = 'SO' || upper(substr(md5('song' || (i::BIGINT * 7919 %% %(songs)s + 1)), 1, 16))
+""")
+
+SURROGATE_SONGPLAYS_FILL = ("""
+    INSERT INTO surrogate_keys.songplays
+        (start_time, user_id, level, song_key, artist_key, session_id, location, user_agent)
+    SELECT songplays.start_time, songplays.user_id, songplays.level, songs.song_key, artists.artist_key,
+        songplays.session_id, songplays.location, songplays.user_agent
+    FROM natural_ids.songplays
+        JOIN surrogate_keys.songs ON songs.song_id = songplays.song_id
+        JOIN surrogate_keys.artists ON artists.artist_id = songplays.artist_id
+    ORDER BY songplays.songplay_id
+""")
+
+SIZE_SELECT = "SELECT pg_table_size('{schema}.songplays'), pg_indexes_size('{schema}.songplays')"
+
+# fact to dimension joins, on natural ids or surrogate keys
+JOINS = [
+    ('songplays with songs and artists', {
+        'natural_ids': """
+            SELECT count(*), sum(songs.duration), count(DISTINCT artists.name)
+            FROM natural_ids.songplays
+                JOIN natural_ids.songs ON songs.song_id = songplays.song_id
+                JOIN natural_ids.artists ON artists.artist_id = songplays.artist_id
+        """,
+        'surrogate_keys': """
+            SELECT count(*), sum(songs.duration), count(DISTINCT artists.name)
+            FROM surrogate_keys.songplays
+                JOIN surrogate_keys.songs ON songs.song_key = songplays.song_key
+                JOIN surrogate_keys.artists ON artists.artist_key = songplays.artist_key
+        """,
+    }),
+    ('top 10 songs by title', {
+        'natural_ids': """
+            SELECT songs.title, count(*)
+            FROM natural_ids.songplays JOIN natural_ids.songs ON songs.song_id = songplays.song_id
+            GROUP BY songs.title ORDER BY 2 DESC, 1 LIMIT 10
+        """,
+        'surrogate_keys': """
+            SELECT songs.title, count(*)
+            FROM surrogate_keys.songplays JOIN surrogate_keys.songs ON songs.song_key = songplays.song_key
+            GROUP BY songs.title ORDER BY 2 DESC, 1 LIMIT 10
+        """,
+    }),
+    ('plays of one artist', {
+        'natural_ids': """
+            SELECT count(*)
+            FROM natural_ids.songplays JOIN natural_ids.artists ON artists.artist_id = songplays.artist_id
+            WHERE artists.name = 'Artist 1'
+        """,
+        'surrogate_keys': """
+            SELECT count(*)
+            FROM surrogate_keys.songplays JOIN surrogate_keys.artists ON artists.artist_key = songplays.artist_key
+            WHERE artists.name = 'Artist 1'
+        """,
+    }),
+]
+
+
+def build_schemas(cur, songs, artists, plays):
+    """
+    This function creates the songplays, songs and artists tables of both variants in their own schemas
+    and fills them with the same synthetic data.
+    """
+    params = {'songs': songs, 'artists': artists, 'plays': plays}
+    for schema, queries in SCHEMAS.items():
+        cur.execute('DROP SCHEMA IF EXISTS {} CASCADE'.format(schema))
+        cur.execute('CREATE SCHEMA {}'.format(schema))
+        cur.execute('SET search_path TO {}'.format(schema))
+        for query in queries:
+            cur.execute(query)
+        cur.execute('RESET search_path')
+        cur.execute(ARTISTS_FILL.format(schema=schema), params)
+        cur.execute(SONGS_FILL.format(schema=schema), params)
+
+    cur.execute(NATURAL_SONGPLAYS_FILL, params)
+    cur.execute(SURROGATE_SONGPLAYS_FILL)
+    for schema in SCHEMAS:
+        cur.execute('VACUUM ANALYZE {}.songplays, {}.songs, {}.artists'.format(schema, schema, schema))
+
+
+def best_time(cur, query, repeat):
+    """
+    This function returns the best wall time of running a query `repeat` times.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        cur.execute(query)
+        cur.fetchall()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    """
+    Builds the natural ids and surrogate keys variants of songplays, songs and artists in scratch schemas
+    of sparkifydb, then reports the size of both fact tables and the timings of fact to dimension joins.
+    """
+    parser = argparse.ArgumentParser(description='Compare songplays with natural ids and with surrogate keys.')
+    parser.add_argument('--songs', type=int, default=100000, help='number of songs')
+    parser.add_argument('--artists', type=int, default=20000, help='number of artists')
+    parser.add_argument('--plays', type=int, default=1000000, help='number of songplays')
+    parser.add_argument('--repeat', type=int, default=5, help='number of runs of every join, the best is kept')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch schemas')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(DSN)
+    conn.set_session(autocommit=True)
+    cur = conn.cursor()
+
+    try:
+        start = time.perf_counter()
+        build_schemas(cur, args.songs, args.artists, args.plays)
+        print('{} songplays of {} songs by {} artists built in {:.2f}s'.format(
+            args.plays, args.songs, args.artists, time.perf_counter() - start))
+
+        sizes = {}
+        for schema in SCHEMAS:
+            cur.execute(SIZE_SELECT.format(schema=schema))
+            sizes[schema] = cur.fetchone()
+        natural, surrogate = sizes['natural_ids'], sizes['surrogate_keys']
+        print('\n{:<34} {:>12} {:>12}'.format('songplays size (MB)', 'natural ids', 'surrogate'))
+        for i, name in enumerate(['table', 'indexes']):
+            print('{:<34} {:12.1f} {:12.1f}'.format(name, natural[i] / 2 ** 20, surrogate[i] / 2 ** 20))
+        print('{:<34} {:12.0%}'.format('table size reduction', 1 - surrogate[0] / natural[0]))
+
+        print('\n{:<34} {:>12} {:>12} {:>8}'.format('join (best of {}, ms)'.format(args.repeat), 'natural ids',
+                                                  'surrogate', 'speedup'))
+        for name, queries in JOINS:
+            timings = {schema: best_time(cur, query, args.repeat) for schema, query in queries.items()}
+            print('{:<34} {:12.1f} {:12.1f} {:7.2f}x'.format(name, timings['natural_ids'] * 1000,
+                                                             timings['surrogate_keys'] * 1000,
+                                                             timings['natural_ids'] / timings['surrogate_keys']))
+    finally:
+        if not args.keep:
+            for schema in SCHEMAS:
+                cur.execute('DROP SCHEMA IF EXISTS {} CASCADE'.format(schema))
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
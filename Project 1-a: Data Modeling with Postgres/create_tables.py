@@ -1,5 +1,9 @@
+import argparse
 import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+from sql_queries import create_table_queries, drop_table_queries, create_table_queries_partitioned, \
+    create_table_queries_surrogate, songplay_index_create_queries, load_phase_queries, finalize_queries, reset_queries, \
+    load_phase_select
+from partitions import create_songplay_partitions
 
 
 def create_database():
@@ -27,6 +31,17 @@ def create_database():
     return cur, conn
 
 
+def connect_database():
+    """
+    - Connects to the existing sparkifydb
+    - Returns the connection and cursor to sparkifydb
+    """
+    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+    cur = conn.cursor()
+
+    return cur, conn
+
+
 def drop_tables(cur, conn):
     """
     Drops each table using the queries in `drop_table_queries` list.
@@ -36,35 +51,143 @@ def drop_tables(cur, conn):
         conn.commit()
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, partitioned=False, surrogate_keys=False):
     """
-    Creates each table using the queries in `create_table_queries` list. 
+    Creates each table using the queries in `create_table_queries` list,
+    or `create_table_queries_partitioned` list if `partitioned` is set,
+    or `create_table_queries_surrogate` list if `surrogate_keys` is set.
     """
-    for query in create_table_queries:
+    if partitioned:
+        queries = create_table_queries_partitioned
+    elif surrogate_keys:
+        queries = create_table_queries_surrogate
+    else:
+        queries = create_table_queries
+
+    for query in queries:
         cur.execute(query)
         conn.commit()
 
 
-def main():
+def create_indexes(cur, conn):
+    """
+    Creates the songplays indexes using the queries in `songplay_index_create_queries` list.
+    They are meant to be created after the bulk load of a partitioned songplays table.
     """
-    - Drops (if exists) and Creates the sparkify database. 
+    for query in songplay_index_create_queries:
+        cur.execute(query)
+        conn.commit()
+
+
+def reset_tables(cur, conn):
+    """
+    Empties all tables with a single TRUNCATE, much faster than recreating the database,
+    using the queries in `reset_queries` list.
+    """
+    for query in reset_queries:
+        cur.execute(query)
+    conn.commit()
+
+
+def is_load_phase(cur):
+    """
+    Returns whether the tables are in the load phase, UNLOGGED and without constraints.
+    """
+    cur.execute(load_phase_select)
+    row = cur.fetchone()
+    return bool(row and row[0])
+
+
+def start_load_phase(cur, conn):
+    """
+    Switches the tables to the load phase using the queries in `load_phase_queries` list:
+    constraints and secondary indexes are dropped and tables are made UNLOGGED,
+    so that loading them pays neither index maintenance nor WAL.
+    """
+    for query in load_phase_queries:
+        cur.execute(query)
+    conn.commit()
+
+
+def finalize_tables(cur, conn):
+    """
+    Ends the load phase using the queries in `finalize_queries` list: duplicates are removed,
+    constraints and indexes are built, tables are made LOGGED again, rollups are rebuilt then tables are analyzed.
+    """
+    for query in finalize_queries:
+        cur.execute(query)
+    conn.commit()
+
+
+def main(partitioned=False, months=(), deferred=False, reset=False, finalize=False, surrogate_keys=False):
+    """
+    - Drops (if exists) and Creates the sparkify database, or only empties its tables if `reset` is set,
+    or only finalizes the load phase if `finalize` is set.
     
     - Establishes connection with the sparkify database and gets
     cursor to it.  
     
     - Drops all the tables.  
     
-    - Creates all tables needed. 
+    - Creates all tables needed, songplays being partitioned by month if `partitioned` is set,
+    songs and artists having integer surrogate keys stored by songplays if `surrogate_keys` is set.
+
+    - Creates the songplays partitions of `months`, a list of (year, month) tuples.
+
+    - Switches the tables to the load phase if `deferred` is set.
     
     - Finally, closes the connection. 
     """
-    cur, conn = create_database()
-    
-    drop_tables(cur, conn)
-    create_tables(cur, conn)
+    if finalize or reset:
+        cur, conn = connect_database()
+        if finalize and is_load_phase(cur):
+            finalize_tables(cur, conn)
+        elif finalize:
+            print('Tables are not in the load phase, nothing to finalize.')
+        else:
+            reset_tables(cur, conn)
+    else:
+        cur, conn = create_database()
+
+        drop_tables(cur, conn)
+        create_tables(cur, conn, partitioned, surrogate_keys)
+
+        if partitioned:
+            create_songplay_partitions(cur, months)
+            conn.commit()
+
+    if deferred:
+        start_load_phase(cur, conn)
 
     conn.close()
 
 
+def parse_args():
+    """
+    Parses the command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Drop and create sparkifydb and its tables.')
+    parser.add_argument('--partitioned', action='store_true',
+                        help='range-partition songplays by month on start_time, indexes are created after the load')
+    parser.add_argument('--months', nargs='*', default=[], metavar='YYYY-MM',
+                        help='songplays partitions to create up front, the ETL creates the others on demand')
+    parser.add_argument('--surrogate-keys', action='store_true',
+                        help='give songs and artists integer surrogate keys and store them in songplays')
+    parser.add_argument('--deferred', action='store_true',
+                        help='leave tables UNLOGGED and without constraints nor indexes until they are finalized')
+    parser.add_argument('--reset', action='store_true',
+                        help='empty the tables with TRUNCATE instead of recreating the database')
+    parser.add_argument('--finalize', action='store_true',
+                        help='remove duplicates, build constraints and indexes, make tables LOGGED and ANALYZE them')
+    args = parser.parse_args()
+    if args.deferred and args.partitioned:
+        parser.error('--deferred cannot be combined with --partitioned, a partitioned table cannot be UNLOGGED')
+    if args.surrogate_keys and (args.partitioned or args.deferred):
+        parser.error('--surrogate-keys cannot be combined with --partitioned nor --deferred')
+    return args
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    args = parse_args()
+    main(partitioned=args.partitioned, months=[tuple(int(part) for part in month.split('-')) for month in args.months],
+         deferred=args.deferred, reset=args.reset, finalize=args.finalize, surrogate_keys=args.surrogate_keys)
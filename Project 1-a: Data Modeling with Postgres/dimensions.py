@@ -0,0 +1,145 @@
+class UserDimension:
+    """
+    Collapses user records before they are written: only the latest record by `start_time` of each user
+    is kept, and a user is written again in the same run only when a later record changes it, or with `refresh`
+    whenever a later record shows up.
+
+    Parameters
+    ----------
+    refresh     : boolean
+                    If set, unchanged users are written again with the time of their later record, so that
+                    the time stored with a level stays ahead of the older records other writers may load
+
+    Attributes
+    ----------
+    seen        : integer
+                    Number of user records received
+    written     : integer
+                    Number of user records returned to be written
+    """
+
+    def __init__(self, refresh=False):
+        self.refresh = refresh
+        self.seen = 0
+        self.written = 0
+        self._latest = {}
+
+    def collapse(self, user_df):
+        """
+        Returns the user records to write.
+
+        Parameters
+        ----------
+        user_df     : DataFrame
+                        User records with userId, firstName, lastName, gender, level and start_time columns
+        """
+        self.seen += len(user_df)
+
+        latest = user_df.sort_values("start_time", kind="stable").drop_duplicates("userId", keep="last")
+        keep = []
+        for row in latest.itertuples(index=False):
+            record = (row.firstName, row.lastName, row.gender, row.level)
+            written = self._latest.get(row.userId)
+            if written is not None and (row.start_time <= written[0] or (record == written[1] and not self.refresh)):
+                if row.start_time > written[0]:
+                    self._latest[row.userId] = (row.start_time, record)
+                keep.append(False)
+                continue
+            self._latest[row.userId] = (row.start_time, record)
+            keep.append(True)
+
+        latest = latest[keep]
+        self.written += len(latest)
+        return latest
+
+    def reset(self):
+        """
+        Forgets the users written so far, for instance when the transaction writing them is rolled back.
+        """
+        self._latest = {}
+
+
+class TimeDimension:
+    """
+    Collapses time records before they are written: each `start_time` is written once per run.
+
+    Attributes
+    ----------
+    seen        : integer
+                    Number of time records received
+    written     : integer
+                    Number of time records returned to be written
+    """
+
+    def __init__(self):
+        self.seen = 0
+        self.written = 0
+        self._written = set()
+
+    def collapse(self, time_df):
+        """
+        Returns the time records to write.
+
+        Parameters
+        ----------
+        time_df     : DataFrame
+                        Time records with a start_time column
+        """
+        self.seen += len(time_df)
+
+        time_df = time_df.drop_duplicates("start_time")
+        keys = time_df["start_time"].values.astype("datetime64[ns]").astype("int64")
+        new = [key not in self._written for key in keys.tolist()]
+        self._written.update(keys.tolist())
+
+        time_df = time_df[new]
+        self.written += len(time_df)
+        return time_df
+
+    def reset(self):
+        """
+        Forgets the times written so far, for instance when the transaction writing them is rolled back.
+        """
+        self._written = set()
+
+
+class Dimensions:
+    """
+    Run-level builders of the users and time dimensions.
+
+    Parameters
+    ----------
+    refresh     : boolean
+                    Passed to UserDimension, set when several writers load files concurrently
+
+    Attributes
+    ----------
+    users       : UserDimension
+    times       : TimeDimension
+    """
+
+    def __init__(self, refresh=False):
+        self.users = UserDimension(refresh)
+        self.times = TimeDimension()
+
+    def reset(self):
+        """
+        Forgets the keys written so far, they are written again when they show up.
+        """
+        self.users.reset()
+        self.times.reset()
+
+    def add_counts(self, other):
+        """
+        Adds the counters of another Dimensions, used to sum up the builders of several writers.
+        """
+        for mine, theirs in ((self.users, other.users), (self.times, other.times)):
+            mine.seen += theirs.seen
+            mine.written += theirs.written
+
+    def summary(self):
+        """
+        Returns the rows seen vs. rows written counters as a printable string.
+        """
+        return 'users: {} rows seen, {} written. time: {} rows seen, {} written.'.format(
+            self.users.seen, self.users.written, self.times.seen, self.times.written)
@@ -1,160 +1,1445 @@
 import os
+import io
 import glob
+import json
+import time
+import queue
+import argparse
+import datetime
+import itertools
+import threading
+import collections
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import psycopg2
 import pandas as pd
 from sql_queries import *
+from song_lookup import SongLookupIndex
+from song_reader import read_song_files
+from dimensions import Dimensions
+from partitions import SongplayPartitions
+from surrogate_keys import SurrogateKeys
+from create_tables import create_indexes, reset_tables, is_load_phase, start_load_phase, finalize_tables
+from manifest import file_entry, select_new_files, record_file
+from rollups import RollupDelta, mark_rollups_stale
+from backfill import SongBackfill, record_unresolved
+from instrumentation import CountingCursor, Metrics, stage, count_rows, timed_read
 
 
-def process_song_file(cur, filepath):
+# connection string of sparkify database
+DSN = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+
+
+# columns needed for songs table
+SONG_COLUMNS = ["song_id", "title", "artist_id", "year", "duration"]
+
+# columns needed for artists table
+ARTIST_COLUMNS = ["artist_id", "artist_name", "artist_location", "artist_latitude", "artist_longitude"]
+
+# columns needed for time table
+TIME_COLUMNS = ["start_time", "hour", "day", "week", "month", "year", "weekday"]
+
+# columns needed for users table
+USER_COLUMNS = ["userId", "firstName", "lastName", "gender", "level"]
+
+# columns needed to build songplays, song/artist/length are used to look up song_id and artist_id
+SONGPLAY_COLUMNS = ["start_time", "userId", "level", "song", "artist", "length", "sessionId", "location", "userAgent"]
+
+# columns of songplays table
+SONGPLAY_TABLE_COLUMNS = ["start_time", "user_id", "level", "song_id", "artist_id", "session_id", "location", "user_agent"]
+
+# columns of songplays table with surrogate keys
+SONGPLAY_SURROGATE_COLUMNS = ["start_time", "user_id", "level", "song_key", "artist_key", "session_id", "location", "user_agent"]
+
+
+def transform_song_data(df):
+    """
+    This function selects song & artist data from a song data frame.
+
+    Parameters
+    ----------
+    df          : DataFrame
+                    Song records as read from song files
+
+    Returns
+    -------
+    (song_df, artist_df) data frames with SONG_COLUMNS and ARTIST_COLUMNS
+    """
+    return df[SONG_COLUMNS], df[ARTIST_COLUMNS]
+
+
+def transform_log_data(df):
+    """
+    This function filters a log data frame by NextSong action then selects time, user and songplay data.
+
+    Parameters
+    ----------
+    df          : DataFrame
+                    Log records as read from log files
+
+    Returns
+    -------
+    (time_df, user_df, songplay_df) data frames, user_df carries a `start_time` column
+    after USER_COLUMNS so the latest level of a user can be told apart
+    """
+    # filter by NextSong action
+    df = df[df.page == 'NextSong']
+
+    # convert timestamp column to datetime
+    t = pd.to_datetime(df['ts'], unit='ms')
+
+    # time data records
+    time_data = (t, t.dt.hour, t.dt.day, t.dt.isocalendar().week, t.dt.month, t.dt.year, t.dt.weekday)
+    time_df = pd.DataFrame(dict(zip(TIME_COLUMNS, time_data)))
+
+    # user records
+    user_df = df[USER_COLUMNS].assign(userId=df['userId'].astype(int), start_time=t)
+
+    # songplay records
+    songplay_df = df.assign(start_time=t, userId=df['userId'].astype(int))[SONGPLAY_COLUMNS]
+
+    return time_df, user_df, songplay_df
+
+
+def build_songplays(songplay_df, index, keys=None, cur=None):
+    """
+    This function builds songplays table records by resolving song_id and artist_id
+    of all records at once against an in-memory song lookup index.
+
+    Parameters
+    ----------
+    songplay_df : DataFrame
+                    Songplay records with SONGPLAY_COLUMNS
+    index       : SongLookupIndex
+                    Song lookup index
+    keys        : SurrogateKeys
+                    If set, song_id and artist_id are then resolved to their surrogate keys
+    cur         : Cursor object
+                    Cursor fetching the surrogate keys missing from `keys`
+
+    Returns
+    -------
+    DataFrame with SONGPLAY_TABLE_COLUMNS, or SONGPLAY_SURROGATE_COLUMNS if `keys` is set
+    """
+    with stage('resolve'):
+        matches = index.resolve(songplay_df)
+        if keys is not None:
+            matches = keys.translate(cur, matches)
+            return pd.DataFrame({
+                "start_time": songplay_df["start_time"],
+                "user_id": songplay_df["userId"],
+                "level": songplay_df["level"],
+                "song_key": matches["song_key"],
+                "artist_key": matches["artist_key"],
+                "session_id": songplay_df["sessionId"],
+                "location": songplay_df["location"],
+                "user_agent": songplay_df["userAgent"],
+            })[SONGPLAY_SURROGATE_COLUMNS]
+    return pd.DataFrame({
+        "start_time": songplay_df["start_time"],
+        "user_id": songplay_df["userId"],
+        "level": songplay_df["level"],
+        "song_id": matches["song_id"],
+        "artist_id": matches["artist_id"],
+        "session_id": songplay_df["sessionId"],
+        "location": songplay_df["location"],
+        "user_agent": songplay_df["userAgent"],
+    })[SONGPLAY_TABLE_COLUMNS]
+
+
+def to_records(df):
+    """
+    This function converts a data frame to a list of tuples of python objects (NaN as None),
+    ready to be passed as query parameters.
+
+    Parameters
+    ----------
+    df          : DataFrame
+                    Data frame to convert
+    """
+    df = df.astype(object)
+    return list(df.where(df.notna(), None).itertuples(index=False, name=None))
+
+
+def read_song_file(filepath):
+    """
+    This function reads a json song file then selects song & artist data.
+
+    Parameters
+    ----------
+    filepath    : string
+                    Path to song file
+
+    Returns
+    -------
+    (song_df, artist_df) data frames
+    """
+    with stage('read'):
+        df, counts = read_song_files([filepath])
+    with stage('transform'):
+        return transform_song_data(df)
+
+
+def read_log_file(filepath):
+    """
+    This function reads a json log file then selects time, user and songplay data.
+
+    Parameters
+    ----------
+    filepath    : string
+                    Path to log file
+
+    Returns
+    -------
+    (time_df, user_df, songplay_df) data frames
+    """
+    with stage('read'):
+        df = pd.read_json(filepath, lines=True)
+    with stage('transform'):
+        return transform_log_data(df)
+
+
+def iter_log_chunks(filepath, chunk_size):
+    """
+    This function reads a json log file in chunks of lines then selects time, user and songplay data of each chunk,
+    so that memory is bound by the chunk size instead of the file size.
+
+    Parameters
+    ----------
+    filepath    : string
+                    Path to log file
+    chunk_size  : integer
+                    Number of lines per chunk
+
+    Yields
+    ------
+    (time_df, user_df, songplay_df) data frames of each chunk, in file order
+    """
+    with pd.read_json(filepath, lines=True, chunksize=chunk_size) as reader:
+        while True:
+            with stage('read'):
+                df = next(reader, None)
+            if df is None:
+                return
+            with stage('transform'):
+                frames = transform_log_data(df)
+            yield frames
+
+
+def read_log_months(filepath):
+    """
+    This function returns the months of the NextSong events of a json log file, reading it line by line
+    and keeping only the months, so that songplays partitions can be created before loading the file.
+
+    Parameters
+    ----------
+    filepath    : string
+                    Path to log file
+
+    Returns
+    -------
+    Set of (year, month) tuples
+    """
+    months = set()
+    with open(filepath, 'r', encoding='utf8') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                if record.get('page') == 'NextSong':
+                    t = datetime.datetime(1970, 1, 1) + datetime.timedelta(milliseconds=record['ts'])
+                    months.add((t.year, t.month))
+    return months
+
+
+def ensure_log_partitions(partitions, filepaths):
+    """
+    This function creates the songplays partitions of the events of log files, before the transaction loading
+    them in several writes (several files or chunks) writes its first songplay: the partition of a later
+    write could not be created once songplays are written, the transaction holding a lock on songplays.
+
+    Parameters
+    ----------
+    partitions  : SongplayPartitions
+                    Partitions of songplays table
+    filepaths   : list
+                    Paths to log files
+    """
+    with stage('partitions'):
+        partitions.ensure_months(set().union(*(read_log_months(filepath) for filepath in filepaths)))
+
+
+def concat_frames(frames):
+    """
+    This function concatenates tuples of data frames read from several files component-wise.
+
+    Parameters
+    ----------
+    frames      : list
+                    Tuples of data frames as returned by `read_song_file` or `read_log_file`
+    """
+    return tuple(pd.concat(dfs, ignore_index=True) for dfs in zip(*frames))
+
+
+def inserted_songplays(cur, keys=None):
+    """
+    This function fetches the songplays returned by the last songplays insert,
+    with the natural ids of their songs and artists.
+
+    Parameters
+    ----------
+    cur         : Cursor object
+                    Cursor that ran the insert
+    keys        : SurrogateKeys
+                    If set, the insert returned surrogate keys which are resolved back to natural ids
+
+    Returns
+    -------
+    List of (start_time, user_id, level, song_id, artist_id) tuples
+    """
+    rows = cur.fetchall()
+    return keys.naturalize(cur, rows) if keys is not None else rows
+
+
+def load_song_data(cur, song_df, artist_df, index=None, append=False, backfill=None):
+    """
+    This function inserts song & artist data record by record into songs and artists tables.
+
+    Parameters
+    ----------
+    cur         : Cursor object
+                    Cursor connected to postgreSQL session
+    song_df     : DataFrame
+                    Song records with SONG_COLUMNS
+    artist_df   : DataFrame
+                    Artist records with ARTIST_COLUMNS
+    index       : SongLookupIndex
+                    If set, loaded songs are added to this song lookup index
+    backfill    : SongBackfill
+                    If set, loaded songs are recorded to resolve the songplays left unresolved by earlier runs
+    append      : boolean
+                    If set, records are appended without conflict handling, tables being in the load phase
+
+    Returns
+    -------
+    Number of rows written
+    """
+    if index is not None:
+        index.add(song_df, artist_df)
+    if backfill is not None:
+        backfill.add(song_df)
+
+    # insert song record
+    with stage('write_songs'):
+        for song_data in to_records(song_df):
+            cur.execute(song_table_append if append else song_table_insert, song_data)
+    count_rows('songs', len(song_df))
+
+    # insert artist record
+    with stage('write_artists'):
+        for artist_data in to_records(artist_df):
+            cur.execute(artist_table_append if append else artist_table_insert, artist_data)
+    count_rows('artists', len(artist_df))
+
+    return len(song_df) + len(artist_df)
+
+
+def load_log_data(cur, time_df, user_df, songplay_df, index=None, dimensions=None, partitions=None, append=False,
+                  rollups=False, keys=None):
+    """
+    This function inserts time, user and songplay data record by record into time, users and songplays tables.
+
+    Parameters
+    ----------
+    cur         : Cursor object
+                    Cursor connected to postgreSQL session
+    time_df     : DataFrame
+                    Time records with TIME_COLUMNS
+    user_df     : DataFrame
+                    User records with USER_COLUMNS and start_time
+    songplay_df : DataFrame
+                    Songplay records with SONGPLAY_COLUMNS
+    index       : SongLookupIndex
+                    If set, song_id and artist_id are resolved against this song lookup index
+                    instead of running `song_select` for every record
+    dimensions  : Dimensions
+                    If set, time and user records are collapsed by these run-level dimension builders
+                    so that each key is written once per run
+    partitions  : SongplayPartitions
+                    If set, the songplays partitions of the records are created before they are written
+    append      : boolean
+                    If set, records are appended without conflict handling, tables being in the load phase
+    rollups     : boolean
+                    If set, the songplays inserted are added to the rollup tables in the same transaction
+    keys        : SurrogateKeys
+                    If set, songplays table stores surrogate keys, song_id and artist_id are resolved to them
+
+    Returns
+    -------
+    Number of rows written
+    """
+    if partitions is not None:
+        partitions.ensure(songplay_df['start_time'])
+    if dimensions is not None:
+        with stage('collapse'):
+            time_df, user_df = dimensions.times.collapse(time_df), dimensions.users.collapse(user_df)
+
+    # insert time data records, in key order so that concurrent writers lock keys in the same order
+    with stage('write_time'):
+        for time_data in to_records(time_df.sort_values("start_time", kind="stable")):
+            cur.execute(time_table_append if append else time_table_insert, time_data)
+    count_rows('time', len(time_df))
+
+    # insert user records with their time, in key order then by time so that the latest level of a user
+    # is written last, and is not overwritten by an older record loaded later by another writer
+    user_columns = USER_COLUMNS + ["start_time"]
+    with stage('write_users'):
+        for user_data in to_records(user_df.sort_values(["userId", "start_time"], kind="stable")[user_columns]):
+            cur.execute(user_table_append if append else user_table_insert, user_data)
+    count_rows('users', len(user_df))
+
+    # songplays actually inserted, as returned by the inserts, are added to the rollups
+    delta = RollupDelta() if rollups else None
+
+    if keys is not None:
+        songplay_insert, songplay_song_select = songplay_table_insert_surrogate, song_select_surrogate
+    else:
+        songplay_insert, songplay_song_select = songplay_table_append if append else songplay_table_insert, song_select
+
+    # insert songplay records resolved against the song lookup index
+    if index is not None:
+        songplays = build_songplays(songplay_df, index, keys, cur)
+        unresolved = songplays["song_key" if keys is not None else "song_id"].isna()
+        with stage('write_songplays'):
+            for songplay_data in to_records(songplays):
+                cur.execute(songplay_insert, songplay_data)
+                if delta is not None:
+                    delta.add(inserted_songplays(cur, keys))
+    else:
+        unresolved = []
+        # insert songplay records
+        with stage('write_songplays'):
+            for row in songplay_df.itertuples(index=False):
+
+                # get songid and artistid from song and artist tables
+                cur.execute(songplay_song_select, (row.song, row.artist, row.length))
+                results = cur.fetchone()
+
+                if results:
+                    songid, artistid = results
+                else:
+                    songid, artistid = None, None
+                unresolved.append(not results)
+
+                # insert songplay record
+                songplay_data = (
+                    row.start_time,
+                    int(row.userId),
+                    row.level,
+                    songid,
+                    artistid,
+                    int(row.sessionId),
+                    row.location,
+                    row.userAgent
+                )
+                cur.execute(songplay_insert, songplay_data)
+                if delta is not None:
+                    delta.add(inserted_songplays(cur, keys))
+    count_rows('songplays', len(songplay_df))
+
+    # songplays without a song are kept to be resolved once their song is loaded
+    with stage('write_unresolved'):
+        count_rows('songplays_unresolved', record_unresolved(cur, songplay_df[unresolved]))
+
+    if delta is not None:
+        with stage('write_rollups'):
+            delta.apply(cur)
+
+    return len(time_df) + len(user_df) + len(songplay_df)
+
+
+def process_song_file(cur, filepath, index=None, append=False, backfill=None):
     """
     This function processes a json song file by reading the file data, select song & atrist data
     then load these data into the appropriate tables.
-    
+
     Parameters
     ----------
     cur         : Cursor object
                     Cursor connected to postgreSQL session
     filepath    : string
                     Path to song file
+    index       : SongLookupIndex
+                    If set, loaded songs are added to this song lookup index
+    backfill    : SongBackfill
+                    If set, loaded songs are recorded to resolve the songplays left unresolved by earlier runs
+    append      : boolean
+                    If set, records are appended without conflict handling, tables being in the load phase
+
+    Returns
+    -------
+    Number of rows written
     """
-    # open song file
-    df = pd.read_json(filepath, lines=True)
-    
-    # columns needed for song table
-    song_columns = ["song_id", "title", "artist_id", "year", "duration"]
-    
-    # insert song record
-    song_data = df[song_columns].values.tolist()[0]
-    cur.execute(song_table_insert, song_data)
-    
-    # columns needed for artists table
-    artist_columns = ["artist_id", "artist_name", "artist_location", "artist_latitude", "artist_longitude"]
-        
-    # insert artist record
-    artist_data = df[artist_columns].values.tolist()[0]
-    cur.execute(artist_table_insert, artist_data)
+    song_df, artist_df = read_song_file(filepath)
+    return load_song_data(cur, song_df, artist_df, index, append, backfill)
+
+
+def process_song_files(cur, filepaths, index=None, append=False, backfill=None):
+    """
+    This function processes a batch of json song files at once by decoding all files data into one data frame,
+    select song & atrist data then load these data into the appropriate tables.
 
+    Parameters
+    ----------
+    cur         : Cursor object
+                    Cursor connected to postgreSQL session
+    filepaths   : list
+                    Paths to song files
+    index       : SongLookupIndex
+                    If set, loaded songs are added to this song lookup index
+    backfill    : SongBackfill
+                    If set, loaded songs are recorded to resolve the songplays left unresolved by earlier runs
+    append      : boolean
+                    If set, records are appended without conflict handling, tables being in the load phase
+
+    Returns
+    -------
+    List of the number of rows written from each file
+    """
+    with stage('read'):
+        df, counts = read_song_files(filepaths)
+    with stage('transform'):
+        song_df, artist_df = transform_song_data(df)
+    load_song_data(cur, song_df, artist_df, index, append, backfill)
 
-def process_log_file(cur, filepath):
+    # every song record is written to songs and artists tables
+    return [2 * count for count in counts]
+
+
+def process_log_file(cur, filepath, index=None, dimensions=None, partitions=None, chunk_size=None,
+                     append=False, rollups=False, keys=None):
     """
     This function processes a json log file by reading the file data, select time, user and songplay data
     then load these data into the appropriate tables.
-    
+
     Parameters
     ----------
     cur         : Cursor object
                     Cursor connected to postgreSQL session
     filepath    : string
                     Path to log file
+    index       : SongLookupIndex
+                    If set, song_id and artist_id are resolved against this song lookup index
+                    instead of running `song_select` for every record
+    dimensions  : Dimensions
+                    If set, time and user records are collapsed by these run-level dimension builders
+                    so that each key is written once per run
+    partitions  : SongplayPartitions
+                    If set, the songplays partitions of the records are created before they are written
+    chunk_size  : integer
+                    If set, the file is read, transformed and loaded this many lines at a time
+    append      : boolean
+                    If set, records are appended without conflict handling, tables being in the load phase
+    rollups     : boolean
+                    If set, the songplays inserted are added to the rollup tables in the same transaction
+    keys        : SurrogateKeys
+                    If set, songplays table stores surrogate keys, song_id and artist_id are resolved to them
+
+    Returns
+    -------
+    Number of rows written
     """
-    # open log file
-    df = pd.read_json(filepath, lines=True)
+    if chunk_size:
+        # without run-level builders, file-level ones keep the latest level of each user across chunks
+        dimensions = dimensions if dimensions is not None else Dimensions()
+        if partitions is not None:
+            ensure_log_partitions(partitions, [filepath])
+        return sum(load_log_data(cur, time_df, user_df, songplay_df, index, dimensions, None, append,
+                                 rollups, keys)
+                   for time_df, user_df, songplay_df in iter_log_chunks(filepath, chunk_size))
 
-    # filter by NextSong action
-    df = df[df.page=='NextSong']
+    time_df, user_df, songplay_df = read_log_file(filepath)
+    return load_log_data(cur, time_df, user_df, songplay_df, index, dimensions, partitions, append, rollups, keys)
 
-    # convert timestamp column to datetime
-    t = pd.to_datetime(df['ts'],unit='ms')
-    
-    # insert time data records
-    time_data = (t, t.dt.hour, t.dt.day, t.dt.week, t.dt.month, t.dt.year, t.dt.weekday)
-    column_labels = ("start_time", "hour", "day", "week", "month", "year", "weekday")
-    time_df = pd.DataFrame(dict(zip(column_labels,time_data)))
-
-    for i, row in time_df.iterrows():
-        cur.execute(time_table_insert, list(row))
-
-    # columns needed for user table
-    user_columns = ["userId", "firstName", "lastName", "gender", "level"]
-    
-    # load user table
-    user_df = df[user_columns]
-
-    # insert user records
-    for i, row in user_df.iterrows():
-        cur.execute(user_table_insert, row)
-
-    # insert songplay records
-    for index, row in df.iterrows():
-        
-        # get songid and artistid from song and artist tables
-        cur.execute(song_select, (row.song, row.artist, row.length))
-        results = cur.fetchone()
-        
-        if results:
-            songid, artistid = results
-        else:
-            songid, artistid = None, None
 
-        # insert songplay record
-        songplay_data = (
-            pd.to_datetime(row.ts,unit='ms'),
-            row.userId,
-            row.level,
-            songid,
-            artistid,
-            row.sessionId,
-            row.location,
-            row.userAgent
-        )
-        cur.execute(songplay_table_insert, songplay_data)
+def process_log_files(cur, filepaths, **kwargs):
+    """
+    This function processes a batch of json log files one by one with `process_log_file`,
+    in the transaction of the batch.
+
+    Parameters
+    ----------
+    cur         : Cursor object
+                    Cursor connected to postgreSQL session
+    filepaths   : list
+                    Paths to log files
+    kwargs      : keyword arguments
+                    Passed on to `process_log_file`
+
+    Returns
+    -------
+    List of the number of rows written from each file
+    """
+    # partitions of all files are created before the first file is written
+    partitions = kwargs.pop('partitions', None)
+    if partitions is not None:
+        ensure_log_partitions(partitions, filepaths)
+    return [process_log_file(cur, filepath, **kwargs) for filepath in filepaths]
 
 
-def process_data(cur, conn, filepath, func):
+def copy_dataframe(cur, df, copy_query):
     """
-    This function all json files on a directory and its sub-directories one by one by calling back the passed function
-    
+    This function streams a data frame into a table using `COPY ... FROM STDIN` in csv format.
+
     Parameters
     ----------
     cur         : Cursor object
                     Cursor connected to postgreSQL session
-    conn        : Connection object
-                    Session connection to postgreSQL database
+    df          : DataFrame
+                    Data frame whose columns are in the order of the COPY column list
+    copy_query  : string
+                    A `COPY ... FROM STDIN WITH (FORMAT csv)` query
+    """
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    cur.copy_expert(copy_query, buffer)
+
+
+def create_staging_tables(cur):
+    """
+    Creates the session-local staging tables used by the bulk load path.
+    Staging tables are emptied on every commit.
+    """
+    for query in create_staging_table_queries:
+        cur.execute(query)
+
+
+def bulk_load_song_data(cur, song_df, artist_df, index=None, append=False, backfill=None):
+    """
+    This function copies song & artist data into the staging tables
+    then merges them into songs and artists tables.
+
+    Parameters
+    ----------
+    cur         : Cursor object
+                    Cursor connected to postgreSQL session
+    song_df     : DataFrame
+                    Song records with SONG_COLUMNS
+    artist_df   : DataFrame
+                    Artist records with ARTIST_COLUMNS
+    index       : SongLookupIndex
+                    If set, loaded songs are added to this song lookup index
+    backfill    : SongBackfill
+                    If set, loaded songs are recorded to resolve the songplays left unresolved by earlier runs
+    append      : boolean
+                    If set, records are appended without conflict handling, tables being in the load phase
+
+    Returns
+    -------
+    Number of rows written
+    """
+    if index is not None:
+        index.add(song_df, artist_df)
+    if backfill is not None:
+        backfill.add(song_df)
+
+    with stage('write_songs'):
+        copy_dataframe(cur, song_df, song_stage_copy)
+        cur.execute(song_stage_append if append else song_stage_merge)
+    count_rows('songs', len(song_df))
+
+    with stage('write_artists'):
+        copy_dataframe(cur, artist_df, artist_stage_copy)
+        cur.execute(artist_stage_append if append else artist_stage_merge)
+    count_rows('artists', len(artist_df))
+
+    return len(song_df) + len(artist_df)
+
+
+def bulk_load_log_data(cur, time_df, user_df, songplay_df, index=None, dimensions=None, partitions=None,
+                       append=False, rollups=False, keys=None):
+    """
+    This function copies time, user and songplay data into the staging tables
+    then merges them into time, users and songplays tables.
+
+    Parameters
+    ----------
+    cur         : Cursor object
+                    Cursor connected to postgreSQL session
+    time_df     : DataFrame
+                    Time records with TIME_COLUMNS
+    user_df     : DataFrame
+                    User records with USER_COLUMNS and start_time
+    songplay_df : DataFrame
+                    Songplay records with SONGPLAY_COLUMNS
+    index       : SongLookupIndex
+                    If set, song_id and artist_id are resolved against this song lookup index
+                    before staging instead of being joined in the database
+    dimensions  : Dimensions
+                    If set, time and user records are collapsed by these run-level dimension builders
+                    so that each key is written once per run
+    partitions  : SongplayPartitions
+                    If set, the songplays partitions of the records are created before they are written
+    append      : boolean
+                    If set, records are appended without conflict handling, tables being in the load phase
+    rollups     : boolean
+                    If set, the songplays inserted are added to the rollup tables in the same transaction
+    keys        : SurrogateKeys
+                    If set, songplays table stores surrogate keys, song_id and artist_id are resolved to them
+
+    Returns
+    -------
+    Number of rows written
+    """
+    if partitions is not None:
+        partitions.ensure(songplay_df['start_time'])
+    if dimensions is not None:
+        with stage('collapse'):
+            time_df, user_df = dimensions.times.collapse(time_df), dimensions.users.collapse(user_df)
+
+    with stage('write_time'):
+        copy_dataframe(cur, time_df, time_stage_copy)
+        cur.execute(time_stage_append if append else time_stage_merge)
+    count_rows('time', len(time_df))
+
+    with stage('write_users'):
+        copy_dataframe(cur, user_df, user_stage_copy)
+        cur.execute(user_stage_append if append else user_stage_merge)
+    count_rows('users', len(user_df))
+
+    if keys is not None:
+        songplay_copy, songplay_merge = songplay_resolved_stage_copy_surrogate, songplay_resolved_stage_merge_surrogate
+        songplay_lookup_merge, unresolved_insert = songplay_stage_merge_surrogate, songplay_unresolved_stage_insert_surrogate
+    elif append:
+        songplay_copy, songplay_merge = songplay_resolved_stage_copy, songplay_resolved_stage_append
+        songplay_lookup_merge = songplay_stage_append
+        unresolved_insert = songplay_unresolved_stage_append if index is not None \
+            else songplay_unresolved_lookup_stage_append
+    else:
+        songplay_copy, songplay_merge = songplay_resolved_stage_copy, songplay_resolved_stage_merge
+        songplay_lookup_merge, unresolved_insert = songplay_stage_merge, songplay_unresolved_stage_insert
+
+    if index is not None:
+        # the event fields of the songplays are staged too, for those left unresolved
+        songplay_df = build_songplays(songplay_df, index, keys, cur).assign(
+            song=songplay_df["song"], artist=songplay_df["artist"], length=songplay_df["length"])
+        with stage('write_songplays'):
+            copy_dataframe(cur, songplay_df, songplay_copy)
+            cur.execute(songplay_merge)
+    else:
+        with stage('write_songplays'):
+            copy_dataframe(cur, songplay_df, songplay_stage_copy)
+            cur.execute(songplay_lookup_merge)
+    count_rows('songplays', len(songplay_df))
+
+    # songplays actually inserted, as returned by the merge, are added to the rollups
+    if rollups:
+        with stage('write_rollups'):
+            delta = RollupDelta()
+            delta.add(inserted_songplays(cur, keys))
+            delta.apply(cur)
+
+    # songplays without a song are kept to be resolved once their song is loaded
+    with stage('write_unresolved'):
+        cur.execute(unresolved_insert)
+        count_rows('songplays_unresolved', cur.rowcount)
+
+    return len(time_df) + len(user_df) + len(songplay_df)
+
+
+def bulk_process_song_files(cur, filepaths, index=None, append=False, backfill=None):
+    """
+    This function processes a batch of json song files at once by reading all files data,
+    select song & atrist data then bulk load these data into the appropriate tables.
+
+    Parameters
+    ----------
+    cur         : Cursor object
+                    Cursor connected to postgreSQL session
+    filepaths   : list
+                    Paths to song files
+    index       : SongLookupIndex
+                    If set, loaded songs are added to this song lookup index
+    backfill    : SongBackfill
+                    If set, loaded songs are recorded to resolve the songplays left unresolved by earlier runs
+    append      : boolean
+                    If set, records are appended without conflict handling, tables being in the load phase
+
+    Returns
+    -------
+    List of the number of rows written from each file
+    """
+    with stage('read'):
+        df, counts = read_song_files(filepaths)
+    with stage('transform'):
+        song_df, artist_df = transform_song_data(df)
+    bulk_load_song_data(cur, song_df, artist_df, index, append, backfill)
+
+    # every song record is written to songs and artists tables
+    return [2 * count for count in counts]
+
+
+def bulk_process_log_files(cur, filepaths, index=None, dimensions=None, partitions=None, chunk_size=None,
+                           append=False, rollups=False, keys=None):
+    """
+    This function processes a batch of json log files at once by reading all files data,
+    select time, user and songplay data then bulk load these data into the appropriate tables.
+
+    Parameters
+    ----------
+    cur         : Cursor object
+                    Cursor connected to postgreSQL session
+    filepaths   : list
+                    Paths to log files
+    index       : SongLookupIndex
+                    If set, song_id and artist_id are resolved against this song lookup index
+    dimensions  : Dimensions
+                    If set, time and user records are collapsed by these run-level dimension builders
+                    so that each key is written once per run
+    partitions  : SongplayPartitions
+                    If set, the songplays partitions of the records are created before they are written
+    chunk_size  : integer
+                    If set, files are read, transformed and loaded this many lines at a time
+                    instead of all files of the batch at once
+    append      : boolean
+                    If set, records are appended without conflict handling, tables being in the load phase
+    rollups     : boolean
+                    If set, the songplays inserted are added to the rollup tables in the same transaction
+    keys        : SurrogateKeys
+                    If set, songplays table stores surrogate keys, song_id and artist_id are resolved to them
+
+    Returns
+    -------
+    List of the number of rows read from each file
+    """
+    if chunk_size:
+        # without run-level builders, batch-level ones keep the latest level of each user across chunks
+        dimensions = dimensions if dimensions is not None else Dimensions()
+        if partitions is not None:
+            ensure_log_partitions(partitions, filepaths)
+        row_counts = []
+        for filepath in filepaths:
+            row_count = 0
+            for time_df, user_df, songplay_df in iter_log_chunks(filepath, chunk_size):
+                bulk_load_log_data(cur, time_df, user_df, songplay_df, index, dimensions, None, append,
+                                   rollups, keys)
+                # staging tables are only emptied on commit
+                cur.execute(log_stage_truncate)
+                row_count += len(time_df) + len(user_df) + len(songplay_df)
+            row_counts.append(row_count)
+        return row_counts
+
+    frames = [read_log_file(filepath) for filepath in filepaths]
+    time_df, user_df, songplay_df = concat_frames(frames)
+    bulk_load_log_data(cur, time_df, user_df, songplay_df, index, dimensions, partitions, append, rollups, keys)
+    return [sum(len(df) for df in file_frames) for file_frames in frames]
+
+
+def get_files(filepath):
+    """
+    This function returns the sorted absolute paths of all json files on a directory and its sub-directories.
+
+    Parameters
+    ----------
     filepath    : string
                     Path to data driectory that contains data files
-    func        : function
-                    A callback function to process a specific data file to be extracted, transformed and loaded (ETL)
-                    to the appropriate tables
     """
-    # get all files matching extension from directory
     all_files = []
     for root, dirs, files in os.walk(filepath):
         files = glob.glob(os.path.join(root,'*.json'))
         for f in files :
             all_files.append(os.path.abspath(f))
 
+    return sorted(all_files)
+
+
+def print_throughput(num_rows, elapsed):
+    """
+    This function prints the number of rows written and the rows written per second.
+    """
+    print('{} rows written in {:.2f}s ({:.0f} rows/sec).'.format(num_rows, elapsed, num_rows / elapsed if elapsed else 0))
+
+
+def get_new_files(cur, conn, filepath, incremental=True):
+    """
+    This function returns the files of a data directory to load, as ManifestEntry.
+
+    Parameters
+    ----------
+    cur         : Cursor object
+                    Cursor connected to postgreSQL session
+    conn        : Connection object
+                    Session connection to postgreSQL database
+    filepath    : string
+                    Path to data driectory that contains data files
+    incremental : boolean
+                    If set, files already loaded and unchanged according to etl_manifest table are skipped
+    """
+    # get all files matching extension from directory
+    all_files = get_files(filepath)
+
     # get total number of files found
-    num_files = len(all_files)
-    print('{} files found in {}'.format(num_files, filepath))
+    print('{} files found in {}'.format(len(all_files), filepath))
+
+    if not incremental:
+        return [file_entry(datafile) for datafile in all_files]
+
+    new_files = select_new_files(cur, all_files)
+    conn.commit()
+    print('{} new or changed files to load.'.format(len(new_files)))
+
+    return new_files
+
+
+def load_files(cur, conn, entries, func, phase, metrics):
+    """
+    This function loads a batch of files in one transaction, recording every file in etl_manifest table
+    before committing so that a file is recorded if and only if its data is committed.
+
+    Parameters
+    ----------
+    cur         : Cursor object
+                    Cursor connected to postgreSQL session
+    conn        : Connection object
+                    Session connection to postgreSQL database
+    entries     : list
+                    ManifestEntry of the files to load
+    func        : function
+                    A callback function called with the list of file paths,
+                    returning the number of rows written from each file
+    phase       : string
+                    Data directory being processed
+    metrics     : Metrics
+                    Run metrics measuring the batch
+
+    Returns
+    -------
+    List of the number of rows written from each file
+    """
+    with metrics.unit(phase, entries, cur):
+        row_counts = func(cur, [entry.path for entry in entries])
+        with stage('commit'):
+            for entry, row_count in zip(entries, row_counts):
+                record_file(cur, entry, row_count)
+            conn.commit()
+    return row_counts
+
+
+def process_data(cur, conn, filepath, func, batch_size=None, incremental=True, metrics=None):
+    """
+    This function all json files on a directory and its sub-directories one by one by calling back the passed function
+
+    Parameters
+    ----------
+    cur         : Cursor object
+                    Cursor connected to postgreSQL session
+    conn        : Connection object
+                    Session connection to postgreSQL database
+    filepath    : string
+                    Path to data driectory that contains data files
+    func        : function
+                    A callback function to process a specific data file to be extracted, transformed and loaded (ETL)
+                    to the appropriate tables
+    batch_size  : integer
+                    If set, `func` is called with lists of up to `batch_size` file paths instead of one path
+                    and returns the number of rows written from each file
+    incremental : boolean
+                    If set, files already loaded and unchanged according to etl_manifest table are skipped
+    metrics     : Metrics
+                    If set, every call of `func` is measured by these run metrics
+
+    Returns
+    -------
+    Number of rows written
+    """
+    metrics = metrics if metrics is not None else Metrics()
+    phase = os.path.basename(os.path.normpath(filepath))
+
+    # files to load, each file is recorded in etl_manifest table in the transaction loading it
+    new_files = get_new_files(cur, conn, filepath, incremental)
+    num_files = len(new_files)
+
+    start = time.perf_counter()
+    num_rows = 0
+
+    if batch_size:
+        # iterate over batches of files and process
+        for i in range(0, num_files, batch_size):
+            batch = new_files[i:i + batch_size]
+            row_counts = load_files(cur, conn, batch, func, phase, metrics)
+            num_rows += sum(row_counts)
+            print('{}/{} files processed.'.format(i + len(batch), num_files))
+    else:
+        # iterate over files and process
+        for i, entry in enumerate(new_files, 1):
+            with metrics.unit(phase, [entry], cur):
+                row_count = func(cur, entry.path)
+                with stage('commit'):
+                    record_file(cur, entry, row_count)
+                    conn.commit()
+            num_rows += row_count
+            print('{}/{} files processed.'.format(i, num_files))
+
+    print_throughput(num_rows, time.perf_counter() - start)
+    metrics.write_prometheus()
+
+    return num_rows
+
+
+def load_with_retry(conn, cur, load_func, frames, entry, dimensions=None, attempts=3):
+    """
+    This function loads a tuple of data frames read from a file, records the file in etl_manifest table
+    and commits, retrying when the transaction is rolled back by a deadlock with another writer.
+
+    Parameters
+    ----------
+    conn        : Connection object
+                    Session connection to postgreSQL database
+    cur         : Cursor object
+                    Cursor connected to postgreSQL session
+    load_func   : function
+                    A callback function loading the data frames as `load_func(cur, *frames)`
+    frames      : tuple
+                    Data frames to load
+    entry       : ManifestEntry
+                    File the data frames were read from
+    dimensions  : Dimensions
+                    If set, passed on to `load_func` and reset when the transaction is rolled back
+    attempts    : integer
+                    Maximum number of attempts
 
-    # iterate over files and process
-    for i, datafile in enumerate(all_files, 1):
-        func(cur, datafile)
-        conn.commit()
-        print('{}/{} files processed.'.format(i, num_files))
+    Returns
+    -------
+    Number of rows written
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            if dimensions is not None:
+                num_rows = load_func(cur, *frames, dimensions=dimensions)
+            else:
+                num_rows = load_func(cur, *frames)
+            with stage('commit'):
+                record_file(cur, entry, num_rows)
+                conn.commit()
+            return num_rows
+        except psycopg2.errors.DeadlockDetected:
+            conn.rollback()
+            if dimensions is not None:
+                dimensions.reset()
+            if attempt == attempts:
+                raise
+
+
+def process_data_parallel(filepath, read_func, load_func, workers=None, writers=1, queue_size=64, bulk=True,
+                          incremental=True, dimensions=None, metrics=None):
+    """
+    This function processes all json files on a directory and its sub-directories in parallel:
+    a pool of processes reads and transforms files and a bounded queue feeds their data frames
+    to writer threads, each with its own database connection.
+
+    Files are handed to the writers in file order. With a single writer they are loaded in that order too.
+    A writer whose connection is lost stops, and the run stops with its error instead of waiting for it.
 
+    Parameters
+    ----------
+    filepath    : string
+                    Path to data driectory that contains data files
+    read_func   : function
+                    A picklable function reading and transforming a data file into a tuple of data frames
+    load_func   : function
+                    A callback function loading a tuple of data frames to the appropriate tables
+                    as `load_func(cur, *frames)`, returning the number of rows written
+    workers     : integer
+                    Number of reader processes, defaults to the number of CPUs
+    writers     : integer
+                    Number of writer threads and database connections
+    queue_size  : integer
+                    Maximum number of files read but not yet loaded, readers wait when it is reached
+    bulk        : boolean
+                    Whether writer connections need the bulk load staging tables
+    incremental : boolean
+                    If set, files already loaded and unchanged according to etl_manifest table are skipped
+    dimensions  : Dimensions
+                    If set, each writer collapses time and user records with its own dimension builders,
+                    passed to `load_func` as `dimensions`, whose counters are added to this one
+    metrics     : Metrics
+                    If set, every file is measured by these run metrics, including the stages run by the readers
 
-def main():
+    Returns
+    -------
+    (number of rows written, list of (file path, error message) sorted in file order)
+    """
+    metrics = metrics if metrics is not None else Metrics()
+    phase = os.path.basename(os.path.normpath(filepath))
+
+    # connect writers up front so a connection failure stops the run before any file is read
+    connections = [psycopg2.connect(DSN) for _ in range(writers)]
+    if bulk:
+        for conn in connections:
+            create_staging_tables(conn.cursor())
+
+    # files to load, each file is recorded in etl_manifest table in the transaction loading it
+    new_files = get_new_files(connections[0].cursor(cursor_factory=CountingCursor), connections[0], filepath, incremental)
+    num_files = len(new_files)
+
+    work = queue.Queue(maxsize=queue_size)
+    lock = threading.Lock()
+    progress = {'files': 0, 'rows': 0, 'printed': 0.0}
+    errors = {}
+    # errors that stopped a writer, re-raised by the thread handing files over
+    failures = []
+    start = time.perf_counter()
+
+    def report(force=False):
+        elapsed = time.perf_counter() - start
+        if force or elapsed - progress['printed'] >= 1:
+            progress['printed'] = elapsed
+            print('{}/{} files, {} rows, {:.0f} rows/sec.'.format(
+                progress['files'], num_files, progress['rows'], progress['rows'] / elapsed if elapsed else 0))
+
+    def write(conn):
+        cur = conn.cursor(cursor_factory=CountingCursor)
+        # builders are per writer so that keys are only taken as written by the transaction writing them,
+        # refreshing the time of unchanged users when other writers may load older records of them
+        writer_dimensions = Dimensions(refresh=writers > 1) if dimensions is not None else None
+        try:
+            while True:
+                item = work.get()
+                if item is None:
+                    break
+                position, entry, (frames, read_stages) = item
+                try:
+                    with metrics.unit(phase, [entry], cur, read_stages):
+                        num_rows = load_with_retry(conn, cur, load_func, frames, entry, writer_dimensions)
+                except Exception as e:
+                    with lock:
+                        errors[position] = (entry.path, repr(e))
+                    try:
+                        conn.rollback()
+                    except psycopg2.Error:
+                        # the connection is lost, this writer cannot load any other file
+                        raise e
+                    if writer_dimensions is not None:
+                        writer_dimensions.reset()
+                    num_rows = 0
+                with lock:
+                    progress['files'] += 1
+                    progress['rows'] += num_rows
+                    report()
+        except Exception as e:
+            with lock:
+                failures.append(e)
+        finally:
+            conn.close()
+            if writer_dimensions is not None:
+                with lock:
+                    dimensions.add_counts(writer_dimensions)
+
+    threads = [threading.Thread(target=write, args=(conn,), daemon=True) for conn in connections]
+    for thread in threads:
+        thread.start()
+
+    def hand_over(item):
+        # once writers stopped, nothing takes items off a full queue
+        while True:
+            if failures:
+                raise failures[0]
+            if not any(thread.is_alive() for thread in threads):
+                raise RuntimeError('all writers stopped')
+            try:
+                work.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # keep a bounded window of files in flight and hand them over in file order
+        window = (workers or os.cpu_count()) * 2
+        pending = collections.deque()
+        files = iter(enumerate(new_files))
+
+        for position, entry in itertools.islice(files, window):
+            pending.append((position, entry, executor.submit(timed_read, read_func, entry.path)))
+
+        while pending:
+            position, entry, future = pending.popleft()
+            try:
+                frames = future.result()
+            except Exception as e:
+                with lock:
+                    errors[position] = (entry.path, repr(e))
+                    progress['files'] += 1
+            else:
+                hand_over((position, entry, frames))
+
+            for position, entry in itertools.islice(files, 1):
+                pending.append((position, entry, executor.submit(timed_read, read_func, entry.path)))
+
+    for thread in threads:
+        hand_over(None)
+    for thread in threads:
+        thread.join()
+    if failures:
+        raise failures[0]
+
+    report(force=True)
+    print_throughput(progress['rows'], time.perf_counter() - start)
+    metrics.write_prometheus()
+
+    errors = [errors[position] for position in sorted(errors)]
+    for datafile, error in errors:
+        print('Failed to process {}: {}'.format(datafile, error))
+
+    return progress['rows'], errors
+
+
+def run_backfill(cur, conn, backfill, rollups=False):
+    """
+    This function resolves the songplays left unresolved by earlier runs whose song was loaded by this run,
+    then prints how many were resolved.
+
+    Parameters
+    ----------
+    cur         : Cursor object
+                    Cursor connected to postgreSQL session
+    conn        : Connection object
+                    Session connection to postgreSQL database
+    backfill    : SongBackfill
+                    Songs loaded by this run
+    rollups     : boolean
+                    If set, the resolved songplays are added to the rollup tables
+    """
+    if not backfill.song_ids:
+        return
+
+    start = time.perf_counter()
+    resolved = backfill.run(cur, conn, rollups)
+    print('{} unresolved songplays resolved against {} new songs in {:.2f}s.'.format(
+        resolved, len(backfill.song_ids), time.perf_counter() - start))
+
+
+def main(mode='row', batch_size=500, lookup='index', tolerance=0.01, workers=0, writers=1, queue_size=64,
+         incremental=True, song_batch_size=5000, dedup=True, metrics_jsonl=None, metrics_prom=None, profile_slowest=0,
+         profile_dir='profiles', chunk_size=None, reset=False, deferred=False, finalize=True,
+         rollups=True):
     """
     This is the main function that processes song and log data
     by performing ETL pipeline
+
+    Parameters
+    ----------
+    mode        : string
+                    `row` to insert records one by one, `bulk` to COPY batches of files
+                    into staging tables and merge them with set-based inserts
+    batch_size  : integer
+                    Number of log files per batch in `bulk` mode
+    lookup      : string
+                    `index` to resolve songs against an in-memory song lookup index,
+                    `query` to run `song_select` in the database
+    tolerance   : float
+                    Duration rounding step in seconds of the song lookup index
+    workers     : integer
+                    If set, files are read by this many processes and loaded by `writers` connections
+    writers     : integer
+                    Number of writer connections when `workers` is set
+    queue_size  : integer
+                    Maximum number of files read but not yet loaded when `workers` is set
+    incremental : boolean
+                    If set, only files that are new or changed since they were loaded are processed
+    song_batch_size : integer
+                    Number of song files decoded and loaded at once when `workers` is not set
+    dedup       : boolean
+                    If set, time and user records are collapsed across the run before they are written
+    metrics_jsonl : string
+                    If set, per-file and run measurements are appended to this JSON lines file
+    metrics_prom : string
+                    If set, run measurements are written to this Prometheus text file
+    profile_slowest : integer
+                    If set, cProfile and tracemalloc profiles of this many slowest files are written to `profile_dir`
+    profile_dir : string
+                    Directory to write the profiles to
+    chunk_size  : integer
+                    If set, log files are read, transformed and loaded this many lines at a time.
+                    Not with `workers`, whose readers hand the data of whole files over to the writers
+    reset       : boolean
+                    If set, all tables are emptied with TRUNCATE before loading
+    deferred    : boolean
+                    If set, tables are switched to the load phase before loading
+    finalize    : boolean
+                    If set and tables are in the load phase, they are finalized after loading
+    rollups     : boolean
+                    If set, the rollup tables are updated with the songplays of every transaction.
+                    Otherwise, or in the load phase, they are marked stale until they are rebuilt
     """
-    
+
     # connect to the database and get the connection and cursor objects
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
-    cur = conn.cursor()
-    
-    # process data files
-    print('Processing song data')
-    print('====================')
-    process_data(cur, conn, filepath='data/song_data', func=process_song_file)
-    print('\nProcessing log data')
-    print('===================')
-    process_data(cur, conn, filepath='data/log_data', func=process_log_file)
+    conn = psycopg2.connect(DSN)
+    cur = conn.cursor(cursor_factory=CountingCursor)
+
+    # surrogate keys of songs and artists if the tables were created with them, resolved through cached mappings
+    keys = SurrogateKeys.detect(cur)
+    if keys is not None and deferred:
+        raise ValueError('tables with surrogate keys cannot be loaded in the load phase, run without --deferred')
+
+    # partitions of songplays table if it was created partitioned, a partitioned table cannot be UNLOGGED
+    # nor get a primary key without its partition column when finalized
+    partitions = SongplayPartitions.detect(cur, DSN)
+    conn.commit()
+    if partitions is not None and deferred:
+        raise ValueError('a partitioned songplays table cannot be loaded in the load phase, run without --deferred')
+
+    # readers hand the data of whole files over to the writers, which would not keep memory bound by chunks
+    if chunk_size and workers:
+        raise ValueError('log files cannot be read in chunks by parallel readers, run without --workers')
+
+    # bulk-load lifecycle: tables in the load phase are appended to then finalized
+    if reset:
+        reset_tables(cur, conn)
+    if deferred and not is_load_phase(cur):
+        start_load_phase(cur, conn)
+    append = is_load_phase(cur)
+    conn.commit()
+
+    # rollups are rebuilt when tables are finalized, songplays appended in the load phase are not counted
+    rollups = rollups and not append
+    if not rollups:
+        mark_rollups_stale(cur, conn)
+
+    # run measurements of every file or batch of files
+    metrics = Metrics(metrics_jsonl, metrics_prom, profile_slowest, profile_dir)
+
+    # song lookup index built from already loaded songs then filled while processing song data
+    index = SongLookupIndex.from_database(cur, tolerance) if lookup == 'index' else None
+
+    # songs of the run, matched against the songplays left unresolved by earlier runs once song data is processed
+    backfill = SongBackfill(tolerance)
+
+    # run-level builders writing each time and user key once
+    dimensions = Dimensions() if dedup else None
+
+    if workers:
+        if mode == 'bulk':
+            song_load, log_load = bulk_load_song_data, bulk_load_log_data
+        else:
+            song_load, log_load = load_song_data, load_log_data
+        song_load = partial(song_load, append=append, backfill=backfill)
+        log_load = partial(log_load, append=append, rollups=rollups, keys=keys)
+
+        print('Processing song data')
+        print('====================')
+        process_data_parallel('data/song_data', read_song_file, partial(song_load, index=index),
+                              workers, writers, queue_size, bulk=mode == 'bulk', incremental=incremental,
+                              metrics=metrics)
+        if keys is not None:
+            keys.load(cur)
+            conn.commit()
+        run_backfill(cur, conn, backfill, rollups)
+        print('\nProcessing log data')
+        print('===================')
+        process_data_parallel('data/log_data', read_log_file, partial(log_load, index=index, partitions=partitions),
+                              workers, writers, queue_size, bulk=mode == 'bulk', incremental=incremental,
+                              dimensions=dimensions, metrics=metrics)
+    else:
+        if mode == 'bulk':
+            create_staging_tables(cur)
+            song_func, log_func = bulk_process_song_files, bulk_process_log_files
+        else:
+            song_func, log_func, batch_size = process_song_files, process_log_file, None
+
+        song_func = partial(song_func, index=index, append=append, backfill=backfill)
+        log_func = partial(log_func, index=index, dimensions=dimensions, partitions=partitions, chunk_size=chunk_size,
+                           append=append, rollups=rollups, keys=keys)
+
+        # process data files
+        print('Processing song data')
+        print('====================')
+        process_data(cur, conn, filepath='data/song_data', func=song_func, batch_size=song_batch_size,
+                     incremental=incremental, metrics=metrics)
+        if keys is not None:
+            keys.load(cur)
+            conn.commit()
+        run_backfill(cur, conn, backfill, rollups)
+        print('\nProcessing log data')
+        print('===================')
+        process_data(cur, conn, filepath='data/log_data', func=log_func, batch_size=batch_size,
+                     incremental=incremental, metrics=metrics)
+
+    # indexes of a partitioned songplays table are deferred until after the load
+    if partitions is not None:
+        create_indexes(cur, conn)
+
+    if append and finalize:
+        print('\nFinalizing tables')
+        start = time.perf_counter()
+        finalize_tables(cur, conn)
+        print('Tables finalized in {:.2f}s.'.format(time.perf_counter() - start))
+
+    if index is not None:
+        print('\nSong lookup: {} hits, {} misses ({:.1%} match rate).'.format(index.hits, index.misses, index.match_rate()))
+    if dimensions is not None:
+        print('Dimensions: {}'.format(dimensions.summary()))
+    if keys is not None:
+        print('Surrogate keys: {}'.format(keys.summary()))
+    for line in metrics.summary():
+        print(line)
+    metrics.close()
 
     # close connection
     conn.close()
 
 
+def parse_args():
+    """
+    Parses the command line arguments of the ETL pipeline.
+    """
+    parser = argparse.ArgumentParser(description='Load song and log data into sparkifydb.')
+    parser.add_argument('--mode', choices=['row', 'bulk'], default='row',
+                        help='row: insert records one by one, bulk: COPY into staging tables then merge')
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='number of files loaded per COPY batch in bulk mode')
+    parser.add_argument('--song-batch-size', type=int, default=5000,
+                        help='number of song files decoded and loaded at once')
+    parser.add_argument('--lookup', choices=['index', 'query'], default='index',
+                        help='index: resolve songs against an in-memory lookup index, query: run song_select per record')
+    parser.add_argument('--duration-tolerance', type=float, default=0.01,
+                        help='duration rounding step in seconds of the song lookup index')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='number of processes reading files in parallel, 0 to process files serially')
+    parser.add_argument('--writers', type=int, default=1,
+                        help='number of database connections loading files read in parallel')
+    parser.add_argument('--queue-size', type=int, default=64,
+                        help='maximum number of files read in parallel but not yet loaded')
+    parser.add_argument('--no-dedup', action='store_true',
+                        help='write time and user records of every event instead of once per run')
+    parser.add_argument('--full-reload', action='store_true',
+                        help='process every file, including files already loaded and unchanged')
+    parser.add_argument('--chunk-size', type=int, default=0, metavar='LINES',
+                        help='read, transform and load log files this many lines at a time, 0 for whole files, '
+                             'not with --workers')
+    parser.add_argument('--reset', action='store_true',
+                        help='empty all tables with TRUNCATE before loading')
+    parser.add_argument('--deferred', action='store_true',
+                        help='load UNLOGGED tables without constraints nor indexes then finalize them')
+    parser.add_argument('--no-finalize', action='store_true',
+                        help='leave tables in the load phase after loading, to finalize them after a later run')
+    parser.add_argument('--no-rollups', action='store_true',
+                        help='do not update the rollup tables, they are marked stale until rebuilt')
+    parser.add_argument('--metrics-jsonl', metavar='PATH',
+                        help='append per-file and run measurements to this JSON lines file')
+    parser.add_argument('--metrics-prom', metavar='PATH',
+                        help='write run measurements to this Prometheus text file for the node exporter')
+    parser.add_argument('--profile-slowest', type=int, default=0, metavar='N',
+                        help='write cProfile and tracemalloc profiles of the N slowest files')
+    parser.add_argument('--profile-dir', default='profiles',
+                        help='directory to write the profiles to')
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    args = parse_args()
+    main(mode=args.mode, batch_size=args.batch_size, lookup=args.lookup, tolerance=args.duration_tolerance,
+         workers=args.workers, writers=args.writers, queue_size=args.queue_size, incremental=not args.full_reload,
+         song_batch_size=args.song_batch_size, dedup=not args.no_dedup, metrics_jsonl=args.metrics_jsonl,
+         metrics_prom=args.metrics_prom, profile_slowest=args.profile_slowest, profile_dir=args.profile_dir,
+         chunk_size=args.chunk_size, reset=args.reset, deferred=args.deferred, finalize=not args.no_finalize,
+         rollups=not args.no_rollups)
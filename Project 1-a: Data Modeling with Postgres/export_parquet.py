@@ -0,0 +1,303 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import itertools
+from collections import namedtuple
+from urllib.parse import quote
+import psycopg2
+import pyarrow as pa
+import pyarrow.parquet as pq
+from etl import DSN
+from sql_queries import songplay_export_lock, songplay_export_max_select, songplay_export_select, \
+    songplay_export_select_surrogate, time_export_select, user_export_select, song_export_select, artist_export_select
+from surrogate_keys import has_surrogate_keys
+from create_tables import is_load_phase
+from instrumentation import max_rss
+
+
+# high-water mark of the data lake, written once all tables are exported
+STATE_FILE = '_sparkify_export.json'
+
+# directory name of a NULL partition value, as written by Spark
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+# a table of the data lake: the query selecting its rows in partition order, the schema of its files,
+# the partition columns selected after the file columns, and whether it is appended to from the high-water mark
+ExportTable = namedtuple("ExportTable", ["name", "query", "schema", "partition_by", "incremental"])
+
+EXPORT_TABLES = [
+    ExportTable('songplays', songplay_export_select, pa.schema([
+        ('songplay_id', pa.int32()), ('start_time', pa.timestamp('us')), ('user_id', pa.int32()),
+        ('level', pa.string()), ('song_id', pa.string()), ('artist_id', pa.string()), ('session_id', pa.int32()),
+        ('location', pa.string()), ('user_agent', pa.string()),
+    ]), ['year', 'month'], True),
+    ExportTable('time', time_export_select, pa.schema([
+        ('start_time', pa.timestamp('us')), ('hour', pa.int32()), ('day', pa.int32()), ('week', pa.int32()),
+        ('weekday', pa.int32()),
+    ]), ['year', 'month'], True),
+    ExportTable('users', user_export_select, pa.schema([
+        ('user_id', pa.int32()), ('first_name', pa.string()), ('last_name', pa.string()), ('gender', pa.string()),
+        ('level', pa.string()),
+    ]), [], False),
+    ExportTable('songs', song_export_select, pa.schema([
+        ('song_id', pa.string()), ('title', pa.string()), ('duration', pa.float64()),
+    ]), ['year', 'artist_id'], False),
+    ExportTable('artists', artist_export_select, pa.schema([
+        ('artist_id', pa.string()), ('artist_name', pa.string()), ('artist_location', pa.string()),
+        ('artist_latitude', pa.float64()), ('artist_longitude', pa.float64()),
+    ]), [], False),
+]
+
+
+def partition_path(partition_by, values):
+    """
+    This function returns the relative directory of a partition, as `year=2018/month=11`.
+    """
+    return os.path.join(*['{}={}'.format(column, NULL_PARTITION if value is None else quote(str(value), safe=''))
+                          for column, value in zip(partition_by, values)]) if partition_by else ''
+
+
+class PartitionWriter:
+    """
+    Writes rows received in partition order to one Parquet file per partition, keeping a single file open.
+
+    A file is written under a hidden name then renamed once complete, so that readers never see a partial file.
+
+    Parameters
+    ----------
+    root        : string
+                    Directory of the table
+    schema      : Schema
+                    pyarrow schema of the files
+    partition_by : list
+                    Partition columns, following the file columns in every row
+    basename    : string
+                    File name in every partition
+
+    Attributes
+    ----------
+    rows        : integer
+                    Number of rows written
+    files       : integer
+                    Number of files written
+    """
+
+    def __init__(self, root, schema, partition_by, basename):
+        self.root = root
+        self.schema = schema
+        self.partition_by = partition_by
+        self.basename = basename
+        self.rows = 0
+        self.files = 0
+        self._writer = None
+        self._partition = None
+        self._path = None
+
+    def write(self, rows):
+        """
+        Writes a chunk of rows, each partition of the chunk as a row group.
+        """
+        width = len(self.schema)
+        for partition, group in itertools.groupby(rows, key=lambda row: row[width:]):
+            if self._writer is None or partition != self._partition:
+                self._open(partition)
+            columns = list(zip(*group))
+            table = pa.Table.from_arrays([pa.array(column, type=field.type)
+                                          for column, field in zip(columns, self.schema)], schema=self.schema)
+            self._writer.write_table(table)
+            self.rows += table.num_rows
+
+    def close(self):
+        """
+        Completes the open file.
+        """
+        if self._writer is not None:
+            self._writer.close()
+            os.replace(self._tmp_path(), self._path)
+            self._writer = None
+            self.files += 1
+
+    def _open(self, partition):
+        self.close()
+        directory = os.path.join(self.root, partition_path(self.partition_by, partition))
+        os.makedirs(directory, exist_ok=True)
+        self._partition = partition
+        self._path = os.path.join(directory, self.basename)
+        self._writer = pq.ParquetWriter(self._tmp_path(), self.schema)
+
+    def _tmp_path(self):
+        return os.path.join(os.path.dirname(self._path), '.{}.tmp'.format(self.basename))
+
+
+def export_table(conn, table, query, root, basename, params, fetch_size):
+    """
+    This function streams the rows of a query through a server-side cursor into the Parquet files of a table.
+
+    Parameters
+    ----------
+    conn        : Connection object
+                    Session connection to postgreSQL database, in the transaction of the export
+    table       : ExportTable
+                    Table to export
+    query       : string
+                    Query selecting the rows of the table
+    root        : string
+                    Directory to write the table to
+    basename    : string
+                    File name in every partition
+    params      : dictionary
+                    Query parameters
+    fetch_size  : integer
+                    Number of rows fetched and held in memory at once
+
+    Returns
+    -------
+    PartitionWriter holding the number of rows and files written
+    """
+    writer = PartitionWriter(root, table.schema, table.partition_by, basename)
+    with conn.cursor(name='export_{}'.format(table.name)) as cur:
+        cur.itersize = fetch_size
+        cur.execute(query, params)
+        while True:
+            rows = cur.fetchmany(fetch_size)
+            if not rows:
+                break
+            writer.write(rows)
+    writer.close()
+    return writer
+
+
+def replace_directory(tmp_path, path):
+    """
+    This function replaces a table directory with a newly written one.
+    """
+    old_path = os.path.join(os.path.dirname(path), '.{}.old'.format(os.path.basename(path)))
+    if os.path.exists(path):
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def read_state(output):
+    """
+    This function returns the high-water mark of a data lake, None if nothing was exported yet.
+    """
+    path = os.path.join(output, STATE_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_state(output, state):
+    """
+    This function writes the high-water mark of a data lake atomically.
+    """
+    path = os.path.join(output, STATE_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def export(conn, output, fetch_size=50000, full=False):
+    """
+    This function exports the star schema to a data lake directory from a single snapshot of the database.
+
+    songplays inserted since the last export and their time are appended as new files, one per partition,
+    named after the high-water mark, so that an export interrupted before its high-water mark is written
+    is overwritten by the next one. users, songs and artists are replaced, as are all tables on the first
+    export or if `full` is set.
+
+    The high-water mark is the last `songplay_id` read under a SHARE lock on songplays, which waits for
+    the inserts in flight to commit or roll back, so that concurrent writers committing ids out of order
+    (`etl.py --writers`, `ingest.py`) cannot commit a songplay below it after it was exported.
+
+    Parameters
+    ----------
+    conn        : Connection object
+                    Session connection to postgreSQL database
+    output      : string
+                    Data lake directory
+    fetch_size  : integer
+                    Number of rows fetched and held in memory at once
+    full        : boolean
+                    If set, all tables are replaced, for instance to export songplays resolved by the backfill
+
+    Returns
+    -------
+    Dictionary of (rows, files) by table name
+    """
+    # the high-water mark is read in its own short transaction, holding off writers only until it is read,
+    # so that songplay ids committed out of order by concurrent writers are all below it and in the snapshot
+    conn.set_session(isolation_level='READ COMMITTED', readonly=False)
+    cur = conn.cursor()
+    cur.execute(songplay_export_lock)
+    cur.execute(songplay_export_max_select)
+    high = cur.fetchone()[0]
+    conn.commit()
+
+    conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    if is_load_phase(cur):
+        raise ValueError('tables are in the load phase, finalize them before exporting')
+
+    state = None if full else read_state(output)
+    if state is not None and not all(os.path.isdir(os.path.join(output, table.name))
+                                     for table in EXPORT_TABLES if table.incremental):
+        state = None
+
+    params = {'low': state['songplay_id'] if state else 0, 'high': high}
+    surrogate = has_surrogate_keys(cur)
+
+    os.makedirs(output, exist_ok=True)
+    exported = {}
+    for table in EXPORT_TABLES:
+        start = time.perf_counter()
+        query = songplay_export_select_surrogate if table.name == 'songplays' and surrogate else table.query
+        path = os.path.join(output, table.name)
+
+        if table.incremental and state is not None:
+            writer = export_table(conn, table, query, path, 'part-{:010d}.parquet'.format(params['low']), params,
+                                  fetch_size)
+        else:
+            tmp_path = os.path.join(output, '.{}.tmp'.format(table.name))
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            writer = export_table(conn, table, query, tmp_path, 'part-{:010d}.parquet'.format(0),
+                                  params, fetch_size)
+            replace_directory(tmp_path, path)
+
+        exported[table.name] = (writer.rows, writer.files)
+        print('{}: {} rows in {} files ({}) in {:.2f}s.'.format(
+            table.name, writer.rows, writer.files,
+            'appended' if table.incremental and state is not None else 'replaced', time.perf_counter() - start))
+
+    conn.commit()
+    write_state(output, {'songplay_id': params['high'], 'exported_at': time.strftime('%Y-%m-%dT%H:%M:%S')})
+    return exported
+
+
+def main():
+    """
+    Exports songplays, users, songs, artists and time to Parquet files partitioned like the data lake
+    of Project 4, then prints the high-water mark and the peak memory.
+    """
+    parser = argparse.ArgumentParser(description='Export the sparkifydb star schema to partitioned Parquet files.')
+    parser.add_argument('--output', default='lake', help='data lake directory')
+    parser.add_argument('--fetch-size', type=int, default=50000,
+                        help='number of rows fetched from the server-side cursors and held in memory at once')
+    parser.add_argument('--full', action='store_true', help='replace all tables instead of appending new songplays')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(DSN)
+    start = time.perf_counter()
+    export(conn, args.output, args.fetch_size, args.full)
+    conn.close()
+
+    state = read_state(args.output)
+    print('Exported up to songplay_id {} in {:.2f}s, peak memory {:.1f} MB.'.format(
+        state['songplay_id'], time.perf_counter() - start, max_rss() / 2 ** 20))
+
+
+if __name__ == "__main__":
+    main()
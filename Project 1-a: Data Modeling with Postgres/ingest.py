@@ -0,0 +1,395 @@
+import os
+import time
+import signal
+import argparse
+import threading
+import collections
+import psycopg2
+from etl import DSN, get_files, load_files, process_log_files, bulk_process_log_files, create_staging_tables
+from song_lookup import SongLookupIndex
+from dimensions import Dimensions
+from partitions import SongplayPartitions
+from surrogate_keys import SurrogateKeys
+from create_tables import create_indexes, is_load_phase
+from manifest import select_new_files
+from rollups import mark_rollups_stale
+from instrumentation import CountingCursor, Metrics
+
+
+# a file waiting to be loaded, with the wall time it arrived at
+PendingFile = collections.namedtuple("PendingFile", ["entry", "arrived"])
+
+
+class LogWatcher:
+    """
+    Polls a data directory for files that are new or changed since they were loaded.
+
+    A file is only handed out once it has not been modified for `settle` seconds, so that files still
+    being written are not loaded partially, and only once per size and modification time. Files are
+    forgotten once loaded, or found loaded and unchanged by etl_manifest table, which skips them on later
+    polls, so that only the files waiting to settle or to be loaded are remembered.
+
+    Attributes
+    ----------
+    filepath    : string
+                    Path to the watched data directory
+    settle      : float
+                    Seconds a file must stay unmodified before it is loaded
+    """
+
+    def __init__(self, filepath, settle=1.0):
+        self.filepath = filepath
+        self.settle = settle
+        # (size, modification time), time first seen and whether handed out, of the files not loaded yet
+        self._seen = {}
+        self._started = time.time()
+
+    def poll(self, cur, conn):
+        """
+        Returns the files arrived since the last poll as PendingFile.
+
+        A file modified since the watcher started arrived at its modification time, otherwise (files found
+        at start or copied with their modification time) it arrived when it was first seen, even if it was
+        handed out by a later poll once settled.
+
+        Parameters
+        ----------
+        cur         : Cursor object
+                        Cursor connected to postgreSQL session
+        conn        : Connection object
+                        Session connection to postgreSQL database
+        """
+        now = time.time()
+        listed = set()
+        candidates = {}
+        for filepath in get_files(self.filepath):
+            try:
+                stat = os.stat(filepath)
+            except FileNotFoundError:
+                continue
+            listed.add(filepath)
+            state = (stat.st_size, stat.st_mtime)
+            seen = self._seen.get(filepath)
+            if seen is None or seen[0] != state:
+                seen = self._seen[filepath] = (state, now, False)
+            if seen[2] or now - stat.st_mtime < self.settle:
+                continue
+            candidates[filepath] = seen
+
+        # files removed before they were handed out
+        removed = [filepath for filepath, seen in self._seen.items() if filepath not in listed and not seen[2]]
+        for filepath in removed:
+            del self._seen[filepath]
+
+        pending = []
+        if candidates:
+            # files already loaded and unchanged according to etl_manifest table are skipped
+            new_files = select_new_files(cur, sorted(candidates))
+            conn.commit()
+            for entry in new_files:
+                state, first_seen, handed = candidates.pop(entry.path)
+                arrived = entry.mtime if self._started < entry.mtime <= now else first_seen
+                pending.append(PendingFile(entry, arrived))
+                self._seen[entry.path] = (state, first_seen, True)
+            for filepath in candidates:
+                del self._seen[filepath]
+
+        return pending
+
+    def forget(self, filepaths):
+        """
+        Forgets loaded files, etl_manifest table skips them on later polls unless they change.
+        """
+        for filepath in filepaths:
+            self._seen.pop(filepath, None)
+
+
+class MicroBatcher:
+    """
+    Files waiting to be loaded, taken as a micro-batch once enough files or bytes are waiting
+    or once the oldest file has waited `max_wait` seconds.
+
+    Attributes
+    ----------
+    max_files   : integer
+                    Maximum number of files of a micro-batch
+    max_bytes   : integer
+                    Size of the waiting files from which a micro-batch is taken without waiting
+    max_wait    : float
+                    Maximum number of seconds a file waits before its micro-batch is taken
+    """
+
+    def __init__(self, max_files=50, max_bytes=64 << 20, max_wait=5.0):
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.max_wait = max_wait
+        self._pending = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, files):
+        """
+        Adds PendingFile to the waiting files, a changed file replaces its earlier version.
+        """
+        for pending in files:
+            arrived = self._pending[pending.entry.path].arrived if pending.entry.path in self._pending \
+                else pending.arrived
+            self._pending[pending.entry.path] = PendingFile(pending.entry, arrived)
+
+    def waiting_bytes(self):
+        return sum(pending.entry.size for pending in self._pending.values())
+
+    def due(self, now):
+        """
+        Returns whether a micro-batch should be taken now.
+        """
+        if not self._pending:
+            return False
+        oldest = min(pending.arrived for pending in self._pending.values())
+        return len(self._pending) >= self.max_files or self.waiting_bytes() >= self.max_bytes \
+            or now - oldest >= self.max_wait
+
+    def take(self):
+        """
+        Removes and returns the next micro-batch, in arrival order, of up to `max_files` files and about `max_bytes`.
+        """
+        batch, size = [], 0
+        for pending in sorted(self._pending.values(), key=lambda pending: (pending.arrived, pending.entry.path)):
+            if batch and (len(batch) >= self.max_files or size + pending.entry.size > self.max_bytes):
+                break
+            batch.append(pending)
+            size += pending.entry.size
+        for pending in batch:
+            del self._pending[pending.entry.path]
+        return batch
+
+
+class Ingest:
+    """
+    Loads the log files arriving in a data directory in micro-batches, each in one transaction recording
+    its files in etl_manifest table, and measures the lag from file arrival to rows committed.
+
+    Parameters
+    ----------
+    conn        : Connection object
+                    Session connection to postgreSQL database
+    cur         : Cursor object
+                    Cursor connected to postgreSQL session
+    func        : function
+                    A callback function loading a batch of log files, returning the number of rows written from each
+    watcher     : LogWatcher
+                    Watcher of the log data directory
+    batcher     : MicroBatcher
+                    Thresholds of the micro-batches
+    metrics     : Metrics
+                    Measurements of every micro-batch
+    poll_interval : float
+                    Seconds between two polls of the data directory
+
+    Attributes
+    ----------
+    files       : integer
+                    Number of files loaded
+    rows        : integer
+                    Number of rows written
+    failed      : integer
+                    Number of files that failed to load
+    lags        : deque
+                    Seconds from arrival to commit of the latest loaded files
+    """
+
+    def __init__(self, conn, cur, func, watcher, batcher, metrics, poll_interval=1.0):
+        self.conn = conn
+        self.cur = cur
+        self.func = func
+        self.watcher = watcher
+        self.batcher = batcher
+        self.metrics = metrics
+        self.poll_interval = poll_interval
+        self.files = 0
+        self.rows = 0
+        self.failed = 0
+        self.lags = collections.deque(maxlen=10000)
+        self._stop = threading.Event()
+
+    def stop(self):
+        """
+        Asks the loop to stop once the current micro-batch is committed.
+        """
+        self._stop.set()
+
+    def run(self, once=False):
+        """
+        Polls the data directory and loads micro-batches until stopped, or until the files found
+        by the first poll are loaded if `once` is set.
+        """
+        while not self._stop.is_set():
+            self.batcher.add(self.watcher.poll(self.cur, self.conn))
+
+            # load every due micro-batch, files still waiting are left to the next start when stopped
+            while not self._stop.is_set() and (self.batcher.due(time.time()) or (once and len(self.batcher))):
+                self.load(self.batcher.take())
+
+            if once:
+                break
+            self._stop.wait(self.poll_interval)
+
+    def load(self, batch, attempts=3):
+        """
+        Loads a micro-batch in one transaction, retrying it when it is rolled back by a deadlock
+        with another writer. If it fails otherwise, its files are loaded one by one so that a bad file
+        does not hold back the others.
+        """
+        entries = [pending.entry for pending in batch]
+        try:
+            row_counts = load_files(self.cur, self.conn, entries, self.func, 'log_data', self.metrics)
+        except psycopg2.errors.TransactionRollbackError:
+            self.conn.rollback()
+            if attempts == 1:
+                raise
+            self.load(batch, attempts - 1)
+            return
+        except psycopg2.OperationalError:
+            # the connection is lost, nothing of the batch is committed nor recorded
+            raise
+        except Exception as error:
+            self.conn.rollback()
+            if len(batch) > 1:
+                for pending in batch:
+                    self.load([pending])
+            else:
+                self.failed += 1
+                print('Failed to load {}: {}'.format(entries[0].path, error))
+            return
+
+        committed = time.time()
+        self.watcher.forget(entry.path for entry in entries)
+        lags = [committed - pending.arrived for pending in batch]
+        self.lags.extend(lags)
+        self.files += len(batch)
+        self.rows += sum(row_counts)
+
+        print('{} files, {} rows committed, lag {:.2f}s avg {:.2f}s max, {} files waiting.'.format(
+            len(batch), sum(row_counts), sum(lags) / len(lags), max(lags), len(self.batcher)))
+        self.report()
+
+    def lag_quantiles(self, quantiles=(0.5, 0.95, 0.99)):
+        """
+        Returns the lag in seconds of the latest loaded files at each quantile.
+        """
+        lags = sorted(self.lags)
+        if not lags:
+            return {}
+        return {q: lags[min(len(lags) - 1, int(q * len(lags)))] for q in quantiles}
+
+    def report(self):
+        """
+        Writes the lag quantiles and the number of waiting files to the Prometheus text file, if set.
+        """
+        self.metrics.gauges['sparkify_ingest_lag_seconds'] = (
+            'Seconds from log file arrival to rows committed, over the latest loaded files.',
+            [({'quantile': str(q)}, lag) for q, lag in self.lag_quantiles().items()])
+        self.metrics.gauges['sparkify_ingest_files_waiting'] = (
+            'Log files arrived but not loaded yet.', [({}, len(self.batcher))])
+        self.metrics.write_prometheus()
+
+    def summary(self):
+        """
+        Returns the files and rows loaded and the lag quantiles as a printable line.
+        """
+        quantiles = ', '.join('p{:g} {:.2f}s'.format(q * 100, lag) for q, lag in self.lag_quantiles().items())
+        return '{} files loaded, {} rows written, {} failed. Lag: {}.'.format(
+            self.files, self.rows, self.failed, quantiles or 'no files loaded')
+
+
+def main():
+    """
+    Watches the log data directory and loads new log files in micro-batches until SIGINT or SIGTERM.
+
+    The first signal stops the daemon once the current micro-batch is committed, a second one interrupts it:
+    the micro-batch is then rolled back with its etl_manifest records and loaded again at the next start.
+    """
+    parser = argparse.ArgumentParser(description='Load log files into sparkifydb as they arrive.')
+    parser.add_argument('--log-data', default='data/log_data', help='log data directory to watch')
+    parser.add_argument('--mode', choices=['row', 'bulk'], default='row',
+                        help='row: insert records one by one, bulk: COPY micro-batches into staging tables then merge')
+    parser.add_argument('--poll-interval', type=float, default=1.0, help='seconds between two polls')
+    parser.add_argument('--settle', type=float, default=1.0,
+                        help='seconds a file must stay unmodified before it is loaded')
+    parser.add_argument('--max-files', type=int, default=50, help='maximum number of files of a micro-batch')
+    parser.add_argument('--max-bytes', type=int, default=64 << 20,
+                        help='size of the waiting files from which a micro-batch is loaded without waiting')
+    parser.add_argument('--max-wait', type=float, default=5.0,
+                        help='maximum number of seconds a file waits for its micro-batch')
+    parser.add_argument('--duration-tolerance', type=float, default=0.01,
+                        help='duration rounding step in seconds of the song lookup index')
+    parser.add_argument('--chunk-size', type=int, default=0, metavar='LINES',
+                        help='read, transform and load log files this many lines at a time, 0 for whole files')
+    parser.add_argument('--no-rollups', action='store_true',
+                        help='do not update the rollup tables, they are marked stale until rebuilt')
+    parser.add_argument('--once', action='store_true', help='load the files found by the first poll then exit')
+    parser.add_argument('--metrics-jsonl', metavar='PATH', help='append per-batch measurements to this JSON lines file')
+    parser.add_argument('--metrics-prom', metavar='PATH',
+                        help='write measurements and lag to this Prometheus text file for the node exporter')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(DSN)
+    cur = conn.cursor(cursor_factory=CountingCursor)
+
+    # appending without conflict handling could load a changed file twice
+    if is_load_phase(cur):
+        raise ValueError('tables are in the load phase, finalize them before ingesting')
+
+    rollups = not args.no_rollups
+    if not rollups:
+        mark_rollups_stale(cur, conn)
+
+    # songs loaded while ingesting are not in the index, their songplays are resolved by the backfill
+    index = SongLookupIndex.from_database(cur, args.duration_tolerance)
+    keys = SurrogateKeys.detect(cur)
+    if keys is not None:
+        keys.load(cur)
+    partitions = SongplayPartitions.detect(cur, DSN)
+    if partitions is not None:
+        # indexes of the parent table are created on every new partition
+        create_indexes(cur, conn)
+    conn.commit()
+
+    if args.mode == 'bulk':
+        create_staging_tables(cur)
+        load_func = bulk_process_log_files
+    else:
+        load_func = process_log_files
+
+    def func(cur, filepaths):
+        # micro-batch level builders, memory stays bound however long the daemon runs
+        return load_func(cur, filepaths, index=index, dimensions=Dimensions(), partitions=partitions,
+                         chunk_size=args.chunk_size, rollups=rollups, keys=keys)
+
+    metrics = Metrics(args.metrics_jsonl, args.metrics_prom)
+    ingest = Ingest(conn, cur, func, LogWatcher(args.log_data, args.settle),
+                    MicroBatcher(args.max_files, args.max_bytes, args.max_wait), metrics, args.poll_interval)
+
+    def shutdown(signum, frame):
+        print('Stopping after the current micro-batch, signal again to interrupt.')
+        ingest.stop()
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    print('Watching {}'.format(args.log_data))
+    try:
+        ingest.run(once=args.once)
+    finally:
+        print(ingest.summary())
+        for line in metrics.summary():
+            print(line)
+        metrics.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,377 @@
+import os
+import sys
+import json
+import time
+import heapq
+import cProfile
+import resource
+import threading
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+import psycopg2.extensions
+
+
+# measurements of the processing unit running on the current thread
+_local = threading.local()
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """
+    Cursor counting the statements it sends to the server, one round trip each.
+
+    Attributes
+    ----------
+    round_trips : integer
+                    Number of statements sent so far
+    """
+
+    round_trips = 0
+
+    def execute(self, query, vars=None):
+        self.round_trips += 1
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        self.round_trips += len(vars_list)
+        return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        self.round_trips += 1
+        return super().copy_expert(sql, file, size)
+
+
+class Unit:
+    """
+    Measurements of one call of a processing function, on a file or a batch of files.
+
+    Attributes
+    ----------
+    phase       : string
+                    Data directory being processed, song_data or log_data
+    paths       : list
+                    Paths of the processed files
+    bytes       : integer
+                    Size of the processed files
+    stages      : Counter
+                    Seconds spent in each stage: read, transform, resolve, collapse, write_<table> and commit
+    rows        : Counter
+                    Rows written to each table
+    round_trips : integer
+                    Statements sent to the server
+    seconds     : float
+                    Wall time of the call
+    peak_memory : integer
+                    Peak traced memory in bytes while profiling, None otherwise
+    error       : boolean
+                    Whether the call raised
+    """
+
+    def __init__(self, phase, paths, nbytes=0):
+        self.phase = phase
+        self.paths = paths
+        self.bytes = nbytes
+        self.stages = Counter()
+        self.rows = Counter()
+        self.round_trips = 0
+        self.seconds = 0.0
+        self.peak_memory = None
+        self.error = False
+
+    def to_dict(self):
+        return {
+            "event": "unit",
+            "phase": self.phase,
+            "path": self.paths[0] if len(self.paths) == 1 else None,
+            "files": len(self.paths),
+            "bytes": self.bytes,
+            "seconds": round(self.seconds, 6),
+            "stages": {name: round(seconds, 6) for name, seconds in sorted(self.stages.items())},
+            "rows": dict(sorted(self.rows.items())),
+            "round_trips": self.round_trips,
+            "max_rss": max_rss(),
+            "peak_memory": self.peak_memory,
+            "error": self.error,
+        }
+
+
+@contextmanager
+def stage(name):
+    """
+    Times a stage of the processing unit running on the current thread, if any.
+    """
+    unit = getattr(_local, 'unit', None)
+    if unit is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        unit.stages[name] += time.perf_counter() - start
+
+
+def count_rows(table, num_rows):
+    """
+    Counts rows written to a table by the processing unit running on the current thread, if any.
+    """
+    unit = getattr(_local, 'unit', None)
+    if unit is not None:
+        unit.rows[table] += num_rows
+
+
+def timed_read(read_func, filepath):
+    """
+    This function calls a read function, typically in a reader process, and returns the data frames
+    it read along with the seconds spent in each of its stages.
+
+    Parameters
+    ----------
+    read_func   : function
+                    A function reading and transforming a data file into a tuple of data frames
+    filepath    : string
+                    Path to data file
+
+    Returns
+    -------
+    (tuple of data frames, dictionary of seconds by stage)
+    """
+    unit = _local.unit = Unit(None, [filepath])
+    try:
+        frames = read_func(filepath)
+    finally:
+        _local.unit = None
+    return frames, dict(unit.stages)
+
+
+def max_rss():
+    """
+    Returns the peak resident memory of this process and its finished children in bytes.
+    """
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return scale * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                       resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+class Metrics:
+    """
+    Collects the measurements of every processing unit of a run and reports them as JSON lines,
+    a Prometheus text file and profiles of the slowest units.
+
+    Parameters
+    ----------
+    jsonl_path  : string
+                    If set, one JSON record per processing unit and one per run are appended to this file
+    prom_path   : string
+                    If set, run totals are written to this Prometheus text file, replaced atomically
+                    so that the node exporter textfile collector never reads a partial file
+    profile_slowest : integer
+                    If set, every unit runs under cProfile and tracemalloc, and the profiles and allocation
+                    snapshots of this many slowest units are written to `profile_dir`
+    profile_dir : string
+                    Directory to write the profiles to
+    """
+
+    def __init__(self, jsonl_path=None, prom_path=None, profile_slowest=0, profile_dir='profiles'):
+        self.prom_path = prom_path
+        self.profile_slowest = profile_slowest
+        self.profile_dir = profile_dir
+        self.started = time.time()
+
+        self.stages = Counter()
+        self.rows = Counter()
+        self.files = Counter()
+        self.errors = Counter()
+        self.bytes = Counter()
+        self.round_trips = Counter()
+        self.seconds = Counter()
+        # additional gauges by name, as (help text, list of (labels, value)), written to the Prometheus text file
+        self.gauges = {}
+
+        self._lock = threading.Lock()
+        self._order = 0
+        self._slowest = []
+        self._jsonl = open(jsonl_path, 'a') if jsonl_path else None
+
+        if profile_slowest:
+            tracemalloc.start()
+
+    @contextmanager
+    def unit(self, phase, entries, cur, stages=None):
+        """
+        Measures a processing unit run on the current thread.
+
+        Parameters
+        ----------
+        phase       : string
+                        Data directory being processed
+        entries     : list
+                        ManifestEntry of the processed files
+        cur         : Cursor object
+                        Cursor the unit writes with, its round trips are counted if it is a CountingCursor
+        stages      : dictionary
+                        Seconds by stage already spent on the unit elsewhere, such as in a reader process
+        """
+        unit = Unit(phase, [entry.path for entry in entries], sum(entry.size for entry in entries))
+        unit.stages.update(stages or {})
+
+        profile = None
+        if self.profile_slowest:
+            tracemalloc.reset_peak()
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # another thread is being profiled
+                profile = None
+
+        round_trips = getattr(cur, 'round_trips', 0)
+        start = time.perf_counter()
+        _local.unit = unit
+        try:
+            yield unit
+        except BaseException:
+            unit.error = True
+            raise
+        finally:
+            _local.unit = None
+            if profile is not None:
+                profile.disable()
+            unit.seconds = time.perf_counter() - start
+            unit.round_trips = getattr(cur, 'round_trips', 0) - round_trips
+            if self.profile_slowest:
+                unit.peak_memory = tracemalloc.get_traced_memory()[1]
+            self._record(unit, profile)
+
+    def _record(self, unit, profile):
+        with self._lock:
+            for name, seconds in unit.stages.items():
+                self.stages[(unit.phase, name)] += seconds
+            self.rows.update(unit.rows)
+            self.files[unit.phase] += len(unit.paths)
+            self.errors[unit.phase] += len(unit.paths) if unit.error else 0
+            self.bytes[unit.phase] += unit.bytes
+            self.round_trips[unit.phase] += unit.round_trips
+            self.seconds[unit.phase] += unit.seconds
+
+            if self._jsonl is not None:
+                self._jsonl.write(json.dumps(unit.to_dict()) + '\n')
+                self._jsonl.flush()
+
+            # keep the profiles of the slowest units only, the snapshot is taken when a unit makes the cut
+            if profile is not None and (len(self._slowest) < self.profile_slowest
+                                        or unit.seconds > self._slowest[0][0]):
+                item = (unit.seconds, self._order, unit, profile, tracemalloc.take_snapshot())
+                self._order += 1
+                if len(self._slowest) < self.profile_slowest:
+                    heapq.heappush(self._slowest, item)
+                else:
+                    heapq.heapreplace(self._slowest, item)
+
+    def write_prometheus(self):
+        """
+        Writes the run totals to the Prometheus text file, if set.
+        """
+        if not self.prom_path:
+            return
+
+        metrics = [
+            ('sparkify_etl_stage_seconds', 'Seconds spent in each ETL stage during the last run.',
+             [({'phase': phase, 'stage': name}, value) for (phase, name), value in sorted(self.stages.items())]),
+            ('sparkify_etl_rows_written', 'Rows written to each table during the last run.',
+             [({'table': table}, value) for table, value in sorted(self.rows.items())]),
+            ('sparkify_etl_files_processed', 'Data files processed during the last run.',
+             [({'phase': phase}, value) for phase, value in sorted(self.files.items())]),
+            ('sparkify_etl_files_failed', 'Data files that failed to load during the last run.',
+             [({'phase': phase}, value) for phase, value in sorted(self.errors.items())]),
+            ('sparkify_etl_bytes_read', 'Bytes of data files read during the last run.',
+             [({'phase': phase}, value) for phase, value in sorted(self.bytes.items())]),
+            ('sparkify_etl_round_trips', 'Statements sent to the database during the last run.',
+             [({'phase': phase}, value) for phase, value in sorted(self.round_trips.items())]),
+            ('sparkify_etl_seconds', 'Seconds spent processing each data directory during the last run.',
+             [({'phase': phase}, value) for phase, value in sorted(self.seconds.items())]),
+            ('sparkify_etl_peak_memory_bytes', 'Peak resident memory of the last run.', [({}, max_rss())]),
+            ('sparkify_etl_last_run_timestamp_seconds', 'Start time of the last run.', [({}, self.started)]),
+        ]
+        metrics.extend((name, help_text, samples) for name, (help_text, samples) in sorted(self.gauges.items()))
+
+        lines = []
+        for name, help_text, samples in metrics:
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} gauge'.format(name))
+            for labels, value in samples:
+                label_text = ','.join('{}="{}"'.format(key, value) for key, value in labels.items())
+                lines.append('{}{} {}'.format(name, '{' + label_text + '}' if label_text else '', value))
+
+        tmp_path = '{}.{}.tmp'.format(self.prom_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.prom_path)
+
+    def write_profiles(self):
+        """
+        Writes the cProfile stats and the top allocations of the slowest units to the profile directory.
+
+        Returns
+        -------
+        List of the written profile paths
+        """
+        if not self._slowest:
+            return []
+
+        os.makedirs(self.profile_dir, exist_ok=True)
+        paths = []
+        for rank, (seconds, order, unit, profile, snapshot) in enumerate(sorted(self._slowest, reverse=True), 1):
+            name = '{:02d}-{}-{}'.format(rank, unit.phase, os.path.splitext(os.path.basename(unit.paths[0]))[0])
+            path = os.path.join(self.profile_dir, name)
+            profile.dump_stats(path + '.prof')
+            with open(path + '.tracemalloc.txt', 'w') as f:
+                f.write('{} ({} files) {:.3f}s, peak traced memory {} bytes\n'.format(
+                    unit.paths[0], len(unit.paths), seconds, unit.peak_memory))
+                for stat in snapshot.statistics('lineno')[:25]:
+                    f.write('{}\n'.format(stat))
+            paths.append(path + '.prof')
+        return paths
+
+    def summary(self):
+        """
+        Returns the run totals as printable lines.
+        """
+        lines = []
+        for phase in sorted(self.files):
+            stages = ', '.join('{} {:.2f}s'.format(name, seconds)
+                               for (stage_phase, name), seconds in sorted(self.stages.items()) if stage_phase == phase)
+            lines.append('{}: {} files, {} bytes, {} round trips, {:.2f}s ({}).'.format(
+                phase, self.files[phase], self.bytes[phase], self.round_trips[phase], self.seconds[phase], stages))
+        lines.append('Rows written: {}.'.format(', '.join('{} {}'.format(table, count)
+                                                          for table, count in sorted(self.rows.items()))))
+        lines.append('Peak memory: {:.1f} MB.'.format(max_rss() / 2 ** 20))
+        return lines
+
+    def close(self):
+        """
+        Writes the run record, the Prometheus text file and the profiles, then stops tracing.
+        """
+        if self._jsonl is not None:
+            self._jsonl.write(json.dumps({
+                "event": "run",
+                "started": self.started,
+                "seconds": round(time.time() - self.started, 6),
+                "files": dict(self.files),
+                "errors": dict(self.errors),
+                "bytes": dict(self.bytes),
+                "round_trips": dict(self.round_trips),
+                "rows": dict(self.rows),
+                "max_rss": max_rss(),
+            }) + '\n')
+            self._jsonl.close()
+            self._jsonl = None
+
+        self.write_prometheus()
+        for path in self.write_profiles():
+            print('Profile written to {}'.format(path))
+
+        if self.profile_slowest:
+            tracemalloc.stop()
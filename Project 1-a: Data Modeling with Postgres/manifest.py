@@ -0,0 +1,108 @@
+import os
+import hashlib
+from collections import namedtuple
+from sql_queries import manifest_select, manifest_upsert, manifest_touch
+
+
+# a data file as recorded in etl_manifest table
+ManifestEntry = namedtuple("ManifestEntry", ["path", "size", "mtime", "content_hash"])
+
+
+def file_hash(filepath, chunk_size=1 << 20):
+    """
+    This function returns the sha256 hex digest of a file content.
+
+    Parameters
+    ----------
+    filepath    : string
+                    Path to data file
+    chunk_size  : integer
+                    Number of bytes read at once
+    """
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_entry(filepath):
+    """
+    This function returns the ManifestEntry describing the current state of a file.
+
+    Parameters
+    ----------
+    filepath    : string
+                    Path to data file
+    """
+    stat = os.stat(filepath)
+    return ManifestEntry(filepath, stat.st_size, stat.st_mtime, file_hash(filepath))
+
+
+def load_manifest(cur):
+    """
+    This function returns the files recorded in etl_manifest table as a dictionary of ManifestEntry by path.
+
+    Parameters
+    ----------
+    cur         : Cursor object
+                    Cursor connected to postgreSQL session
+    """
+    cur.execute(manifest_select)
+    return {row[0]: ManifestEntry(*row) for row in cur.fetchall()}
+
+
+def select_new_files(cur, filepaths):
+    """
+    This function returns the files that are not loaded yet or changed since they were loaded.
+
+    A file whose size and modification time are unchanged is skipped without being read.
+    A file whose size or modification time changed is hashed and skipped if its content is unchanged,
+    its new modification time is then recorded.
+
+    Parameters
+    ----------
+    cur         : Cursor object
+                    Cursor connected to postgreSQL session
+    filepaths   : list
+                    Paths to data files
+
+    Returns
+    -------
+    List of ManifestEntry of the files to load, in the order of `filepaths`
+    """
+    manifest = load_manifest(cur)
+    new_files = []
+
+    for filepath in filepaths:
+        stat = os.stat(filepath)
+        loaded = manifest.get(filepath)
+
+        if loaded and loaded.size == stat.st_size and loaded.mtime == stat.st_mtime:
+            continue
+
+        entry = file_entry(filepath)
+        if loaded and loaded.content_hash == entry.content_hash:
+            cur.execute(manifest_touch, (entry.size, entry.mtime, entry.path))
+            continue
+
+        new_files.append(entry)
+
+    return new_files
+
+
+def record_file(cur, entry, row_count):
+    """
+    This function records a loaded file in etl_manifest table. It is meant to run in the transaction
+    loading the file so that a file is recorded if and only if its data is committed.
+
+    Parameters
+    ----------
+    cur         : Cursor object
+                    Cursor connected to postgreSQL session
+    entry       : ManifestEntry
+                    Loaded file
+    row_count   : integer
+                    Number of rows written from the file
+    """
+    cur.execute(manifest_upsert, (entry.path, entry.size, entry.mtime, entry.content_hash, row_count))
@@ -0,0 +1,110 @@
+import threading
+import psycopg2
+from sql_queries import songplay_partition_create, songplay_partitions_select, songplay_partitioned_select
+
+
+def partition_name(year, month):
+    """
+    Returns the name of the songplays partition holding a month.
+    """
+    return 'songplays_{:04d}_{:02d}'.format(year, month)
+
+
+def month_bounds(year, month):
+    """
+    Returns the first day of a month and the first day of the next month as ISO dates.
+    """
+    next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return '{:04d}-{:02d}-01'.format(year, month), '{:04d}-{:02d}-01'.format(next_year, next_month)
+
+
+def create_songplay_partitions(cur, months):
+    """
+    Creates the monthly partitions of songplays table that do not exist yet.
+
+    Parameters
+    ----------
+    cur         : Cursor object
+                    Cursor connected to postgreSQL session
+    months      : iterable
+                    (year, month) tuples
+    """
+    for year, month in sorted(months):
+        start, end = month_bounds(year, month)
+        cur.execute(songplay_partition_create.format(name=partition_name(year, month), start=start, end=end))
+
+
+class SongplayPartitions:
+    """
+    Creates the monthly partitions of a range-partitioned songplays table on demand, before rows
+    of a new month are written so that postgreSQL routes every row to an existing partition.
+
+    Partitions are created on their own autocommit connection, so that they outlive a rolled back load
+    and are visible to every writer. Creating a partition locks songplays exclusively, so it waits for
+    every transaction that wrote songplays: partitions must be ensured before the transaction loading their
+    rows writes any songplay, otherwise it waits for itself forever.
+    """
+
+    def __init__(self, dsn, months=()):
+        self._dsn = dsn
+        self._months = set(months)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def detect(cls, cur, dsn):
+        """
+        Returns the partitions of songplays table if it is partitioned, None otherwise.
+
+        Parameters
+        ----------
+        cur         : Cursor object
+                        Cursor connected to postgreSQL session
+        dsn         : string
+                        Connection string used to create partitions
+        """
+        cur.execute(songplay_partitioned_select)
+        if not cur.fetchone()[0]:
+            return None
+
+        cur.execute(songplay_partitions_select)
+        months = set()
+        for (name,) in cur.fetchall():
+            year, month = name.split('_')[1:3]
+            months.add((int(year), int(month)))
+        return cls(dsn, months)
+
+    def ensure(self, start_times):
+        """
+        Creates the missing partitions for a series of start times.
+
+        Parameters
+        ----------
+        start_times : Series
+                        Datetime series of the songplays about to be written
+        """
+        self.ensure_months(zip(start_times.dt.year.tolist(), start_times.dt.month.tolist()))
+
+    def ensure_months(self, months):
+        """
+        Creates the missing partitions of a set of months.
+
+        Parameters
+        ----------
+        months      : iterable
+                        (year, month) tuples
+        """
+        months = set(months) - self._months
+        if not months:
+            return
+
+        with self._lock:
+            months -= self._months
+            if not months:
+                return
+            conn = psycopg2.connect(self._dsn)
+            conn.set_session(autocommit=True)
+            try:
+                create_songplay_partitions(conn.cursor(), months)
+            finally:
+                conn.close()
+            self._months |= months
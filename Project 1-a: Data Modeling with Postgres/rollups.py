@@ -0,0 +1,100 @@
+from collections import Counter
+from psycopg2.extras import execute_values
+from sql_queries import plays_by_hour_upsert, plays_by_user_upsert, plays_by_song_upsert, plays_by_artist_upsert, \
+    rollup_rebuild_queries, rollup_rebuild_queries_surrogate, rollup_state_stale, rollup_state_select
+from surrogate_keys import has_surrogate_keys
+
+
+class RollupDelta:
+    """
+    Plays added to the rollup tables by the songplays inserted in a transaction.
+
+    Songplays inserts return the rows they actually inserted, so songplays skipped as duplicates
+    are not counted. The delta is added to the rollups in the same transaction.
+
+    Attributes
+    ----------
+    hours       : Counter
+                    Plays by hour
+    users       : Counter
+                    Plays by (user_id, level)
+    songs       : Counter
+                    Plays by song_id
+    artists     : Counter
+                    Plays by artist_id
+    """
+
+    def __init__(self):
+        self.hours = Counter()
+        self.users = Counter()
+        self.songs = Counter()
+        self.artists = Counter()
+
+    def add(self, rows):
+        """
+        Counts inserted songplays.
+
+        Parameters
+        ----------
+        rows        : list
+                        (start_time, user_id, level, song_id, artist_id) tuples returned by a songplays insert
+        """
+        for start_time, user_id, level, song_id, artist_id in rows:
+            self.hours[start_time.replace(minute=0, second=0, microsecond=0)] += 1
+            if level is not None:
+                self.users[(user_id, level)] += 1
+            if song_id is not None:
+                self.songs[song_id] += 1
+            if artist_id is not None:
+                self.artists[artist_id] += 1
+
+    def apply(self, cur):
+        """
+        Adds the delta to the rollup tables, one statement per rollup, then clears it.
+
+        Parameters
+        ----------
+        cur         : Cursor object
+                        Cursor connected to postgreSQL session
+
+        Returns
+        -------
+        Number of songplays added
+        """
+        for query, counts in ((plays_by_hour_upsert, self.hours), (plays_by_user_upsert, self.users),
+                              (plays_by_song_upsert, self.songs), (plays_by_artist_upsert, self.artists)):
+            if counts:
+                rows = [key + (plays,) if isinstance(key, tuple) else (key, plays) for key, plays in sorted(counts.items())]
+                execute_values(cur, query, rows, page_size=len(rows))
+
+        num_plays = sum(self.hours.values())
+        self.__init__()
+        return num_plays
+
+
+def rebuild_rollups(cur, conn):
+    """
+    Recomputes the rollup tables from songplays using the queries in `rollup_rebuild_queries` list,
+    or `rollup_rebuild_queries_surrogate` list if songplays stores surrogate keys.
+    """
+    for query in rollup_rebuild_queries_surrogate if has_surrogate_keys(cur) else rollup_rebuild_queries:
+        cur.execute(query)
+    conn.commit()
+
+
+def mark_rollups_stale(cur, conn):
+    """
+    Records that songplays are loaded without updating the rollups, queries then read songplays
+    until the rollups are rebuilt.
+    """
+    cur.execute(rollup_state_stale)
+    conn.commit()
+
+
+def rollups_fresh(cur):
+    """
+    Returns whether the rollup tables are in sync with songplays.
+    """
+    cur.execute(rollup_state_select)
+    row = cur.fetchone()
+    return bool(row and row[0])
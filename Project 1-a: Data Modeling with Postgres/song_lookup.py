@@ -0,0 +1,135 @@
+import threading
+import pandas as pd
+from sql_queries import song_lookup_select
+
+
+# columns of the normalized lookup key
+KEY_COLUMNS = ["title_key", "name_key", "duration_key"]
+
+
+class SongLookupIndex:
+    """
+    In-memory index resolving (song title, artist name, song duration) to (song_id, artist_id).
+
+    Titles and names are matched case-insensitively ignoring surrounding spaces and durations
+    are rounded to `tolerance` seconds. It replaces running `song_select` for every event
+    with one vectorized join per data frame.
+
+    Attributes
+    ----------
+    tolerance   : float
+                    Duration rounding step in seconds
+    hits        : integer
+                    Number of resolved records
+    misses      : integer
+                    Number of records with no matching song
+    """
+
+    def __init__(self, tolerance=0.01):
+        self.tolerance = tolerance
+        self.hits = 0
+        self.misses = 0
+        self._table = pd.DataFrame({
+            "title_key": pd.Series(dtype="string"),
+            "name_key": pd.Series(dtype="string"),
+            "duration_key": pd.Series(dtype="Int64"),
+            "song_id": pd.Series(dtype=object),
+            "artist_id": pd.Series(dtype=object),
+        })
+        self._pending = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_database(cls, cur, tolerance=0.01):
+        """
+        Builds an index from the songs and artists tables.
+
+        Parameters
+        ----------
+        cur         : Cursor object
+                        Cursor connected to postgreSQL session
+        tolerance   : float
+                        Duration rounding step in seconds
+        """
+        index = cls(tolerance)
+        cur.execute(song_lookup_select)
+        rows = pd.DataFrame(cur.fetchall(), columns=["song_id", "title", "artist_id", "artist_name", "duration"])
+        index._pending.append(index._keys(rows, "title", "artist_name", "duration").assign(
+            song_id=rows["song_id"].values, artist_id=rows["artist_id"].values))
+        return index
+
+    def __len__(self):
+        return len(self._consolidate())
+
+    def add(self, song_df, artist_df):
+        """
+        Adds songs to the index, the first song wins when two songs share a key.
+
+        Parameters
+        ----------
+        song_df     : DataFrame
+                        Song records with song_id, title, artist_id and duration columns
+        artist_df   : DataFrame
+                        Artist records with artist_id and artist_name columns
+        """
+        artists = artist_df[["artist_id", "artist_name"]].drop_duplicates("artist_id")
+        songs = song_df[["song_id", "title", "artist_id", "duration"]].merge(artists, on="artist_id")
+        self._pending.append(self._keys(songs, "title", "artist_name", "duration").assign(
+            song_id=songs["song_id"].values, artist_id=songs["artist_id"].values))
+
+    def resolve(self, df, title="song", name="artist", duration="length"):
+        """
+        Resolves song_id and artist_id of every record of a data frame in one join.
+
+        Parameters
+        ----------
+        df          : DataFrame
+                        Records to resolve
+        title       : string
+                        Column holding the song title
+        name        : string
+                        Column holding the artist name
+        duration    : string
+                        Column holding the song duration
+
+        Returns
+        -------
+        DataFrame indexed like `df` with song_id and artist_id columns, None when not found
+        """
+        matches = self._keys(df, title, name, duration).merge(self._consolidate(), how="left", on=KEY_COLUMNS)
+        matches.index = df.index
+        matches = matches[["song_id", "artist_id"]].astype(object)
+        matches = matches.where(matches.notna(), None)
+
+        found = int(matches["song_id"].notna().sum())
+        with self._lock:
+            self.hits += found
+            self.misses += len(matches) - found
+
+        return matches
+
+    def match_rate(self):
+        """
+        Returns the share of resolved records since the index was created.
+        """
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def _keys(self, df, title, name, duration):
+        return pd.DataFrame({
+            "title_key": df[title].astype("string").str.strip().str.casefold().values,
+            "name_key": df[name].astype("string").str.strip().str.casefold().values,
+            "duration_key": (pd.to_numeric(df[duration]) / self.tolerance).round().astype("Int64").values,
+        })
+
+    def _consolidate(self):
+        with self._lock:
+            return self._consolidate_locked()
+
+    def _consolidate_locked(self):
+        if self._pending:
+            self._table = pd.concat([self._table] + self._pending, ignore_index=True) \
+                .dropna(subset=KEY_COLUMNS) \
+                .drop_duplicates(KEY_COLUMNS)
+            self._pending = []
+        return self._table
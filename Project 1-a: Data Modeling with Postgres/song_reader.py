@@ -0,0 +1,63 @@
+import pandas as pd
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    import json
+    loads = json.loads
+
+
+# fields of a song data record
+SONG_FIELDS = ["num_songs", "artist_id", "artist_latitude", "artist_longitude", "artist_location",
+               "artist_name", "song_id", "title", "duration", "year"]
+
+
+def read_song_files(filepaths):
+    """
+    This function decodes many small json song files straight into one columnar data frame,
+    without building a data frame per file.
+
+    Parameters
+    ----------
+    filepaths   : list
+                    Paths to song files, each holding one json record per line
+
+    Returns
+    -------
+    (DataFrame with SONG_FIELDS columns in file order, list of the number of records of each file)
+    """
+    columns = {field: [] for field in SONG_FIELDS}
+    counts = []
+
+    for filepath in filepaths:
+        with open(filepath, 'rb') as f:
+            lines = [line for line in f.read().splitlines() if line.strip()]
+        for line in lines:
+            record = loads(line)
+            for field, values in columns.items():
+                values.append(record.get(field))
+        counts.append(len(lines))
+
+    return pd.DataFrame(columns), counts
+
+
+def iter_song_batches(filepaths, batch_size=5000):
+    """
+    This function reads song files in batches.
+
+    Parameters
+    ----------
+    filepaths   : list
+                    Paths to song files
+    batch_size  : integer
+                    Number of files per batch
+
+    Yields
+    ------
+    (list of file paths of the batch, DataFrame, list of the number of records of each file)
+    """
+    for i in range(0, len(filepaths), batch_size):
+        batch = filepaths[i:i + batch_size]
+        df, counts = read_song_files(batch)
+        yield batch, df, counts
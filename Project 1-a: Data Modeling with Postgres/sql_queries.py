@@ -5,6 +5,13 @@ user_table_drop = "DROP TABLE if exists users"
 song_table_drop = "DROP TABLE if exists songs"
 artist_table_drop = "DROP TABLE if exists artists"
 time_table_drop = "DROP TABLE if exists time"
+manifest_table_drop = "DROP TABLE if exists etl_manifest"
+plays_by_hour_table_drop = "DROP TABLE if exists plays_by_hour"
+plays_by_user_table_drop = "DROP TABLE if exists plays_by_user"
+plays_by_song_table_drop = "DROP TABLE if exists plays_by_song"
+plays_by_artist_table_drop = "DROP TABLE if exists plays_by_artist"
+rollup_state_table_drop = "DROP TABLE if exists rollup_state"
+songplay_unresolved_table_drop = "DROP TABLE if exists songplays_unresolved"
 
 # CREATE TABLES
 
@@ -18,17 +25,43 @@ songplay_table_create = ("""
         artist_id TEXT,
         session_id INT,
         location TEXT,
-        user_agent TEXT
+        user_agent TEXT,
+        UNIQUE (start_time, user_id, session_id)
     )
 """)
 
+# songplays range-partitioned by month on start_time, the primary key includes the partition key
+songplay_table_create_partitioned = ("""
+    CREATE TABLE IF NOT EXISTS songplays (
+        songplay_id SERIAL NOT NULL,
+        start_time timestamp NOT NULL,
+        user_id INT NOT NULL,
+        level TEXT,
+        song_id TEXT,
+        artist_id TEXT,
+        session_id INT,
+        location TEXT,
+        user_agent TEXT,
+        PRIMARY KEY (songplay_id, start_time),
+        UNIQUE (start_time, user_id, session_id)
+    ) PARTITION BY RANGE (start_time)
+""")
+
+songplay_partition_create = ("""
+    CREATE TABLE IF NOT EXISTS {name} PARTITION OF songplays
+        FOR VALUES FROM ('{start}') TO ('{end}')
+""")
+
+# updated_at is the time of the record the level was taken from, so that a file loaded late by a concurrent
+# writer does not overwrite a newer level
 user_table_create = ("""
     CREATE TABLE IF NOT EXISTS users (
         user_id INT NOT NULL PRIMARY KEY,
         first_name TEXT,
         last_name TEXT,
         gender TEXT,
-        level TEXT
+        level TEXT,
+        updated_at timestamp
     )
 """)
 
@@ -64,6 +97,195 @@ time_table_create = ("""
     )
 """)
 
+# files already loaded, to load only new or changed files
+manifest_table_create = ("""
+    CREATE TABLE IF NOT EXISTS etl_manifest (
+        path TEXT NOT NULL PRIMARY KEY,
+        size BIGINT NOT NULL,
+        mtime DOUBLE PRECISION NOT NULL,
+        content_hash TEXT NOT NULL,
+        row_count INT NOT NULL,
+        loaded_at timestamp NOT NULL
+    )
+""")
+
+# songplays whose song was not found, with the event fields needed to resolve them once their song is loaded
+songplay_unresolved_table_create = ("""
+    CREATE TABLE IF NOT EXISTS songplays_unresolved (
+        start_time timestamp NOT NULL,
+        user_id INT NOT NULL,
+        session_id INT NOT NULL,
+        song TEXT,
+        artist TEXT,
+        length FLOAT,
+        PRIMARY KEY (start_time, user_id, session_id)
+    )
+""")
+
+songplay_unresolved_index_create = "CREATE INDEX IF NOT EXISTS songplays_unresolved_song_idx ON songplays_unresolved (lower(trim(song)), lower(trim(artist)))"
+
+# ROLLUP TABLES
+# plays aggregated from songplays, updated with the deltas of every transaction inserting songplays
+
+plays_by_hour_table_create = ("""
+    CREATE TABLE IF NOT EXISTS plays_by_hour (
+        hour timestamp NOT NULL PRIMARY KEY,
+        plays BIGINT NOT NULL
+    )
+""")
+
+plays_by_user_table_create = ("""
+    CREATE TABLE IF NOT EXISTS plays_by_user (
+        user_id INT NOT NULL,
+        level TEXT NOT NULL,
+        plays BIGINT NOT NULL,
+        PRIMARY KEY (user_id, level)
+    )
+""")
+
+plays_by_song_table_create = ("""
+    CREATE TABLE IF NOT EXISTS plays_by_song (
+        song_id TEXT NOT NULL PRIMARY KEY,
+        plays BIGINT NOT NULL
+    )
+""")
+
+plays_by_artist_table_create = ("""
+    CREATE TABLE IF NOT EXISTS plays_by_artist (
+        artist_id TEXT NOT NULL PRIMARY KEY,
+        plays BIGINT NOT NULL
+    )
+""")
+
+# whether the rollups are in sync with songplays, they are not after songplays were loaded without them
+rollup_state_table_create = ("""
+    CREATE TABLE IF NOT EXISTS rollup_state (
+        id INT NOT NULL PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+        fresh BOOLEAN NOT NULL,
+        updated_at timestamp NOT NULL
+    )
+""")
+
+rollup_state_insert = ("""
+    INSERT INTO rollup_state
+        (fresh, updated_at)
+    VALUES
+        (TRUE, now())
+    ON CONFLICT
+    (id) DO NOTHING
+""")
+
+# SURROGATE KEYS
+# songs and artists get compact integer keys, songplays stores them instead of the 18-character natural ids
+
+songplay_table_create_surrogate = ("""
+    CREATE TABLE IF NOT EXISTS songplays (
+        songplay_id SERIAL NOT NULL PRIMARY KEY,
+        start_time timestamp NOT NULL,
+        user_id INT NOT NULL,
+        level TEXT,
+        song_key INT,
+        artist_key INT,
+        session_id INT,
+        location TEXT,
+        user_agent TEXT,
+        UNIQUE (start_time, user_id, session_id)
+    )
+""")
+
+song_table_create_surrogate = ("""
+    CREATE TABLE IF NOT EXISTS songs(
+        song_key SERIAL NOT NULL PRIMARY KEY,
+        song_id TEXT NOT NULL UNIQUE,
+        title TEXT,
+        artist_id TEXT,
+        year INT,
+        duration FLOAT
+    )
+""")
+
+artist_table_create_surrogate = ("""
+    CREATE TABLE IF NOT EXISTS artists (
+        artist_key SERIAL NOT NULL PRIMARY KEY,
+        artist_id TEXT NOT NULL UNIQUE,
+        name TEXT,
+        location TEXT,
+        latitude FLOAT,
+        longitude FLOAT
+    )
+""")
+
+# INDEXES
+# created on a partitioned songplays table after the bulk load, new partitions inherit them
+
+songplay_start_time_index_create = "CREATE INDEX IF NOT EXISTS songplays_start_time_brin ON songplays USING BRIN (start_time)"
+songplay_user_id_index_create = "CREATE INDEX IF NOT EXISTS songplays_user_id_idx ON songplays (user_id)"
+songplay_song_id_index_create = "CREATE INDEX IF NOT EXISTS songplays_song_id_idx ON songplays (song_id)"
+
+# STAGING TABLES (bulk load)
+# session-local tables, emptied on every commit
+
+songplay_stage_create = ("""
+    CREATE TEMP TABLE IF NOT EXISTS songplays_stage (
+        start_time timestamp,
+        user_id INT,
+        level TEXT,
+        song TEXT,
+        artist TEXT,
+        length FLOAT,
+        session_id INT,
+        location TEXT,
+        user_agent TEXT,
+        song_id TEXT,
+        artist_id TEXT,
+        song_key INT,
+        artist_key INT
+    ) ON COMMIT DELETE ROWS
+""")
+
+user_stage_create = ("""
+    CREATE TEMP TABLE IF NOT EXISTS users_stage (
+        user_id INT,
+        first_name TEXT,
+        last_name TEXT,
+        gender TEXT,
+        level TEXT,
+        start_time timestamp
+    ) ON COMMIT DELETE ROWS
+""")
+
+song_stage_create = ("""
+    CREATE TEMP TABLE IF NOT EXISTS songs_stage (
+        song_id TEXT,
+        title TEXT,
+        artist_id TEXT,
+        year INT,
+        duration FLOAT
+    ) ON COMMIT DELETE ROWS
+""")
+
+artist_stage_create = ("""
+    CREATE TEMP TABLE IF NOT EXISTS artists_stage (
+        artist_id TEXT,
+        name TEXT,
+        location TEXT,
+        latitude FLOAT,
+        longitude FLOAT
+    ) ON COMMIT DELETE ROWS
+""")
+
+time_stage_create = ("""
+    CREATE TEMP TABLE IF NOT EXISTS time_stage (
+        start_time timestamp,
+        hour INT,
+        day INT,
+        week INT,
+        month INT,
+        year INT,
+        weekday INT
+    ) ON COMMIT DELETE ROWS
+""")
+
 # INSERT RECORDS
 
 songplay_table_insert = ("""
@@ -72,17 +294,20 @@ songplay_table_insert = ("""
     VALUES
         (%s, %s, %s, %s, %s, %s, %s, %s)
     ON CONFLICT
-    (songplay_id) DO NOTHING;
+    (start_time, user_id, session_id) DO NOTHING
+    RETURNING
+        start_time, user_id, level, song_id, artist_id;
 """)
 
 user_table_insert = ("""
     INSERT INTO users
-        (user_id, first_name, last_name, gender, level)
+        (user_id, first_name, last_name, gender, level, updated_at)
     VALUES
-        (%s, %s, %s, %s, %s)
+        (%s, %s, %s, %s, %s, %s)
     ON CONFLICT
     (user_id) DO
-    UPDATE SET level = EXCLUDED.level;
+    UPDATE SET level = EXCLUDED.level, updated_at = EXCLUDED.updated_at
+    WHERE users.updated_at IS NULL OR users.updated_at <= EXCLUDED.updated_at;
 """)
 
 song_table_insert = ("""
@@ -113,6 +338,351 @@ time_table_insert = ("""
     (start_time) DO NOTHING;
 """)
 
+# COPY INTO STAGING TABLES
+
+songplay_stage_copy = "COPY songplays_stage (start_time, user_id, level, song, artist, length, session_id, location, user_agent) FROM STDIN WITH (FORMAT csv)"
+songplay_resolved_stage_copy = "COPY songplays_stage (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent, song, artist, length) FROM STDIN WITH (FORMAT csv)"
+user_stage_copy = "COPY users_stage (user_id, first_name, last_name, gender, level, start_time) FROM STDIN WITH (FORMAT csv)"
+song_stage_copy = "COPY songs_stage (song_id, title, artist_id, year, duration) FROM STDIN WITH (FORMAT csv)"
+artist_stage_copy = "COPY artists_stage (artist_id, name, location, latitude, longitude) FROM STDIN WITH (FORMAT csv)"
+time_stage_copy = "COPY time_stage (start_time, hour, day, week, month, year, weekday) FROM STDIN WITH (FORMAT csv)"
+
+# MERGE STAGING TABLES
+# rows are merged in key order so that concurrent writers lock keys in the same order
+
+songplay_stage_merge = ("""
+    INSERT INTO songplays
+        (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+    SELECT
+        stage.start_time, stage.user_id, stage.level, match.song_id, match.artist_id,
+        stage.session_id, stage.location, stage.user_agent
+    FROM
+        songplays_stage stage
+        LEFT JOIN LATERAL (
+            SELECT
+                songs.song_id, artists.artist_id
+            FROM
+                songs
+                JOIN artists ON artists.artist_id = songs.artist_id
+            WHERE
+                songs.title = stage.song AND artists.name = stage.artist AND songs.duration = stage.length
+            LIMIT 1
+        ) match ON TRUE
+    ON CONFLICT
+    (start_time, user_id, session_id) DO NOTHING
+    RETURNING
+        start_time, user_id, level, song_id, artist_id;
+""")
+
+# songplays whose song_id and artist_id were resolved before staging
+songplay_resolved_stage_merge = ("""
+    INSERT INTO songplays
+        (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+    SELECT
+        start_time, user_id, level, song_id, artist_id, session_id, location, user_agent
+    FROM
+        songplays_stage
+    ON CONFLICT
+    (start_time, user_id, session_id) DO NOTHING
+    RETURNING
+        start_time, user_id, level, song_id, artist_id;
+""")
+
+# keep the latest level of a user when it shows up more than once in a batch, or was loaded by another batch
+user_stage_merge = ("""
+    INSERT INTO users
+        (user_id, first_name, last_name, gender, level, updated_at)
+    SELECT DISTINCT ON (user_id)
+        user_id, first_name, last_name, gender, level, start_time
+    FROM
+        users_stage
+    ORDER BY
+        user_id, start_time DESC
+    ON CONFLICT
+    (user_id) DO
+    UPDATE SET level = EXCLUDED.level, updated_at = EXCLUDED.updated_at
+    WHERE users.updated_at IS NULL OR users.updated_at <= EXCLUDED.updated_at;
+""")
+
+song_stage_merge = ("""
+    INSERT INTO songs
+        (song_id, title, artist_id, year, duration)
+    SELECT
+        song_id, title, artist_id, year, duration
+    FROM
+        songs_stage
+    ORDER BY
+        song_id
+    ON CONFLICT
+    (song_id) DO NOTHING;
+""")
+
+artist_stage_merge = ("""
+    INSERT INTO artists
+        (artist_id, name, location, latitude, longitude)
+    SELECT
+        artist_id, name, location, latitude, longitude
+    FROM
+        artists_stage
+    ORDER BY
+        artist_id
+    ON CONFLICT
+    (artist_id) DO NOTHING;
+""")
+
+time_stage_merge = ("""
+    INSERT INTO time
+        (start_time, hour, day, week, month, year, weekday)
+    SELECT
+        start_time, hour, day, week, month, year, weekday
+    FROM
+        time_stage
+    ORDER BY
+        start_time
+    ON CONFLICT
+    (start_time) DO NOTHING;
+""")
+
+# INSERT AND MERGE RECORDS (surrogate keys)
+
+songplay_table_insert_surrogate = ("""
+    INSERT INTO songplays
+        (start_time, user_id, level, song_key, artist_key, session_id, location, user_agent)
+    VALUES
+        (%s, %s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT
+    (start_time, user_id, session_id) DO NOTHING
+    RETURNING
+        start_time, user_id, level, song_key, artist_key;
+""")
+
+songplay_resolved_stage_copy_surrogate = "COPY songplays_stage (start_time, user_id, level, song_key, artist_key, session_id, location, user_agent, song, artist, length) FROM STDIN WITH (FORMAT csv)"
+
+songplay_stage_merge_surrogate = ("""
+    INSERT INTO songplays
+        (start_time, user_id, level, song_key, artist_key, session_id, location, user_agent)
+    SELECT
+        stage.start_time, stage.user_id, stage.level, match.song_key, match.artist_key,
+        stage.session_id, stage.location, stage.user_agent
+    FROM
+        songplays_stage stage
+        LEFT JOIN LATERAL (
+            SELECT
+                songs.song_key, artists.artist_key
+            FROM
+                songs
+                JOIN artists ON artists.artist_id = songs.artist_id
+            WHERE
+                songs.title = stage.song AND artists.name = stage.artist AND songs.duration = stage.length
+            LIMIT 1
+        ) match ON TRUE
+    ON CONFLICT
+    (start_time, user_id, session_id) DO NOTHING
+    RETURNING
+        start_time, user_id, level, song_key, artist_key;
+""")
+
+songplay_resolved_stage_merge_surrogate = ("""
+    INSERT INTO songplays
+        (start_time, user_id, level, song_key, artist_key, session_id, location, user_agent)
+    SELECT
+        start_time, user_id, level, song_key, artist_key, session_id, location, user_agent
+    FROM
+        songplays_stage
+    ON CONFLICT
+    (start_time, user_id, session_id) DO NOTHING
+    RETURNING
+        start_time, user_id, level, song_key, artist_key;
+""")
+
+# APPEND RECORDS (load phase)
+# tables have no constraints while they are loaded, duplicates are removed when they are finalized
+
+songplay_table_append = ("""
+    INSERT INTO songplays
+        (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+    VALUES
+        (%s, %s, %s, %s, %s, %s, %s, %s);
+""")
+
+# the time of the record is kept to find the latest level of a user
+user_table_append = ("""
+    INSERT INTO users
+        (user_id, first_name, last_name, gender, level, updated_at)
+    VALUES
+        (%s, %s, %s, %s, %s, %s);
+""")
+
+song_table_append = ("""
+    INSERT INTO songs
+        (song_id, title, artist_id, year, duration)
+    VALUES
+        (%s, %s, %s, %s, %s);
+""")
+
+artist_table_append = ("""
+    INSERT INTO artists
+        (artist_id, name, location, latitude, longitude)
+    VALUES
+        (%s, %s, %s, %s, %s);
+""")
+
+time_table_append = ("""
+    INSERT INTO time
+        (start_time, hour, day, week, month, year, weekday)
+    VALUES
+        (%s, %s, %s, %s, %s, %s, %s);
+""")
+
+songplay_stage_append = ("""
+    INSERT INTO songplays
+        (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+    SELECT
+        stage.start_time, stage.user_id, stage.level, match.song_id, match.artist_id,
+        stage.session_id, stage.location, stage.user_agent
+    FROM
+        songplays_stage stage
+        LEFT JOIN LATERAL (
+            SELECT
+                songs.song_id, artists.artist_id
+            FROM
+                songs
+                JOIN artists ON artists.artist_id = songs.artist_id
+            WHERE
+                songs.title = stage.song AND artists.name = stage.artist AND songs.duration = stage.length
+            LIMIT 1
+        ) match ON TRUE;
+""")
+
+songplay_resolved_stage_append = ("""
+    INSERT INTO songplays
+        (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+    SELECT
+        start_time, user_id, level, song_id, artist_id, session_id, location, user_agent
+    FROM
+        songplays_stage;
+""")
+
+user_stage_append = ("""
+    INSERT INTO users
+        (user_id, first_name, last_name, gender, level, updated_at)
+    SELECT
+        user_id, first_name, last_name, gender, level, start_time
+    FROM
+        users_stage;
+""")
+
+song_stage_append = ("""
+    INSERT INTO songs
+        (song_id, title, artist_id, year, duration)
+    SELECT
+        song_id, title, artist_id, year, duration
+    FROM
+        songs_stage;
+""")
+
+artist_stage_append = ("""
+    INSERT INTO artists
+        (artist_id, name, location, latitude, longitude)
+    SELECT
+        artist_id, name, location, latitude, longitude
+    FROM
+        artists_stage;
+""")
+
+time_stage_append = ("""
+    INSERT INTO time
+        (start_time, hour, day, week, month, year, weekday)
+    SELECT
+        start_time, hour, day, week, month, year, weekday
+    FROM
+        time_stage;
+""")
+
+# UNRESOLVED SONGPLAYS
+
+songplay_unresolved_insert = ("""
+    INSERT INTO songplays_unresolved
+        (start_time, user_id, session_id, song, artist, length)
+    VALUES
+        %s
+    ON CONFLICT
+    (start_time, user_id, session_id) DO NOTHING;
+""")
+
+# staged songplays merged without a song
+songplay_unresolved_stage_insert = ("""
+    INSERT INTO songplays_unresolved
+        (start_time, user_id, session_id, song, artist, length)
+    SELECT
+        stage.start_time, stage.user_id, stage.session_id, stage.song, stage.artist, stage.length
+    FROM
+        songplays_stage stage
+        JOIN songplays ON songplays.start_time = stage.start_time AND songplays.user_id = stage.user_id
+            AND songplays.session_id = stage.session_id
+    WHERE
+        songplays.song_id IS NULL
+    ON CONFLICT
+    (start_time, user_id, session_id) DO NOTHING;
+""")
+
+songplay_unresolved_stage_insert_surrogate = ("""
+    INSERT INTO songplays_unresolved
+        (start_time, user_id, session_id, song, artist, length)
+    SELECT
+        stage.start_time, stage.user_id, stage.session_id, stage.song, stage.artist, stage.length
+    FROM
+        songplays_stage stage
+        JOIN songplays ON songplays.start_time = stage.start_time AND songplays.user_id = stage.user_id
+            AND songplays.session_id = stage.session_id
+    WHERE
+        songplays.song_key IS NULL
+    ON CONFLICT
+    (start_time, user_id, session_id) DO NOTHING;
+""")
+
+# in the load phase every staged songplay is appended and songplays has no index to join them back on,
+# the songplays left without a song are found in the staging table instead
+songplay_unresolved_stage_append = ("""
+    INSERT INTO songplays_unresolved
+        (start_time, user_id, session_id, song, artist, length)
+    SELECT
+        start_time, user_id, session_id, song, artist, length
+    FROM
+        songplays_stage
+    WHERE
+        song_id IS NULL
+    ON CONFLICT
+    (start_time, user_id, session_id) DO NOTHING;
+""")
+
+# songplays staged without song_id, matched against songs like songplay_stage_append
+songplay_unresolved_lookup_stage_append = ("""
+    INSERT INTO songplays_unresolved
+        (start_time, user_id, session_id, song, artist, length)
+    SELECT
+        stage.start_time, stage.user_id, stage.session_id, stage.song, stage.artist, stage.length
+    FROM
+        songplays_stage stage
+    WHERE
+        NOT EXISTS (
+            SELECT
+                1
+            FROM
+                songs
+                JOIN artists ON artists.artist_id = songs.artist_id
+            WHERE
+                songs.title = stage.song AND artists.name = stage.artist AND songs.duration = stage.length
+        )
+    ON CONFLICT
+    (start_time, user_id, session_id) DO NOTHING;
+""")
+
+# EMPTY STAGING TABLES
+# used when several chunks of log data are merged in the same transaction
+
+log_stage_truncate = "TRUNCATE time_stage, users_stage, songplays_stage;"
+
 # FIND SONGS
 
 song_select = ("""
@@ -125,7 +695,601 @@ song_select = ("""
         songs.title=%s AND artists.name=%s AND songs.duration=%s;
 """)
 
+# all songs with their artist name, to build an in-memory song lookup
+
+song_lookup_select = ("""
+    SELECT
+        songs.song_id, songs.title, songs.artist_id, artists.name, songs.duration
+    FROM
+        songs
+        JOIN artists ON artists.artist_id = songs.artist_id;
+""")
+
+song_select_surrogate = ("""
+    SELECT
+        songs.song_key, artists.artist_key
+    FROM
+        songs
+        JOIN artists ON artists.artist_id = songs.artist_id
+    WHERE
+        songs.title=%s AND artists.name=%s AND songs.duration=%s;
+""")
+
+# natural to surrogate key mappings, all of them or the ones missing from the cache
+
+song_keys_select = "SELECT song_id, song_key FROM songs;"
+song_keys_find = "SELECT song_id, song_key FROM songs WHERE song_id = ANY(%s::text[]) OR song_key = ANY(%s::int[]);"
+artist_keys_select = "SELECT artist_id, artist_key FROM artists;"
+artist_keys_find = "SELECT artist_id, artist_key FROM artists WHERE artist_id = ANY(%s::text[]) OR artist_key = ANY(%s::int[]);"
+
+surrogate_keys_select = ("""
+    SELECT EXISTS (
+        SELECT 1
+        FROM
+            information_schema.columns
+        WHERE
+            table_schema = 'public' AND table_name = 'songplays' AND column_name = 'song_key'
+    );
+""")
+
+# BACKFILL
+# unresolved songplays matching songs loaded after them are resolved in place, with the normalized match
+# of the song lookup index, only against the songs of `song_ids` when it is not NULL
+
+songplay_backfill = ("""
+    WITH matches AS (
+        SELECT DISTINCT ON (u.start_time, u.user_id, u.session_id)
+            u.start_time, u.user_id, u.session_id, songs.song_id, artists.artist_id
+        FROM
+            songs
+            JOIN artists ON artists.artist_id = songs.artist_id
+            JOIN songplays_unresolved u
+                ON lower(trim(u.song)) = lower(trim(songs.title)) AND lower(trim(u.artist)) = lower(trim(artists.name))
+                AND round(u.length / %(tolerance)s) = round(songs.duration / %(tolerance)s)
+        WHERE
+            %(song_ids)s::text[] IS NULL OR songs.song_id = ANY(%(song_ids)s::text[])
+        ORDER BY
+            u.start_time, u.user_id, u.session_id, songs.song_id
+    ), resolved AS (
+        UPDATE songplays
+        SET song_id = matches.song_id, artist_id = matches.artist_id
+        FROM matches
+        WHERE
+            songplays.start_time = matches.start_time AND songplays.user_id = matches.user_id
+            AND songplays.session_id = matches.session_id AND songplays.song_id IS NULL
+        RETURNING
+            matches.song_id, matches.artist_id
+    ), removed AS (
+        DELETE FROM songplays_unresolved u
+        USING matches
+        WHERE u.start_time = matches.start_time AND u.user_id = matches.user_id AND u.session_id = matches.session_id
+    )
+    SELECT song_id, artist_id FROM resolved;
+""")
+
+songplay_backfill_surrogate = ("""
+    WITH matches AS (
+        SELECT DISTINCT ON (u.start_time, u.user_id, u.session_id)
+            u.start_time, u.user_id, u.session_id, songs.song_id, artists.artist_id, songs.song_key, artists.artist_key
+        FROM
+            songs
+            JOIN artists ON artists.artist_id = songs.artist_id
+            JOIN songplays_unresolved u
+                ON lower(trim(u.song)) = lower(trim(songs.title)) AND lower(trim(u.artist)) = lower(trim(artists.name))
+                AND round(u.length / %(tolerance)s) = round(songs.duration / %(tolerance)s)
+        WHERE
+            %(song_ids)s::text[] IS NULL OR songs.song_id = ANY(%(song_ids)s::text[])
+        ORDER BY
+            u.start_time, u.user_id, u.session_id, songs.song_id
+    ), resolved AS (
+        UPDATE songplays
+        SET song_key = matches.song_key, artist_key = matches.artist_key
+        FROM matches
+        WHERE
+            songplays.start_time = matches.start_time AND songplays.user_id = matches.user_id
+            AND songplays.session_id = matches.session_id AND songplays.song_key IS NULL
+        RETURNING
+            matches.song_id, matches.artist_id
+    ), removed AS (
+        DELETE FROM songplays_unresolved u
+        USING matches
+        WHERE u.start_time = matches.start_time AND u.user_id = matches.user_id AND u.session_id = matches.session_id
+    )
+    SELECT song_id, artist_id FROM resolved;
+""")
+
+songplay_unresolved_count_select = "SELECT count(*) FROM songplays_unresolved;"
+
+# MANIFEST
+
+manifest_select = ("""
+    SELECT
+        path, size, mtime, content_hash
+    FROM
+        etl_manifest;
+""")
+
+manifest_upsert = ("""
+    INSERT INTO etl_manifest
+        (path, size, mtime, content_hash, row_count, loaded_at)
+    VALUES
+        (%s, %s, %s, %s, %s, now())
+    ON CONFLICT
+    (path) DO
+    UPDATE SET size = EXCLUDED.size, mtime = EXCLUDED.mtime, content_hash = EXCLUDED.content_hash,
+        row_count = EXCLUDED.row_count, loaded_at = EXCLUDED.loaded_at;
+""")
+
+manifest_touch = ("""
+    UPDATE etl_manifest SET size = %s, mtime = %s WHERE path = %s;
+""")
+
+# BULK-LOAD LIFECYCLE
+# load phase: tables are UNLOGGED and have no constraints nor secondary indexes,
+# etl_manifest is UNLOGGED too so that a crash loses the data and its manifest together
+
+songplay_load_phase = ("""
+    ALTER TABLE songplays
+        DROP CONSTRAINT IF EXISTS songplays_pkey,
+        DROP CONSTRAINT IF EXISTS songplays_start_time_user_id_session_id_key,
+        SET UNLOGGED;
+""")
+
+user_load_phase = ("""
+    ALTER TABLE users
+        DROP CONSTRAINT IF EXISTS users_pkey,
+        ADD COLUMN IF NOT EXISTS updated_at timestamp,
+        SET UNLOGGED;
+""")
+
+song_load_phase = "ALTER TABLE songs DROP CONSTRAINT IF EXISTS songs_pkey, SET UNLOGGED;"
+artist_load_phase = "ALTER TABLE artists DROP CONSTRAINT IF EXISTS artists_pkey, SET UNLOGGED;"
+time_load_phase = "ALTER TABLE time DROP CONSTRAINT IF EXISTS time_pkey, SET UNLOGGED;"
+manifest_load_phase = "ALTER TABLE etl_manifest SET UNLOGGED;"
+
+songplay_index_drop = "DROP INDEX IF EXISTS songplays_start_time_brin, songplays_user_id_idx, songplays_song_id_idx;"
+
+# finalize: duplicates are removed keeping the first row loaded, or the latest level of a user,
+# then constraints are built and tables are switched to LOGGED
+
+songplay_dedup = ("""
+    DELETE FROM songplays a
+    USING songplays b
+    WHERE
+        a.start_time = b.start_time AND a.user_id = b.user_id AND a.session_id = b.session_id
+        AND a.songplay_id > b.songplay_id;
+""")
+
+user_dedup = ("""
+    DELETE FROM users a
+    USING users b
+    WHERE
+        a.user_id = b.user_id
+        AND (COALESCE(a.updated_at, '-infinity'), a.ctid) < (COALESCE(b.updated_at, '-infinity'), b.ctid);
+""")
+
+song_dedup = "DELETE FROM songs a USING songs b WHERE a.song_id = b.song_id AND a.ctid > b.ctid;"
+artist_dedup = "DELETE FROM artists a USING artists b WHERE a.artist_id = b.artist_id AND a.ctid > b.ctid;"
+time_dedup = "DELETE FROM time a USING time b WHERE a.start_time = b.start_time AND a.ctid > b.ctid;"
+
+songplay_finalize = ("""
+    ALTER TABLE songplays
+        ADD PRIMARY KEY (songplay_id),
+        ADD UNIQUE (start_time, user_id, session_id),
+        SET LOGGED;
+""")
+
+user_finalize = ("""
+    ALTER TABLE users
+        ADD PRIMARY KEY (user_id),
+        SET LOGGED;
+""")
+
+song_finalize = "ALTER TABLE songs ADD PRIMARY KEY (song_id), SET LOGGED;"
+artist_finalize = "ALTER TABLE artists ADD PRIMARY KEY (artist_id), SET LOGGED;"
+time_finalize = "ALTER TABLE time ADD PRIMARY KEY (start_time), SET LOGGED;"
+manifest_finalize = "ALTER TABLE etl_manifest SET LOGGED;"
+
+tables_analyze = "ANALYZE songplays, songplays_unresolved, users, songs, artists, time, etl_manifest, plays_by_hour, plays_by_user, plays_by_song, plays_by_artist;"
+
+# fast reset without recreating the database
+tables_truncate = "TRUNCATE songplays, songplays_unresolved, users, songs, artists, time, etl_manifest, plays_by_hour, plays_by_user, plays_by_song, plays_by_artist RESTART IDENTITY;"
+
+load_phase_select = ("""
+    SELECT
+        relpersistence = 'u'
+    FROM
+        pg_class
+    WHERE
+        relname = 'songplays' AND relnamespace = 'public'::regnamespace;
+""")
+
+# ROLLUPS
+# deltas are added in key order so that concurrent writers lock keys in the same order
+
+plays_by_hour_upsert = ("""
+    INSERT INTO plays_by_hour
+        (hour, plays)
+    VALUES
+        %s
+    ON CONFLICT
+    (hour) DO
+    UPDATE SET plays = plays_by_hour.plays + EXCLUDED.plays;
+""")
+
+plays_by_user_upsert = ("""
+    INSERT INTO plays_by_user
+        (user_id, level, plays)
+    VALUES
+        %s
+    ON CONFLICT
+    (user_id, level) DO
+    UPDATE SET plays = plays_by_user.plays + EXCLUDED.plays;
+""")
+
+plays_by_song_upsert = ("""
+    INSERT INTO plays_by_song
+        (song_id, plays)
+    VALUES
+        %s
+    ON CONFLICT
+    (song_id) DO
+    UPDATE SET plays = plays_by_song.plays + EXCLUDED.plays;
+""")
+
+plays_by_artist_upsert = ("""
+    INSERT INTO plays_by_artist
+        (artist_id, plays)
+    VALUES
+        %s
+    ON CONFLICT
+    (artist_id) DO
+    UPDATE SET plays = plays_by_artist.plays + EXCLUDED.plays;
+""")
+
+# full recompute, after a bulk-load or a run without rollups
+
+rollups_truncate = "TRUNCATE plays_by_hour, plays_by_user, plays_by_song, plays_by_artist;"
+
+plays_by_hour_rebuild = ("""
+    INSERT INTO plays_by_hour
+        (hour, plays)
+    SELECT
+        date_trunc('hour', start_time), count(*)
+    FROM
+        songplays
+    GROUP BY
+        1;
+""")
+
+plays_by_user_rebuild = ("""
+    INSERT INTO plays_by_user
+        (user_id, level, plays)
+    SELECT
+        user_id, level, count(*)
+    FROM
+        songplays
+    WHERE
+        level IS NOT NULL
+    GROUP BY
+        user_id, level;
+""")
+
+plays_by_song_rebuild = ("""
+    INSERT INTO plays_by_song
+        (song_id, plays)
+    SELECT
+        song_id, count(*)
+    FROM
+        songplays
+    WHERE
+        song_id IS NOT NULL
+    GROUP BY
+        song_id;
+""")
+
+plays_by_artist_rebuild = ("""
+    INSERT INTO plays_by_artist
+        (artist_id, plays)
+    SELECT
+        artist_id, count(*)
+    FROM
+        songplays
+    WHERE
+        artist_id IS NOT NULL
+    GROUP BY
+        artist_id;
+""")
+
+# songplays with surrogate keys, rollups keep the natural ids
+
+plays_by_song_rebuild_surrogate = ("""
+    INSERT INTO plays_by_song
+        (song_id, plays)
+    SELECT
+        songs.song_id, count(*)
+    FROM
+        songplays
+        JOIN songs ON songs.song_key = songplays.song_key
+    GROUP BY
+        songs.song_id;
+""")
+
+plays_by_artist_rebuild_surrogate = ("""
+    INSERT INTO plays_by_artist
+        (artist_id, plays)
+    SELECT
+        artists.artist_id, count(*)
+    FROM
+        songplays
+        JOIN artists ON artists.artist_key = songplays.artist_key
+    GROUP BY
+        artists.artist_id;
+""")
+
+rollup_state_fresh = "UPDATE rollup_state SET fresh = TRUE, updated_at = now();"
+rollup_state_stale = "UPDATE rollup_state SET fresh = FALSE, updated_at = now();"
+rollup_state_select = "SELECT fresh FROM rollup_state;"
+
+# ANALYTICS
+# each question has a query on the rollups and a query on the fact table, bounds and limits may be NULL
+
+plays_per_hour_rollup_select = ("""
+    SELECT
+        hour, plays
+    FROM
+        plays_by_hour
+    WHERE
+        (%(start)s IS NULL OR hour >= %(start)s) AND (%(end)s IS NULL OR hour < %(end)s)
+    ORDER BY
+        hour;
+""")
+
+plays_per_hour_select = ("""
+    SELECT
+        date_trunc('hour', start_time) AS hour, count(*)
+    FROM
+        songplays
+    WHERE
+        (%(start)s IS NULL OR start_time >= %(start)s) AND (%(end)s IS NULL OR start_time < %(end)s)
+    GROUP BY
+        1
+    ORDER BY
+        1;
+""")
+
+plays_per_day_rollup_select = ("""
+    SELECT
+        hour::date AS day, sum(plays)::BIGINT
+    FROM
+        plays_by_hour
+    WHERE
+        (%(start)s IS NULL OR hour >= %(start)s) AND (%(end)s IS NULL OR hour < %(end)s)
+    GROUP BY
+        1
+    ORDER BY
+        1;
+""")
+
+plays_per_day_select = ("""
+    SELECT
+        start_time::date AS day, count(*)
+    FROM
+        songplays
+    WHERE
+        (%(start)s IS NULL OR start_time >= %(start)s) AND (%(end)s IS NULL OR start_time < %(end)s)
+    GROUP BY
+        1
+    ORDER BY
+        1;
+""")
+
+plays_per_user_rollup_select = ("""
+    SELECT
+        user_id, level, plays
+    FROM
+        plays_by_user
+    WHERE
+        %(level)s IS NULL OR level = %(level)s
+    ORDER BY
+        plays DESC, user_id, level
+    LIMIT %(limit)s;
+""")
+
+plays_per_user_select = ("""
+    SELECT
+        user_id, level, count(*) AS plays
+    FROM
+        songplays
+    WHERE
+        level IS NOT NULL AND (%(level)s IS NULL OR level = %(level)s)
+    GROUP BY
+        user_id, level
+    ORDER BY
+        plays DESC, user_id, level
+    LIMIT %(limit)s;
+""")
+
+top_songs_rollup_select = ("""
+    SELECT
+        plays_by_song.song_id, songs.title, plays_by_song.plays
+    FROM
+        plays_by_song
+        LEFT JOIN songs ON songs.song_id = plays_by_song.song_id
+    ORDER BY
+        plays_by_song.plays DESC, plays_by_song.song_id
+    LIMIT %(limit)s;
+""")
+
+top_songs_select = ("""
+    SELECT
+        plays.song_id, songs.title, plays.plays
+    FROM
+        (SELECT song_id, count(*) AS plays FROM songplays WHERE song_id IS NOT NULL GROUP BY song_id) plays
+        LEFT JOIN songs ON songs.song_id = plays.song_id
+    ORDER BY
+        plays.plays DESC, plays.song_id
+    LIMIT %(limit)s;
+""")
+
+top_artists_rollup_select = ("""
+    SELECT
+        plays_by_artist.artist_id, artists.name, plays_by_artist.plays
+    FROM
+        plays_by_artist
+        LEFT JOIN artists ON artists.artist_id = plays_by_artist.artist_id
+    ORDER BY
+        plays_by_artist.plays DESC, plays_by_artist.artist_id
+    LIMIT %(limit)s;
+""")
+
+top_artists_select = ("""
+    SELECT
+        plays.artist_id, artists.name, plays.plays
+    FROM
+        (SELECT artist_id, count(*) AS plays FROM songplays WHERE artist_id IS NOT NULL GROUP BY artist_id) plays
+        LEFT JOIN artists ON artists.artist_id = plays.artist_id
+    ORDER BY
+        plays.plays DESC, plays.artist_id
+    LIMIT %(limit)s;
+""")
+
+top_songs_select_surrogate = ("""
+    SELECT
+        songs.song_id, songs.title, plays.plays
+    FROM
+        (SELECT song_key, count(*) AS plays FROM songplays WHERE song_key IS NOT NULL GROUP BY song_key) plays
+        JOIN songs ON songs.song_key = plays.song_key
+    ORDER BY
+        plays.plays DESC, songs.song_id
+    LIMIT %(limit)s;
+""")
+
+top_artists_select_surrogate = ("""
+    SELECT
+        artists.artist_id, artists.name, plays.plays
+    FROM
+        (SELECT artist_key, count(*) AS plays FROM songplays WHERE artist_key IS NOT NULL GROUP BY artist_key) plays
+        JOIN artists ON artists.artist_key = plays.artist_key
+    ORDER BY
+        plays.plays DESC, artists.artist_id
+    LIMIT %(limit)s;
+""")
+
+# PARQUET EXPORT
+# rows come in partition order, partition columns last, with the column names of the data lake tables
+
+# songplay ids are drawn by inserts holding a ROW EXCLUSIVE lock on songplays, so once this lock is granted
+# no insert is in flight and every id up to the max is either committed or rolled back
+songplay_export_lock = "LOCK TABLE songplays IN SHARE MODE;"
+
+songplay_export_max_select = "SELECT coalesce(max(songplay_id), 0) FROM songplays;"
+
+# songplays inserted after the high-water mark `low`, up to `high`
+songplay_export_select = ("""
+    SELECT
+        songplay_id, start_time, user_id, level, song_id, artist_id, session_id, location, user_agent,
+        extract(year FROM start_time)::INT AS year, extract(month FROM start_time)::INT AS month
+    FROM
+        songplays
+    WHERE
+        songplay_id > %(low)s AND songplay_id <= %(high)s
+    ORDER BY
+        year, month, songplay_id;
+""")
+
+songplay_export_select_surrogate = ("""
+    SELECT
+        songplays.songplay_id, songplays.start_time, songplays.user_id, songplays.level, songs.song_id,
+        artists.artist_id, songplays.session_id, songplays.location, songplays.user_agent,
+        extract(year FROM songplays.start_time)::INT AS year, extract(month FROM songplays.start_time)::INT AS month
+    FROM
+        songplays
+        LEFT JOIN songs ON songs.song_key = songplays.song_key
+        LEFT JOIN artists ON artists.artist_key = songplays.artist_key
+    WHERE
+        songplays.songplay_id > %(low)s AND songplays.songplay_id <= %(high)s
+    ORDER BY
+        year, month, songplays.songplay_id;
+""")
+
+# time of the songplays exported with them, the ones of songplays exported earlier are skipped
+time_export_select = ("""
+    SELECT
+        start_time, hour, day, week, weekday, year, month
+    FROM
+        time
+    WHERE
+        start_time IN (SELECT start_time FROM songplays WHERE songplay_id > %(low)s AND songplay_id <= %(high)s)
+        AND NOT EXISTS (SELECT 1 FROM songplays WHERE songplays.start_time = time.start_time
+                                                      AND songplays.songplay_id <= %(low)s)
+    ORDER BY
+        year, month, start_time;
+""")
+
+user_export_select = ("""
+    SELECT
+        user_id, first_name, last_name, gender, level
+    FROM
+        users
+    ORDER BY
+        user_id;
+""")
+
+song_export_select = ("""
+    SELECT
+        song_id, title, duration, year, artist_id
+    FROM
+        songs
+    ORDER BY
+        year, artist_id, song_id;
+""")
+
+artist_export_select = ("""
+    SELECT
+        artist_id, name AS artist_name, location AS artist_location, latitude AS artist_latitude,
+        longitude AS artist_longitude
+    FROM
+        artists
+    ORDER BY
+        artist_id;
+""")
+
+# PARTITIONS
+
+songplay_partitioned_select = ("""
+    SELECT EXISTS (
+        SELECT 1
+        FROM
+            pg_partitioned_table
+            JOIN pg_class ON pg_class.oid = pg_partitioned_table.partrelid
+        WHERE
+            pg_class.relname = 'songplays' AND pg_class.relnamespace = 'public'::regnamespace
+    );
+""")
+
+songplay_partitions_select = ("""
+    SELECT
+        child.relname
+    FROM
+        pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+    WHERE
+        parent.relname = 'songplays' AND parent.relnamespace = 'public'::regnamespace;
+""")
+
 # QUERY LISTS
 
-create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
\ No newline at end of file
+rollup_table_create_queries = [plays_by_hour_table_create, plays_by_user_table_create, plays_by_song_table_create, plays_by_artist_table_create, rollup_state_table_create, rollup_state_insert]
+create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, manifest_table_create, songplay_unresolved_table_create, songplay_unresolved_index_create] + rollup_table_create_queries
+drop_table_queries = [songplay_table_drop, songplay_unresolved_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, manifest_table_drop, plays_by_hour_table_drop, plays_by_user_table_drop, plays_by_song_table_drop, plays_by_artist_table_drop, rollup_state_table_drop]
+create_table_queries_partitioned = [songplay_table_create_partitioned, user_table_create, song_table_create, artist_table_create, time_table_create, manifest_table_create, songplay_unresolved_table_create, songplay_unresolved_index_create] + rollup_table_create_queries
+create_table_queries_surrogate = [songplay_table_create_surrogate, user_table_create, song_table_create_surrogate, artist_table_create_surrogate, time_table_create, manifest_table_create, songplay_unresolved_table_create, songplay_unresolved_index_create] + rollup_table_create_queries
+rollup_rebuild_queries = [rollups_truncate, plays_by_hour_rebuild, plays_by_user_rebuild, plays_by_song_rebuild, plays_by_artist_rebuild, rollup_state_fresh]
+rollup_rebuild_queries_surrogate = [rollups_truncate, plays_by_hour_rebuild, plays_by_user_rebuild, plays_by_song_rebuild_surrogate, plays_by_artist_rebuild_surrogate, rollup_state_fresh]
+reset_queries = [tables_truncate, rollup_state_fresh]
+songplay_index_create_queries = [songplay_start_time_index_create, songplay_user_id_index_create, songplay_song_id_index_create]
+load_phase_queries = [songplay_index_drop, songplay_load_phase, user_load_phase, song_load_phase, artist_load_phase, time_load_phase, manifest_load_phase]
+finalize_queries = [songplay_dedup, user_dedup, song_dedup, artist_dedup, time_dedup, songplay_finalize, user_finalize, song_finalize, artist_finalize, time_finalize, manifest_finalize] + songplay_index_create_queries + rollup_rebuild_queries + [tables_analyze]
+create_staging_table_queries = [songplay_stage_create, user_stage_create, song_stage_create, artist_stage_create, time_stage_create]
@@ -0,0 +1,156 @@
+import threading
+import pandas as pd
+from sql_queries import song_keys_select, song_keys_find, artist_keys_select, artist_keys_find, surrogate_keys_select
+
+
+def has_surrogate_keys(cur):
+    """
+    Returns whether songplays table stores the surrogate keys of songs and artists instead of their natural ids.
+    """
+    cur.execute(surrogate_keys_select)
+    return bool(cur.fetchone()[0])
+
+
+class KeyMapping:
+    """
+    Cached mapping between the natural ids and the surrogate keys of a dimension table, in both directions.
+
+    Ids and keys missing from the cache are fetched from the table at once, then cached.
+
+    Attributes
+    ----------
+    hits        : integer
+                    Number of ids and keys found in the cache
+    misses      : integer
+                    Number of ids and keys fetched from the table
+    """
+
+    def __init__(self, select_query, find_query):
+        self.hits = 0
+        self.misses = 0
+        self._select_query = select_query
+        self._find_query = find_query
+        self._keys = {}
+        self._ids = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def load(self, cur):
+        """
+        Caches the whole mapping of the table.
+        """
+        cur.execute(self._select_query)
+        self._add(cur.fetchall())
+
+    def keys(self, cur, ids):
+        """
+        Returns the surrogate keys of a list of natural ids, None for None or unknown ids.
+        """
+        missing = {value for value in ids if value is not None and value not in self._keys}
+        self._count(len(ids), missing)
+        if missing:
+            cur.execute(self._find_query, (sorted(missing), []))
+            self._add(cur.fetchall())
+        return [self._keys.get(value) for value in ids]
+
+    def ids(self, cur, keys):
+        """
+        Returns the natural ids of a list of surrogate keys, None for None or unknown keys.
+        """
+        missing = {value for value in keys if value is not None and value not in self._ids}
+        self._count(len(keys), missing)
+        if missing:
+            cur.execute(self._find_query, ([], sorted(missing)))
+            self._add(cur.fetchall())
+        return [self._ids.get(value) for value in keys]
+
+    def _add(self, rows):
+        with self._lock:
+            for natural_id, key in rows:
+                self._keys[natural_id] = key
+                self._ids[key] = natural_id
+
+    def _count(self, total, missing):
+        with self._lock:
+            self.misses += len(missing)
+            self.hits += total - len(missing)
+
+
+class SurrogateKeys:
+    """
+    Cached mappings resolving the natural song_id and artist_id of songplays to the surrogate keys
+    of songs and artists tables, shared by every writer of a run.
+
+    Keys are assigned by the database when songs and artists are inserted, the mappings are loaded
+    once song data is processed and filled on demand afterwards.
+
+    Attributes
+    ----------
+    songs       : KeyMapping
+                    song_id to song_key mapping
+    artists     : KeyMapping
+                    artist_id to artist_key mapping
+    """
+
+    def __init__(self):
+        self.songs = KeyMapping(song_keys_select, song_keys_find)
+        self.artists = KeyMapping(artist_keys_select, artist_keys_find)
+
+    @classmethod
+    def detect(cls, cur):
+        """
+        Returns empty mappings if songplays table stores surrogate keys, None otherwise.
+
+        Parameters
+        ----------
+        cur         : Cursor object
+                        Cursor connected to postgreSQL session
+        """
+        return cls() if has_surrogate_keys(cur) else None
+
+    def load(self, cur):
+        """
+        Caches the mappings of all songs and artists loaded so far.
+        """
+        self.songs.load(cur)
+        self.artists.load(cur)
+
+    def translate(self, cur, matches):
+        """
+        Resolves natural ids to surrogate keys.
+
+        Parameters
+        ----------
+        cur         : Cursor object
+                        Cursor connected to postgreSQL session
+        matches     : DataFrame
+                        Records with song_id and artist_id columns, as resolved by the song lookup index
+
+        Returns
+        -------
+        DataFrame indexed like `matches` with song_key and artist_key columns, None when not found
+        """
+        return pd.DataFrame({
+            "song_key": self.songs.keys(cur, matches["song_id"].tolist()),
+            "artist_key": self.artists.keys(cur, matches["artist_id"].tolist()),
+        }, index=matches.index, dtype=object)
+
+    def naturalize(self, cur, rows):
+        """
+        Resolves the surrogate keys of (start_time, user_id, level, song_key, artist_key) rows,
+        as returned by songplays inserts, back to natural ids.
+        """
+        rows = list(rows)
+        song_ids = self.songs.ids(cur, [row[3] for row in rows])
+        artist_ids = self.artists.ids(cur, [row[4] for row in rows])
+        return [row[:3] + (song_id, artist_id) for row, song_id, artist_id in zip(rows, song_ids, artist_ids)]
+
+    def summary(self):
+        """
+        Returns the cache sizes and hit counts as a printable line.
+        """
+        return '{} songs and {} artists cached, {} hits, {} misses.'.format(
+            len(self.songs), len(self.artists), self.songs.hits + self.artists.hits,
+            self.songs.misses + self.artists.misses)
@@ -0,0 +1,108 @@
+import time
+import argparse
+from cql_queries import create_table_queries
+from cassandra_loader import TABLE_LOADS, ConcurrentLoader, read_events, event_values, load_table, fan_out_requests
+from fake_session import FakeSession, FakeBatchStatement
+
+
+def expected_rows(filepath, table, keys):
+    """
+    This function returns the rows a table should hold after loading the event data file, by primary key.
+    """
+    rows = {}
+    for line in read_events(filepath):
+        row = dict(zip(table.columns, event_values(line, table.columns)))
+        rows[tuple(row[column] for column in keys)] = row
+    return rows
+
+
+def load_synchronously(session, table, filepath):
+    """
+    This function loads a table the way the notebook does, waiting for every insert before sending the next one.
+    """
+    statement = session.prepare(table.insert)
+    start = time.perf_counter()
+    count = 0
+    for line in read_events(filepath):
+        session.execute(statement, event_values(line, table.columns))
+        count += 1
+    return count, time.perf_counter() - start
+
+
+def fake_session(latency, timeout_rate):
+    """
+    This function returns a FakeSession with the tables created.
+    """
+    session = FakeSession(latency, timeout_rate)
+    for query in create_table_queries:
+        session.execute(query)
+    return session
+
+
+def main():
+    """
+    Loads the event data file into a FakeSession synchronously, table by table with increasing concurrency levels
+    and in a single pass fanned out to all tables in per-partition batches, then prints the throughput of each
+    and checks that every table holds the expected rows.
+    """
+    parser = argparse.ArgumentParser(description='Measure the concurrent loader against an in-process fake session.')
+    parser.add_argument('--file', default='event_datafile_new.csv', help='event data file')
+    parser.add_argument('--latency', type=float, default=0.001, help='seconds every fake request takes')
+    parser.add_argument('--timeout-rate', type=float, default=0.01, help='share of the fake writes timing out')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 64, 256],
+                        help='concurrency levels to measure')
+    parser.add_argument('--batch-size', type=int, default=20, help='maximum number of rows of a partition batch')
+    args = parser.parse_args()
+
+    expected = {}
+    row_format = '{:<32} {:>14} {:8d} {:9d} {:12.0f} {:8d} {:9d} {:>8}'
+    print('{:<32} {:>14} {:>8} {:>9} {:>12} {:>8} {:>9} {:>8}'.format(
+        'table', 'concurrency', 'rows', 'requests', 'rows/sec', 'retries', 'in flight', 'correct'))
+
+    def correct(session, table, failed):
+        if table.name not in expected:
+            expected[table.name] = expected_rows(args.file, table, session.primary_key(table.name))
+        return not failed and session.rows(table.name) == expected[table.name]
+
+    # one pass over the file per table, one request per row
+    for concurrency in [None] + args.concurrency:
+        session = fake_session(args.latency, 0.0 if concurrency is None else args.timeout_rate)
+        loader = ConcurrentLoader(session, concurrency or 1)
+
+        for table in TABLE_LOADS:
+            if concurrency is None:
+                rows, seconds = load_synchronously(session, table, args.file)
+                retries, failed, requests = 0, [], rows
+            else:
+                result = load_table(loader, table, args.file)
+                rows, seconds, retries, failed, requests = (result.rows, result.seconds, result.retries,
+                                                            result.failed, result.requests)
+
+            print(row_format.format(table.name, 'sync' if concurrency is None else concurrency, rows, requests,
+                                    rows / seconds, retries, session.max_in_flight,
+                                    str(correct(session, table, failed))))
+        session.shutdown()
+
+    # a single pass over the file fanned out to all tables, in batches of one partition
+    for concurrency in args.concurrency:
+        session = fake_session(args.latency, args.timeout_rate)
+        loader = ConcurrentLoader(session, concurrency, batch_factory=FakeBatchStatement)
+        start = time.perf_counter()
+        results = loader.execute(fan_out_requests(loader, args.file, TABLE_LOADS, args.batch_size),
+                                 [table.name for table in TABLE_LOADS])
+        elapsed = time.perf_counter() - start
+
+        for table in TABLE_LOADS:
+            result = results[table.name]
+            print(row_format.format(table.name, 'fan-out {}'.format(concurrency), result.rows, result.requests,
+                                    result.rows / result.seconds, result.retries, session.max_in_flight,
+                                    str(correct(session, table, result.failed))))
+        rows = sum(result.rows for result in results.values())
+        print('{:<32} {:>14} {:8d} {:9d} {:12.0f} {:>8} {:>9} {:>8}'.format(
+            'all tables', 'fan-out {}'.format(concurrency), rows, session.requests, rows / elapsed, '', '',
+            'multi-partition batches: {}'.format(session.multi_partition_batches)))
+        session.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,494 @@
+import csv
+import time
+import argparse
+import threading
+import collections
+from collections import namedtuple
+from operator import itemgetter
+from cql_queries import *
+
+try:
+    from cassandra import OperationTimedOut, WriteTimeout
+    from cassandra.query import BatchStatement, BatchType
+except ImportError:
+    # without the driver only the fake session can be used, it raises these
+    class OperationTimedOut(Exception):
+        pass
+
+    class WriteTimeout(Exception):
+        pass
+
+    BatchStatement = BatchType = None
+
+
+# errors after which a write is sent again, inserts being idempotent
+TIMEOUT_ERRORS = (OperationTimedOut, WriteTimeout)
+
+# columns of event_datafile_new.csv
+EVENT_COLUMNS = dict(
+    artist=0,
+    user_first_name=1,
+    gender=2,
+    item_in_session=3,
+    user_last_name=4,
+    length=5,
+    level=6,
+    location=7,
+    session_id=8,
+    song_title=9,
+    user_id=10
+)
+
+# types of the event columns that are not text
+EVENT_TYPES = dict(item_in_session=int, length=float, session_id=int, user_id=int)
+
+# type of every column of an event data line, in file order
+EVENT_CONVERTERS = [EVENT_TYPES.get(column, str) for column in sorted(EVENT_COLUMNS, key=EVENT_COLUMNS.get)]
+
+# a table loaded from the event data file: its insert statement, the event columns bound to it
+# and its partition key
+TableLoad = namedtuple("TableLoad", ["name", "insert", "columns", "partition_key"])
+
+TABLE_LOADS = [
+    TableLoad('music_session_items', music_session_items_insert,
+              ['session_id', 'item_in_session', 'artist', 'song_title', 'length'], ['session_id']),
+    TableLoad('music_session_users', music_session_users_insert,
+              ['user_id', 'session_id', 'item_in_session', 'artist', 'song_title', 'user_first_name',
+               'user_last_name'], ['user_id', 'session_id']),
+    TableLoad('music_users_listened_to_song', music_users_listened_to_song_insert,
+              ['song_title', 'user_id', 'user_first_name', 'user_last_name'], ['song_title']),
+]
+
+# outcome of a load: rows written, writes sent again after a timeout, (values, error) of the rows not written,
+# seconds until the last write completed and requests sent, a batch being one request
+LoadResult = namedtuple("LoadResult", ["rows", "retries", "failed", "seconds", "requests"])
+
+# a write of rows of a table: a bound statement and its parameters, or a batch without parameters
+Request = namedtuple("Request", ["table", "statement", "parameters", "rows"])
+
+
+def unlogged_batch():
+    """
+    This function returns an empty unlogged batch of the driver.
+    """
+    return BatchStatement(batch_type=BatchType.UNLOGGED)
+
+
+def read_events(filepath):
+    """
+    This function yields the lines of the event data file, without its header.
+
+    Parameters
+    ----------
+    filepath    : string
+                    Path to event data file
+    """
+    with open(filepath, encoding='utf8', newline='') as f:
+        csvreader = csv.reader(f)
+        next(csvreader)
+        for line in csvreader:
+            yield line
+
+
+def event_values(line, columns):
+    """
+    This function returns the typed values of some columns of an event data line, in the order of `columns`.
+    """
+    return tuple(EVENT_TYPES.get(column, str)(line[EVENT_COLUMNS[column]]) for column in columns)
+
+
+def parse_event(line):
+    """
+    This function returns the typed values of all columns of an event data line, in file order.
+    """
+    return tuple(convert(value) for convert, value in zip(EVENT_CONVERTERS, line))
+
+
+def read_parsed_events(filepath):
+    """
+    This function yields the typed values of all columns of every line of the event data file, in file order.
+
+    A Parquet file written by consolidate_events.py is read by batches of typed columns, without parsing text,
+    other files are read as csv.
+
+    Parameters
+    ----------
+    filepath    : string
+                    Path to event data file, csv or Parquet
+    """
+    if filepath.endswith('.parquet'):
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(filepath).iter_batches():
+            yield from zip(*(column.to_pylist() for column in batch.columns))
+    else:
+        for line in read_events(filepath):
+            yield parse_event(line)
+
+
+class ConcurrentLoader:
+    """
+    Writes rows with prepared statements, keeping up to `concurrency` asynchronous requests in flight.
+
+    Each statement is prepared once per session. A write that times out is sent again after a backoff,
+    up to `retries` times, other errors are recorded with the row.
+
+    Parameters
+    ----------
+    session     : Session object
+                    Cassandra session, or a FakeSession
+    concurrency : integer
+                    Maximum number of requests in flight
+    retries     : integer
+                    Maximum number of times a write is sent again after a timeout
+    backoff     : float
+                    Seconds before the first retry of a write, doubled on every retry
+    retry_errors : tuple
+                    Exception types after which a write is sent again
+    batch_factory : function
+                    Returns an empty unlogged batch, a driver BatchStatement by default
+    """
+
+    def __init__(self, session, concurrency=64, retries=3, backoff=0.05, retry_errors=TIMEOUT_ERRORS,
+                 batch_factory=None):
+        self.session = session
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.retry_errors = retry_errors
+        self.batch_factory = batch_factory or unlogged_batch
+        self._prepared = {}
+        self._condition = threading.Condition()
+
+    def prepare(self, query):
+        """
+        Returns the prepared statement of a query, preparing it on first use.
+        """
+        if query not in self._prepared:
+            self._prepared[query] = self.session.prepare(query)
+        return self._prepared[query]
+
+    def load(self, query, rows):
+        """
+        Writes rows with a query and waits until every write succeeded or failed.
+
+        Parameters
+        ----------
+        query       : string
+                        Insert statement with `?` markers
+        rows        : iterable
+                        Tuples of values bound to the statement
+
+        Returns
+        -------
+        LoadResult
+        """
+        statement = self.prepare(query)
+        return self.execute((Request(None, statement, values, [values]) for values in rows), [None])[None]
+
+    def execute(self, requests, tables=()):
+        """
+        Sends requests and waits until every one succeeded or failed.
+
+        Parameters
+        ----------
+        requests    : iterable
+                        Request to send
+        tables      : iterable
+                        Names of the tables to report even if no request writes to them
+
+        Returns
+        -------
+        Dictionary of LoadResult by table name
+        """
+        requests = iter(requests)
+        counts = collections.defaultdict(lambda: dict(written=0, retried=0, requests=0, failed=[], finished=0.0))
+        for table in tables:
+            counts[table]
+        state = dict(in_flight=0, exhausted=False, start=time.perf_counter(), counts=counts)
+        pending = collections.deque()
+
+        while True:
+            with self._condition:
+                item = None
+                while item is None:
+                    if state['in_flight'] < self.concurrency:
+                        # writes to send again come first, in the order they timed out
+                        if pending and pending[0][0] <= time.perf_counter():
+                            item = pending.popleft()[1:]
+                            break
+                        if not state['exhausted']:
+                            request = next(requests, None)
+                            if request is not None:
+                                item = (request, 0)
+                                break
+                            state['exhausted'] = True
+                    if state['exhausted'] and not pending and not state['in_flight']:
+                        break
+                    self._condition.wait(max(0.0, pending[0][0] - time.perf_counter()) if pending else None)
+                if item is None:
+                    break
+                state['in_flight'] += 1
+                counts[item[0].table]['requests'] += 1
+
+            request, attempt = item
+            future = self.session.execute_async(request.statement, request.parameters)
+            future.add_callbacks(self._written, self._failed, callback_args=(state, request),
+                                 errback_args=(state, pending, request, attempt))
+
+        return {table: LoadResult(count['written'], count['retried'], count['failed'], count['finished'],
+                                  count['requests'])
+                for table, count in counts.items()}
+
+    def _written(self, result, state, request):
+        with self._condition:
+            state['in_flight'] -= 1
+            count = state['counts'][request.table]
+            count['written'] += len(request.rows)
+            count['finished'] = time.perf_counter() - state['start']
+            self._condition.notify()
+
+    def _failed(self, error, state, pending, request, attempt):
+        with self._condition:
+            state['in_flight'] -= 1
+            count = state['counts'][request.table]
+            if isinstance(error, self.retry_errors) and attempt < self.retries:
+                count['retried'] += 1
+                pending.append((time.perf_counter() + self.backoff * 2 ** attempt, request, attempt + 1))
+            else:
+                count['failed'].extend((values, error) for values in request.rows)
+                count['finished'] = time.perf_counter() - state['start']
+            self._condition.notify()
+
+
+class PartitionBatcher:
+    """
+    Groups the rows of a table by partition key into requests of up to `batch_size` rows of one partition,
+    so that every request goes to the replicas of a single partition.
+
+    Several rows are written as an unlogged batch, a single row as a bound statement. At most `max_buffered`
+    rows are held, all partitions are flushed when it is reached.
+
+    Parameters
+    ----------
+    loader      : ConcurrentLoader
+                    Loader preparing the insert and building the batches
+    table       : TableLoad
+                    Table of the rows
+    batch_size  : integer
+                    Maximum number of rows of a batch
+    max_buffered : integer
+                    Maximum number of rows held before all partitions are flushed
+    """
+
+    def __init__(self, loader, table, batch_size=20, max_buffered=5000):
+        self.loader = loader
+        self.table = table
+        self.batch_size = batch_size
+        self.max_buffered = max_buffered
+        self.statement = loader.prepare(table.insert)
+        self.partition_key = itemgetter(*[table.columns.index(column) for column in table.partition_key])
+        self._partitions = {}
+        self._buffered = 0
+
+    def add(self, values):
+        """
+        Adds a row, yielding the requests of the partitions that are full.
+        """
+        key = self.partition_key(values)
+        rows = self._partitions.setdefault(key, [])
+        rows.append(values)
+        self._buffered += 1
+        if len(rows) >= self.batch_size:
+            del self._partitions[key]
+            self._buffered -= len(rows)
+            yield self._request(rows)
+        if self._buffered >= self.max_buffered:
+            yield from self.flush()
+
+    def flush(self):
+        """
+        Yields the requests of all partitions held.
+        """
+        partitions, self._partitions, self._buffered = self._partitions, {}, 0
+        for rows in partitions.values():
+            yield self._request(rows)
+
+    def _request(self, rows):
+        if len(rows) == 1:
+            return Request(self.table.name, self.statement, rows[0], rows)
+        batch = self.loader.batch_factory()
+        for values in rows:
+            batch.add(self.statement, values)
+        return Request(self.table.name, batch, None, rows)
+
+
+def fan_out_requests(loader, filepath, tables=TABLE_LOADS, batch_size=20, max_buffered=5000):
+    """
+    This function parses every line of the event data file, csv or Parquet, once and yields the requests writing it
+    to every table, grouped by partition.
+
+    Parameters
+    ----------
+    loader      : ConcurrentLoader
+                    Loader preparing the inserts and building the batches
+    filepath    : string
+                    Path to event data file
+    tables      : list
+                    TableLoad of the tables to load
+    batch_size  : integer
+                    Maximum number of rows of a batch
+    max_buffered : integer
+                    Maximum number of rows held per table before its partitions are flushed
+    """
+    batchers = [(itemgetter(*[EVENT_COLUMNS[column] for column in table.columns]),
+                 PartitionBatcher(loader, table, batch_size, max_buffered)) for table in tables]
+    for event in read_parsed_events(filepath):
+        for select, batcher in batchers:
+            yield from batcher.add(select(event))
+    for select, batcher in batchers:
+        yield from batcher.flush()
+
+
+def load_table(loader, table, filepath):
+    """
+    This function loads the event data file into a table.
+
+    Parameters
+    ----------
+    loader      : ConcurrentLoader
+                    Loader writing the rows
+    table       : TableLoad
+                    Table to load
+    filepath    : string
+                    Path to event data file
+
+    Returns
+    -------
+    LoadResult
+    """
+    select = itemgetter(*[EVENT_COLUMNS[column] for column in table.columns])
+    return loader.load(table.insert, (select(event) for event in read_parsed_events(filepath)))
+
+
+def print_results(results):
+    """
+    This function prints the rows, requests, write throughput, retries and failures of every table.
+    """
+    for table, result in results.items():
+        print('{}: {} rows written in {} requests in {:.2f}s ({:.0f} rows/sec), {} retries, {} failed.'.format(
+            table, result.rows, result.requests, result.seconds, result.rows / result.seconds if result.seconds else 0,
+            result.retries, len(result.failed)))
+        for values, error in result.failed[:5]:
+            print('    {}: {}'.format(values, error))
+
+
+def load_event_file(session, filepath='event_datafile_new.csv', tables=TABLE_LOADS, concurrency=64, retries=3):
+    """
+    This function loads the event data file into every table, one pass over the file per table,
+    printing the throughput of each.
+
+    Parameters
+    ----------
+    session     : Session object
+                    Cassandra session, or a FakeSession, with the keyspace set
+    filepath    : string
+                    Path to event data file
+    tables      : list
+                    TableLoad of the tables to load
+    concurrency : integer
+                    Maximum number of requests in flight
+    retries     : integer
+                    Maximum number of times a write is sent again after a timeout
+
+    Returns
+    -------
+    Dictionary of LoadResult by table name
+    """
+    loader = ConcurrentLoader(session, concurrency, retries)
+    results = {}
+    for table in tables:
+        result = load_table(loader, table, filepath)
+        results[table.name] = result
+        print_results({table.name: result})
+    return results
+
+
+def fan_out_event_file(session, filepath='event_datafile_new.csv', tables=TABLE_LOADS, concurrency=64, retries=3,
+                       batch_size=20, max_buffered=5000, batch_factory=None):
+    """
+    This function loads the event data file into every table in a single pass, every line being parsed once
+    and written to all tables in per-partition unlogged batches, printing the throughput of each table.
+
+    Parameters
+    ----------
+    session     : Session object
+                    Cassandra session, or a FakeSession, with the keyspace set
+    filepath    : string
+                    Path to event data file
+    tables      : list
+                    TableLoad of the tables to load
+    concurrency : integer
+                    Maximum number of requests in flight
+    retries     : integer
+                    Maximum number of times a write is sent again after a timeout
+    batch_size  : integer
+                    Maximum number of rows of a batch
+    max_buffered : integer
+                    Maximum number of rows held per table before its partitions are flushed
+    batch_factory : function
+                    Returns an empty unlogged batch, a driver BatchStatement by default
+
+    Returns
+    -------
+    Dictionary of LoadResult by table name
+    """
+    loader = ConcurrentLoader(session, concurrency, retries, batch_factory=batch_factory)
+    start = time.perf_counter()
+    results = loader.execute(fan_out_requests(loader, filepath, tables, batch_size, max_buffered),
+                             [table.name for table in tables])
+    print_results(results)
+    rows = sum(result.rows for result in results.values())
+    elapsed = time.perf_counter() - start
+    print('{} rows written in {:.2f}s ({:.0f} rows/sec).'.format(rows, elapsed, rows / elapsed if elapsed else 0))
+    return results
+
+
+def main():
+    """
+    Creates the keyspace and tables on a Cassandra cluster and loads the event data file into them.
+    """
+    parser = argparse.ArgumentParser(description='Load event_datafile_new.csv into the Cassandra tables.')
+    parser.add_argument('--hosts', nargs='+', default=['127.0.0.1'], help='contact points of the cluster')
+    parser.add_argument('--file', default='event_datafile_new.csv',
+                        help='event data file, csv or Parquet written by consolidate_events.py')
+    parser.add_argument('--concurrency', type=int, default=64, help='maximum number of requests in flight')
+    parser.add_argument('--retries', type=int, default=3, help='maximum number of retries of a timed out write')
+    parser.add_argument('--per-table', action='store_true',
+                        help='read the file once per table and write rows one by one instead of fanning out')
+    parser.add_argument('--batch-size', type=int, default=20, help='maximum number of rows of a partition batch')
+    parser.add_argument('--max-buffered', type=int, default=5000,
+                        help='maximum number of rows held per table before its partitions are flushed')
+    args = parser.parse_args()
+
+    from cassandra.cluster import Cluster
+    cluster = Cluster(args.hosts)
+    session = cluster.connect()
+
+    session.execute(keyspace_create)
+    session.set_keyspace('udacity')
+    for query in create_table_queries:
+        session.execute(query)
+
+    if args.per_table:
+        load_event_file(session, args.file, concurrency=args.concurrency, retries=args.retries)
+    else:
+        fan_out_event_file(session, args.file, concurrency=args.concurrency, retries=args.retries,
+                           batch_size=args.batch_size, max_buffered=args.max_buffered)
+
+    session.shutdown()
+    cluster.shutdown()
+
+
+if __name__ == "__main__":
+    main()
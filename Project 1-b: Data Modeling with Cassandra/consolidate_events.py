@@ -0,0 +1,238 @@
+import os
+import csv
+import glob
+import time
+import argparse
+import itertools
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+
+# columns of event_datafile_new.csv and their positions in the event data files
+EVENT_FILE_COLUMNS = collections.OrderedDict([
+    ('artist', 0),
+    ('firstName', 2),
+    ('gender', 3),
+    ('itemInSession', 4),
+    ('lastName', 5),
+    ('length', 6),
+    ('level', 7),
+    ('location', 8),
+    ('sessionId', 12),
+    ('song', 13),
+    ('userId', 16),
+])
+
+# types of the columns that are not text, in the columnar output
+EVENT_FILE_TYPES = dict(itemInSession=int, length=float, sessionId=int, userId=int)
+
+csv.register_dialect('myDialect', quoting=csv.QUOTE_ALL, skipinitialspace=True)
+
+
+def list_event_files(directory):
+    """
+    This function returns the paths of the event csv files of a directory and its subdirectories, sorted by name
+    so that the consolidated file is the same on every run.
+
+    Parameters
+    ----------
+    directory   : string
+                    Path to event data directory
+    """
+    return sorted(glob.glob(os.path.join(directory, '**', '*.csv'), recursive=True))
+
+
+def read_event_file(filepath):
+    """
+    This function reads an event csv file and returns its song plays, the lines with an artist,
+    with the columns of event_datafile_new.csv.
+
+    Parameters
+    ----------
+    filepath    : string
+                    Path to event csv file
+    """
+    positions = list(EVENT_FILE_COLUMNS.values())
+    with open(filepath, 'r', encoding='utf8', newline='') as f:
+        csvreader = csv.reader(f)
+        next(csvreader)
+        return [[line[position] for position in positions] for line in csvreader if line[0] != '']
+
+
+def consolidated_rows(filepaths, workers=1):
+    """
+    This function yields the song plays of the event csv files, file after file in the order of `filepaths`.
+
+    With more than one worker the files are read by a process pool, keeping a bounded window of files in flight,
+    so at most about `workers * 2` files are held in memory.
+
+    Parameters
+    ----------
+    filepaths   : list
+                    Paths to event csv files
+    workers     : integer
+                    Number of processes reading files, 1 to read them in this process
+    """
+    if workers <= 1:
+        for filepath in filepaths:
+            yield from read_event_file(filepath)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        files = iter(filepaths)
+        pending = collections.deque(executor.submit(read_event_file, filepath)
+                                    for filepath in itertools.islice(files, workers * 2))
+        while pending:
+            rows = pending.popleft().result()
+            for filepath in itertools.islice(files, 1):
+                pending.append(executor.submit(read_event_file, filepath))
+            yield from rows
+
+
+class CsvEventWriter:
+    """
+    Writes song plays to event_datafile_new.csv, quoting every value like the notebook.
+
+    Parameters
+    ----------
+    filepath    : string
+                    Path to the csv file written
+    """
+
+    def __init__(self, filepath):
+        self.file = open(filepath, 'w', encoding='utf8', newline='')
+        self.writer = csv.writer(self.file, dialect='myDialect')
+        self.writer.writerow(list(EVENT_FILE_COLUMNS))
+
+    def write(self, row):
+        self.writer.writerow(row)
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetEventWriter:
+    """
+    Writes song plays to a Parquet file with typed columns, in row groups of up to `row_group_size` rows,
+    so the loaders can read them without parsing csv text.
+
+    Parameters
+    ----------
+    filepath    : string
+                    Path to the Parquet file written
+    row_group_size : integer
+                    Maximum number of rows of a row group, held in memory until written
+    """
+
+    def __init__(self, filepath, row_group_size=50000):
+        # pyarrow is only needed for the columnar output
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        types = {int: pa.int32(), float: pa.float64()}
+        self.schema = pa.schema([(column, types.get(EVENT_FILE_TYPES.get(column), pa.string()))
+                                 for column in EVENT_FILE_COLUMNS])
+        self.converters = [EVENT_FILE_TYPES.get(column, str) for column in EVENT_FILE_COLUMNS]
+        self.row_group_size = row_group_size
+        self.writer = pq.ParquetWriter(filepath, self.schema)
+        self.columns = [[] for column in EVENT_FILE_COLUMNS]
+
+    def write(self, row):
+        for values, convert, value in zip(self.columns, self.converters, row):
+            values.append(convert(value) if value != '' else None)
+        if len(self.columns[0]) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if self.columns[0]:
+            self.writer.write_batch(self.pa.RecordBatch.from_arrays(
+                [self.pa.array(values, type=field.type) for values, field in zip(self.columns, self.schema)],
+                schema=self.schema))
+            self.columns = [[] for column in EVENT_FILE_COLUMNS]
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def consolidate(filepaths, csv_path='event_datafile_new.csv', parquet_path=None, workers=1, row_group_size=50000):
+    """
+    This function streams the song plays of the event csv files into event_datafile_new.csv and optionally
+    a Parquet file, writing every row as it is read instead of holding all of them in memory.
+
+    Outputs are written to hidden temporary files renamed once complete, so an interrupted run leaves
+    the previous files in place.
+
+    Parameters
+    ----------
+    filepaths   : list
+                    Paths to event csv files, read in this order
+    csv_path    : string
+                    Path to the csv file written, None to skip it
+    parquet_path : string
+                    Path to the Parquet file written, None to skip it
+    workers     : integer
+                    Number of processes reading files
+    row_group_size : integer
+                    Maximum number of rows of a Parquet row group
+
+    Returns
+    -------
+    Number of rows written
+    """
+    outputs = []
+    if csv_path is not None:
+        outputs.append((csv_path, CsvEventWriter))
+    if parquet_path is not None:
+        outputs.append((parquet_path, lambda filepath: ParquetEventWriter(filepath, row_group_size)))
+
+    targets = [(path, os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.tmp'))
+               for path, _ in outputs]
+    writers = []
+    try:
+        for (path, tmp), (_, writer) in zip(targets, outputs):
+            writers.append(writer(tmp))
+
+        count = 0
+        for row in consolidated_rows(filepaths, workers):
+            for writer in writers:
+                writer.write(row)
+            count += 1
+
+        for writer in writers:
+            writer.close()
+        writers = []
+        for path, tmp in targets:
+            os.replace(tmp, path)
+        return count
+    finally:
+        for writer in writers:
+            writer.close()
+        for path, tmp in targets:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
+def main():
+    """
+    Consolidates the event csv files into event_datafile_new.csv and optionally a Parquet file.
+    """
+    parser = argparse.ArgumentParser(description='Consolidate the event csv files into event_datafile_new.csv.')
+    parser.add_argument('--event-data', default='event_data', help='directory of the event csv files')
+    parser.add_argument('--csv', default='event_datafile_new.csv', help='csv file written')
+    parser.add_argument('--no-csv', action='store_true', help='do not write the csv file')
+    parser.add_argument('--parquet', help='Parquet file also written, e.g. event_datafile_new.parquet')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes reading files')
+    parser.add_argument('--row-group-size', type=int, default=50000,
+                        help='maximum number of rows of a Parquet row group')
+    args = parser.parse_args()
+
+    filepaths = list_event_files(args.event_data)
+    start = time.perf_counter()
+    count = consolidate(filepaths, None if args.no_csv else args.csv, args.parquet, args.workers, args.row_group_size)
+    print('{} rows of {} files consolidated in {:.2f}s.'.format(count, len(filepaths), time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+# KEYSPACE
+
+keyspace_create = ("""
+    CREATE KEYSPACE IF NOT EXISTS udacity
+    WITH REPLICATION =
+    { 'class' : 'SimpleStrategy', 'replication_factor' : 1 }
+""")
+
+# DROP TABLES
+
+music_session_items_table_drop = "DROP TABLE IF EXISTS music_session_items"
+music_session_users_table_drop = "DROP TABLE IF EXISTS music_session_users"
+music_users_listened_to_song_table_drop = "DROP TABLE IF EXISTS music_users_listened_to_song"
+
+# CREATE TABLES
+
+# query 1: artist, song title and song length of an item of a session
+music_session_items_table_create = ("""
+    CREATE TABLE IF NOT EXISTS music_session_items (
+        session_id INT,
+        item_in_session INT,
+        artist TEXT,
+        song_title TEXT,
+        length FLOAT,
+        PRIMARY KEY (session_id, item_in_session)
+    )
+""")
+
+# query 2: artist, song title and user name of the items of a user session, sorted by item
+music_session_users_table_create = ("""
+    CREATE TABLE IF NOT EXISTS music_session_users (
+        user_id INT,
+        session_id INT,
+        item_in_session INT,
+        artist TEXT,
+        song_title TEXT,
+        user_first_name TEXT,
+        user_last_name TEXT,
+        PRIMARY KEY ((user_id, session_id), item_in_session)
+    )
+""")
+
+# query 3: names of the users who listened to a song
+music_users_listened_to_song_table_create = ("""
+    CREATE TABLE IF NOT EXISTS music_users_listened_to_song (
+        song_title TEXT,
+        user_id INT,
+        user_first_name TEXT,
+        user_last_name TEXT,
+        PRIMARY KEY (song_title, user_id)
+    )
+""")
+
+# INSERT RECORDS
+# prepared once and bound to every row
+
+music_session_items_insert = ("""
+    INSERT INTO music_session_items (session_id, item_in_session, artist, song_title, length)
+    VALUES (?, ?, ?, ?, ?)
+""")
+
+music_session_users_insert = ("""
+    INSERT INTO music_session_users (user_id, session_id, item_in_session, artist, song_title, user_first_name,
+                                     user_last_name)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+""")
+
+music_users_listened_to_song_insert = ("""
+    INSERT INTO music_users_listened_to_song (song_title, user_id, user_first_name, user_last_name)
+    VALUES (?, ?, ?, ?)
+""")
+
+# SELECT RECORDS
+
+music_session_items_select = ("""
+    SELECT artist, song_title, length
+    FROM music_session_items
+    WHERE session_id = %s AND item_in_session = %s
+""")
+
+music_session_users_select = ("""
+    SELECT artist, song_title, user_first_name, user_last_name
+    FROM music_session_users
+    WHERE user_id = %s AND session_id = %s
+""")
+
+music_users_listened_to_song_select = ("""
+    SELECT user_first_name, user_last_name
+    FROM music_users_listened_to_song
+    WHERE song_title = %s
+""")
+
+# QUERY LISTS
+
+create_table_queries = [music_session_items_table_create, music_session_users_table_create, music_users_listened_to_song_table_create]
+drop_table_queries = [music_session_items_table_drop, music_session_users_table_drop, music_users_listened_to_song_table_drop]
@@ -0,0 +1,211 @@
+import re
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from cassandra_loader import WriteTimeout
+
+
+class FakePreparedStatement:
+    """
+    Prepared INSERT statement of a FakeSession.
+
+    Attributes
+    ----------
+    query       : string
+                    Prepared query
+    table       : string
+                    Table inserted into
+    columns     : list
+                    Columns bound to the markers, in order
+    """
+
+    def __init__(self, query):
+        match = re.search(r'INSERT\s+INTO\s+(\w+)\s*\(([^)]*)\)\s*VALUES', query, re.IGNORECASE)
+        if match is None:
+            raise ValueError('only INSERT statements can be prepared: {}'.format(query))
+        self.query = query
+        self.table = match.group(1)
+        self.columns = [column.strip() for column in match.group(2).split(',')]
+
+
+class FakeBatchStatement:
+    """
+    Unlogged batch of a FakeSession, with the `add` method of the driver BatchStatement.
+
+    Attributes
+    ----------
+    entries     : list
+                    (prepared statement, parameters) of the batch, in order
+    """
+
+    def __init__(self):
+        self.entries = []
+
+    def add(self, statement, parameters=None):
+        self.entries.append((statement, parameters))
+
+
+class FakeResponseFuture:
+    """
+    Result of FakeSession.execute_async, with the callback API of the driver ResponseFuture.
+    """
+
+    def __init__(self, future):
+        self._future = future
+
+    def result(self):
+        return self._future.result()
+
+    def add_callbacks(self, callback, errback, callback_args=(), callback_kwargs=None, errback_args=(),
+                      errback_kwargs=None):
+        def done(future):
+            error = future.exception()
+            if error is None:
+                callback(future.result(), *callback_args, **(callback_kwargs or {}))
+            else:
+                errback(error, *errback_args, **(errback_kwargs or {}))
+        self._future.add_done_callback(done)
+
+
+class FakeSession:
+    """
+    In-process stand-in for a Cassandra session to measure and check loaders without a live node.
+
+    Tables are dictionaries of rows by primary key, so inserting an existing key overwrites it like an upsert.
+    Every request, a single insert or a FakeBatchStatement, waits `latency` seconds on a worker thread,
+    like a network round trip, and a share `timeout_rate` of the requests raise WriteTimeout, half of them
+    after being applied, as a coordinator timing out may have written the rows anyway.
+
+    Parameters
+    ----------
+    latency     : float
+                    Seconds every request takes
+    timeout_rate : float
+                    Share of the writes timing out
+    seed        : integer
+                    Seed of the timeouts
+    max_workers : integer
+                    Maximum number of requests served at once
+
+    Attributes
+    ----------
+    tables      : dictionary
+                    Rows by primary key of every table
+    requests    : integer
+                    Number of requests received
+    timeouts    : integer
+                    Number of requests that timed out
+    batches     : integer
+                    Number of batches received
+    multi_partition_batches : integer
+                    Number of batches writing to more than one partition
+    max_in_flight : integer
+                    Maximum number of requests in flight at once
+    """
+
+    def __init__(self, latency=0.001, timeout_rate=0.0, seed=0, max_workers=512):
+        self.latency = latency
+        self.timeout_rate = timeout_rate
+        self.tables = {}
+        self.requests = 0
+        self.timeouts = 0
+        self.batches = 0
+        self.multi_partition_batches = 0
+        self.max_in_flight = 0
+        self._keys = {}
+        self._partition_keys = {}
+        self._in_flight = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def set_keyspace(self, keyspace):
+        pass
+
+    def prepare(self, query):
+        return FakePreparedStatement(query)
+
+    def execute(self, query, parameters=None):
+        """
+        Runs a request synchronously: CREATE and DROP TABLE, other DDL is ignored, and prepared inserts.
+        """
+        if isinstance(query, FakePreparedStatement):
+            return self.execute_async(query, parameters).result()
+
+        create = re.search(r'CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)', query, re.IGNORECASE)
+        drop = re.search(r'DROP\s+TABLE\s+(?:IF\s+EXISTS\s+)?(\w+)', query, re.IGNORECASE)
+        if create:
+            key = re.search(r'PRIMARY\s+KEY\s*\((.*)\)', query, re.IGNORECASE | re.DOTALL).group(1).strip()
+            self._keys[create.group(1)] = re.findall(r'\w+', key)
+            # a composite partition key is in parentheses, otherwise it is the first column
+            partition_key = re.match(r'\(([^)]*)\)', key)
+            self._partition_keys[create.group(1)] = re.findall(r'\w+', partition_key.group(1)) if partition_key \
+                else self._keys[create.group(1)][:1]
+            self.tables.setdefault(create.group(1), {})
+        elif drop:
+            self._keys.pop(drop.group(1), None)
+            self._partition_keys.pop(drop.group(1), None)
+            self.tables.pop(drop.group(1), None)
+
+    def execute_async(self, statement, parameters=None):
+        """
+        Sends a prepared insert or a FakeBatchStatement, returning a FakeResponseFuture.
+        """
+        with self._lock:
+            self.requests += 1
+            if isinstance(statement, FakeBatchStatement):
+                self.batches += 1
+                partitions = {(entry.table, self._partition_key(entry, values)) for entry, values in statement.entries}
+                self.multi_partition_batches += len(partitions) > 1
+            self._in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self._in_flight)
+            timeout = self._random.random() < self.timeout_rate
+            applied = not timeout or self._random.random() < 0.5
+        return FakeResponseFuture(self._executor.submit(self._write, statement, parameters, timeout, applied))
+
+    def rows(self, table):
+        """
+        Returns the rows of a table as dictionaries, by primary key.
+        """
+        return self.tables[table]
+
+    def primary_key(self, table):
+        """
+        Returns the primary key columns of a table, partition key first.
+        """
+        return self._keys[table]
+
+    def partition_key(self, table):
+        """
+        Returns the partition key columns of a table.
+        """
+        return self._partition_keys[table]
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+    def _partition_key(self, statement, parameters):
+        row = dict(zip(statement.columns, parameters))
+        return tuple(row[column] for column in self._partition_keys[statement.table])
+
+    def _write(self, statement, parameters, timeout, applied):
+        time.sleep(self.latency)
+        try:
+            entries = statement.entries if isinstance(statement, FakeBatchStatement) else [(statement, parameters)]
+            rows = []
+            for entry, values in entries:
+                row = dict(zip(entry.columns, values))
+                rows.append((entry.table, tuple(row[column] for column in self._keys[entry.table]), row))
+            if applied:
+                # a batch of one partition is applied as a whole
+                with self._lock:
+                    for table, key, row in rows:
+                        self.tables[table][key] = row
+            if timeout:
+                with self._lock:
+                    self.timeouts += 1
+                raise WriteTimeout('fake write timeout on {}'.format(rows[0][0]))
+        finally:
+            with self._lock:
+                self._in_flight -= 1
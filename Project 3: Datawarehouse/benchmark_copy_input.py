@@ -0,0 +1,145 @@
+import os
+import gzip
+import json
+import time
+import argparse
+import datetime
+import tempfile
+import collections
+import psycopg2
+import psycopg2.extras
+from table_specs import create_table, staging_events_spec, staging_songs_spec
+from prepare_copy_input import list_json_files, read_json_records, staging_row, format_timestamp, prepare_table, EPOCH
+from benchmark_scheduler import DSN, SCHEMA, standin_dsn
+
+
+# sample data of Project 1-a, in the layout of the S3 buckets
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_LOG_DATA = os.path.join(ROOT, 'Project 1-a: Data Modeling with Postgres', 'data', 'log_data')
+SAMPLE_SONG_DATA = os.path.join(ROOT, 'Project 1-a: Data Modeling with Postgres', 'data', 'song_data')
+
+# S3 prefix written in the manifests, mapped back to the output directory to read the shards locally
+PREFIX = 's3://sparkify-copy-input'
+
+
+def manifest_paths(output, table):
+    """
+    This function returns the local paths of the shards listed by the manifest of a table, and their sizes
+    checked against the content length of the manifest.
+    """
+    with open(os.path.join(output, table + '.manifest')) as f:
+        entries = json.load(f)['entries']
+    paths = [os.path.join(output, entry['url'][len(PREFIX) + 1:]) for entry in entries]
+    for path, entry in zip(paths, entries):
+        if os.path.getsize(path) != entry['meta']['content_length']:
+            raise ValueError('content length of {} does not match its manifest'.format(path))
+    return paths
+
+
+def table_fingerprint(cur, table):
+    """
+    This function returns the number of rows and a hash of the sorted rows of a table.
+    """
+    cur.execute("SELECT count(*), md5(string_agg(t::text, '|' ORDER BY t::text)) FROM {} t".format(table))
+    return cur.fetchone()
+
+
+def copy_csv_shards(cur, spec, paths):
+    """
+    This function copies gzip compressed csv shards into a staging table the way Redshift COPY reads them,
+    and returns the wall time in seconds.
+    """
+    start = time.perf_counter()
+    for path in paths:
+        with gzip.open(path, 'rt', encoding='utf8') as f:
+            cur.copy_expert("COPY {} FROM STDIN WITH (FORMAT csv, NULL '\\N')".format(spec.name), f)
+    return time.perf_counter() - start
+
+
+def parquet_rows(paths):
+    """
+    This function returns the rows of Parquet shards.
+    """
+    import pyarrow.parquet as pq
+
+    rows = []
+    for path in paths:
+        table = pq.read_table(path)
+        rows.extend(zip(*[column.to_pylist() for column in table.columns]))
+    return rows
+
+
+def main():
+    """
+    Converts log and song json files into csv and Parquet shards on local disk, prints the rows and sizes
+    of the shards, then checks that the csv shards copied into the Postgres stand-in and the rows
+    of the Parquet shards are the rows of the json files.
+    """
+    parser = argparse.ArgumentParser(description='Convert json files into COPY shards on local disk '
+                                                 'and check their rows against the json files.')
+    parser.add_argument('--dsn', default=DSN, help='connection string of the local Postgres database')
+    parser.add_argument('--log-data', default=SAMPLE_LOG_DATA, help='directory of the log json files')
+    parser.add_argument('--song-data', default=SAMPLE_SONG_DATA, help='directory of the song json files')
+    parser.add_argument('--output', help='directory the shards are written to, a temporary one by default')
+    parser.add_argument('--slices', type=int, default=8, help='number of shards of every table')
+    args = parser.parse_args()
+
+    output = args.output or tempfile.mkdtemp(prefix='copy_input_')
+    dsn = standin_dsn(args.dsn)
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+    cur.execute('CREATE SCHEMA IF NOT EXISTS {}'.format(SCHEMA))
+
+    print('{:<15} {:<8} {:>6} {:>9} {:>12} {:>21} {:>9}'.format(
+        'table', 'format', 'files', 'rows', 'bytes', 'shard bytes', 'seconds'))
+    same = True
+    for directory, spec in [(args.log_data, staging_events_spec), (args.song_data, staging_songs_spec)]:
+        filepaths = list_json_files(directory)
+        source = [staging_row(record, spec) for record in read_json_records(filepaths)]
+        print('{:<15} {:<8} {:6d} {:9d} {:12d} {:>21} {:>9}'.format(
+            spec.name, 'json', len(filepaths), len(source), sum(os.path.getsize(path) for path in filepaths), '', ''))
+        timestamps = [column.type == 'TIMESTAMP' for column in spec.columns]
+
+        for file_format in ['csv', 'parquet']:
+            format_output = os.path.join(output, file_format)
+            start = time.perf_counter()
+            result = prepare_table(filepaths, spec, format_output, PREFIX, args.slices, file_format)
+            seconds = time.perf_counter() - start
+            sizes = [shard['bytes'] for shard in result['shards']]
+            print('{:<15} {:<8} {:6d} {:9d} {:12d} {:>21} {:9.2f}'.format(
+                spec.name, file_format, len(sizes), result['rows'], sum(sizes),
+                '{} - {}'.format(min(sizes), max(sizes)), seconds))
+            paths = manifest_paths(format_output, spec.name)
+
+            if file_format == 'csv':
+                # the json rows inserted one by one, then the shards copied, into the same staging table
+                cur.execute('DROP TABLE IF EXISTS {}'.format(spec.name))
+                cur.execute(create_table(spec, 'postgres'))
+                psycopg2.extras.execute_values(cur, 'INSERT INTO {} VALUES %s'.format(spec.name), [
+                    [format_timestamp(value) if timestamp and value is not None else value
+                     for value, timestamp in zip(row, timestamps)] for row in source])
+                expected = table_fingerprint(cur, spec.name)
+                cur.execute('TRUNCATE {}'.format(spec.name))
+                copy_seconds = copy_csv_shards(cur, spec, paths)
+                copied = table_fingerprint(cur, spec.name)
+                print('{:<15} {:<8} {:>6} {:9d} {:>12} {:>21} {:9.2f}'.format(
+                    spec.name, 'copied', '', copied[0], '', 'same rows: {}'.format(copied == expected),
+                    copy_seconds))
+                same = same and copied == expected
+                conn.rollback()
+            else:
+                expected = collections.Counter(
+                    tuple(EPOCH + datetime.timedelta(milliseconds=value) if timestamp and value is not None else value
+                          for value, timestamp in zip(row, timestamps)) for row in source)
+                read = collections.Counter(parquet_rows(paths))
+                print('{:<15} {:<8} {:>6} {:9d} {:>12} {:>21} {:>9}'.format(
+                    spec.name, 'read', '', sum(read.values()), '', 'same rows: {}'.format(read == expected), ''))
+                same = same and read == expected
+    conn.close()
+    print()
+    print('Shards written to {}.'.format(output))
+    print('Same rows as the json files: {}'.format(same))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import io
+import time
+import argparse
+import contextlib
+from scheduler import run_dag
+from benchmark_scheduler import DSN, standin_dsn, reset_tables, standin_steps, table_fingerprints
+
+
+def run_load(dsn, steps, workers):
+    """
+    This function runs the steps of a load without printing them and returns its wall time in seconds.
+    """
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        run_dag(steps, dsn, workers)
+    return time.perf_counter() - start
+
+
+def print_run(name, events, seconds, fingerprints):
+    """
+    This function prints the staged events, wall time and rows of every table of a load.
+    """
+    print('{:<28} {:>16} {:8.2f}  {}'.format(name, events, seconds, ', '.join(
+        '{} {}'.format(table, count) for table, (count, digest) in fingerprints.items())))
+
+
+def main():
+    """
+    Loads generated events against a local Postgres database in one full load, runs the full load again, then loads
+    the same events incrementally in overlapping batches and once more with the last batch, printing the wall time
+    and rows of every run and checking that the incremental loads end with the same rows as the full load.
+    """
+    parser = argparse.ArgumentParser(description='Compare full and incremental loads of the ETL steps '
+                                                 'against a local Postgres stand-in.')
+    parser.add_argument('--dsn', default=DSN, help='connection string of the local Postgres database')
+    parser.add_argument('--batches', type=int, default=5, help='number of incremental loads')
+    parser.add_argument('--batch-events', type=int, default=100000, help='number of new events of every batch')
+    parser.add_argument('--overlap', type=int, default=20000,
+                        help='number of events of the previous batch staged again with every batch')
+    parser.add_argument('--songs', type=int, default=100000, help='number of staged songs generated')
+    parser.add_argument('--users', type=int, default=100, help='number of users of the staged events')
+    parser.add_argument('--artists', type=int, default=20000, help='number of artists of the staged songs')
+    parser.add_argument('--workers', type=int, default=4, help='maximum number of steps running at once')
+    parser.add_argument('--surrogate-keys', action='store_true', help='create and load the surrogate key schema')
+    args = parser.parse_args()
+
+    dsn = standin_dsn(args.dsn)
+    total = args.batches * args.batch_events
+    parameters = dict(vars(args), copy_seconds=0)
+
+    print('{:<28} {:>16} {:>8}  {}'.format('load', 'staged events', 'seconds', 'rows'))
+    reset_tables(dsn, args.surrogate_keys)
+    steps = standin_steps(args.surrogate_keys, dict(parameters, first_event=1, events=total))
+    seconds = run_load(dsn, steps, args.workers)
+    full = table_fingerprints(dsn, args.surrogate_keys)
+    print_run('full', '1-{}'.format(total), seconds, full)
+    seconds = run_load(dsn, steps, args.workers)
+    print_run('full, run again', '1-{}'.format(total), seconds, table_fingerprints(dsn, args.surrogate_keys))
+
+    reset_tables(dsn, args.surrogate_keys)
+    for batch in range(args.batches):
+        first = max(1, batch * args.batch_events + 1 - args.overlap)
+        last = (batch + 1) * args.batch_events
+        steps = standin_steps(args.surrogate_keys, dict(parameters, first_event=first, events=last), incremental=True)
+        seconds = run_load(dsn, steps, args.workers)
+        incremental = table_fingerprints(dsn, args.surrogate_keys)
+        print_run('incremental batch {}'.format(batch + 1), '{}-{}'.format(first, last), seconds, incremental)
+    seconds = run_load(dsn, steps, args.workers)
+    rerun = table_fingerprints(dsn, args.surrogate_keys)
+    print_run('incremental, last run again', '{}-{}'.format(first, last), seconds, rerun)
+
+    print()
+    print('Incremental loads have the same rows as the full load: {}'.format(incremental == full))
+    print('Running the last incremental load again changes no row: {}'.format(rerun == incremental))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+import re
+import time
+import argparse
+import psycopg2
+from sql_queries import create_table_queries, drop_table_queries, create_table_queries_surrogate
+from scheduler import run_dag, write_report
+from etl import table_queries
+from table_specs import create_table
+
+
+# local Postgres database standing in for the Redshift cluster, the tables are created in their own schema
+DSN = "host=127.0.0.1 dbname=studentdb user=student password=student"
+SCHEMA = 'dwh_standin'
+
+# staged songs and events generated instead of copied from S3, after sleeping as long as a COPY would take,
+# half of the events playing a staged song
+staging_songs_standin = ("""
+    SELECT pg_sleep(%(copy_seconds)s);
+    INSERT INTO staging_songs (num_songs, artist_id, artist_latitude, artist_longitude, artist_location,
+                               artist_name, song_id, title, duration, year)
+    SELECT
+        1,
+        'AR' || lpad((i %% %(artists)s)::text, 16, '0'),
+        CASE WHEN i %% 4 = 0 THEN NULL ELSE (i %% %(artists)s) / 100.0 END,
+        CASE WHEN i %% 4 = 0 THEN NULL ELSE (i %% %(artists)s) / -100.0 END,
+        CASE WHEN i %% 4 = 0 THEN NULL ELSE 'City ' || (i %% %(artists)s) END,
+        'Artist ' || (i %% %(artists)s),
+        'SO' || lpad(i::text, 16, '0'),
+        'Song ' || i,
+        100 + i %% 300,
+        1950 + i %% 70
+    FROM generate_series(1, %(songs)s) i
+""")
+
+staging_events_standin = ("""
+    SELECT pg_sleep(%(copy_seconds)s);
+    INSERT INTO staging_events (artist, auth, firstName, gender, itemInSession, lastName, length, level, location,
+                                method, page, registration, sessionId, song, status, ts, userAgent, userId)
+    SELECT
+        'Artist ' || (i * 7 %% (%(songs)s * 2) %% %(artists)s),
+        'Logged In',
+        'First ' || (i %% %(users)s),
+        CASE WHEN i %% %(users)s %% 2 = 0 THEN 'F' ELSE 'M' END,
+        i %% 50,
+        'Last ' || (i %% %(users)s),
+        100 + i * 7 %% (%(songs)s * 2) %% 300,
+        CASE WHEN i %% %(users)s %% 3 = 0 THEN 'paid' ELSE 'free' END,
+        'Town ' || (i %% %(users)s),
+        'PUT',
+        CASE WHEN i %% 5 = 0 THEN 'Home' ELSE 'NextSong' END,
+        0,
+        i / 20,
+        'Song ' || (i * 7 %% (%(songs)s * 2)),
+        200,
+        timestamp '2018-11-01' + i * interval '1 second',
+        'Mozilla/5.0',
+        i %% %(users)s
+    FROM generate_series(%(first_event)s, %(events)s) i
+""")
+
+# tables analyzed once loaded by a step, as Redshift updates the statistics of copied and inserted tables itself
+analyzed_tables = dict(staging_events='staging_events', staging_songs='staging_songs',
+                       song_lookup='staging_song_lookup', song='songs', artist='artists')
+
+# rows of every table compared between runs, keys generated by the database being replaced by natural ids
+table_checks = {
+    'songplays': "SELECT start_time, user_id, level, song_id, artist_id, session_id, location, user_agent FROM songplays",
+    'users': "SELECT * FROM users",
+    'songs': "SELECT song_id, title, artist_id, year, duration FROM songs",
+    'artists': "SELECT artist_id, name, location, latitude, longitude FROM artists",
+    'time': "SELECT * FROM time",
+}
+
+songplays_check_surrogate = ("""
+    SELECT sp.start_time, sp.user_id, sp.level, s.song_id, a.artist_id, sp.session_id, sp.location, sp.user_agent
+    FROM songplays sp
+    JOIN songs s ON s.song_key = sp.song_key
+    JOIN artists a ON a.artist_key = sp.artist_key
+""")
+
+
+def standin_dsn(dsn):
+    """
+    This function returns the connection string of the stand-in schema. Nested loops are disabled: Postgres
+    underestimates joins on the correlated title, artist name and duration of the song lookup and would loop
+    over large tables that Redshift hash joins.
+    """
+    return "{} options='-c search_path={} -c enable_nestloop=off'".format(dsn, SCHEMA)
+
+
+def postgres_query(query):
+    """
+    This function rewrites the Redshift only parts of a query for Postgres. Primary keys are left out,
+    as Redshift does not enforce them.
+    """
+    query = re.sub(r'IDENTITY\(0,1\)', 'GENERATED BY DEFAULT AS IDENTITY (MINVALUE 0 START WITH 0)', query)
+    query = re.sub(r'\s+PRIMARY KEY', '', query)
+    return query.replace('extract(dayofweek from', 'extract(dow from')
+
+
+def standin_steps(surrogate_keys, parameters, incremental=False):
+    """
+    This function returns the steps of etl.py, with the copies replaced by generated data, events `first_event`
+    to `events`, and the inserts rewritten for Postgres, keeping their dependencies.
+    """
+    copies = [
+        {'name': 'staging_events', 'query': staging_events_standin % parameters, 'depends': []},
+        {'name': 'staging_songs', 'query': staging_songs_standin % parameters, 'depends': []},
+    ]
+    if incremental:
+        # like the incremental copies, staging tables are emptied first
+        copies = [dict(step, query='TRUNCATE {};'.format(step['name']) + step['query']) for step in copies]
+    inserts = [dict(step, query=postgres_query(step['query']))
+               for step in table_queries(surrogate_keys, incremental)[1]]
+    return [dict(step, query='{};\nANALYZE {}'.format(step['query'].rstrip().rstrip(';'), analyzed_tables[step['name']]))
+            if step['name'] in analyzed_tables else step for step in copies + inserts]
+
+
+def reset_tables(dsn, surrogate_keys):
+    """
+    This function drops and creates the tables of the stand-in schema, in the Postgres dialect of their specs.
+    """
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+    cur.execute('CREATE SCHEMA IF NOT EXISTS {}'.format(SCHEMA))
+    for table in drop_table_queries:
+        cur.execute(table['query'])
+    for table in create_table_queries_surrogate if surrogate_keys else create_table_queries:
+        cur.execute(postgres_query(create_table(table['spec'], 'postgres')))
+    conn.commit()
+    conn.close()
+
+
+def table_fingerprints(dsn, surrogate_keys):
+    """
+    This function returns the number of rows and a hash of the sorted rows of every table.
+    """
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+    fingerprints = {}
+    for table, query in table_checks.items():
+        if surrogate_keys and table == 'songplays':
+            query = songplays_check_surrogate
+        cur.execute("SELECT count(*), md5(string_agg(t::text, '|' ORDER BY t::text)) FROM ({}) t".format(query))
+        fingerprints[table] = cur.fetchone()
+    conn.close()
+    return fingerprints
+
+
+def main():
+    """
+    Runs the steps of etl.py against a local Postgres database one at a time then concurrently,
+    prints the wall time and critical path of each run and checks that both load the same rows.
+    """
+    parser = argparse.ArgumentParser(description='Compare sequential and concurrent runs of the ETL steps '
+                                                 'against a local Postgres stand-in.')
+    parser.add_argument('--dsn', default=DSN, help='connection string of the local Postgres database')
+    parser.add_argument('--events', type=int, default=500000, help='number of staged events generated')
+    parser.add_argument('--songs', type=int, default=100000, help='number of staged songs generated')
+    parser.add_argument('--users', type=int, default=100, help='number of users of the staged events')
+    parser.add_argument('--artists', type=int, default=20000, help='number of artists of the staged songs')
+    parser.add_argument('--copy-seconds', type=float, default=2.0, help='seconds every stand-in COPY waits for S3')
+    parser.add_argument('--workers', type=int, default=4, help='maximum number of steps running at once')
+    parser.add_argument('--surrogate-keys', action='store_true', help='create and load the surrogate key schema')
+    parser.add_argument('--report', help='JSON file the timings of the concurrent run are written to')
+    args = parser.parse_args()
+
+    dsn = standin_dsn(args.dsn)
+    steps = standin_steps(args.surrogate_keys, dict(vars(args), first_event=1))
+
+    runs = {}
+    for workers in [1, args.workers]:
+        print('************************* {} step(s) at once *************************'.format(workers))
+        reset_tables(dsn, args.surrogate_keys)
+        start = time.perf_counter()
+        timings = run_dag(steps, dsn, workers)
+        elapsed = time.perf_counter() - start
+        write_report(args.report if workers > 1 else None, steps, timings)
+        runs[workers] = (elapsed, table_fingerprints(dsn, args.surrogate_keys))
+        print()
+
+    for workers, (elapsed, fingerprints) in runs.items():
+        print('{} step(s) at once: {:.2f}s, {}'.format(workers, elapsed, ', '.join(
+            '{} {}'.format(table, count) for table, (count, digest) in fingerprints.items())))
+    print('Same rows: {}'.format(runs[1][1] == runs[args.workers][1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+import time
+import argparse
+import psycopg2
+from sql_queries import staging_song_lookup_insert, songplay_table_insert
+from benchmark_scheduler import DSN, SCHEMA, postgres_query, reset_tables
+
+
+# songplays insert joining songs on their title alone, replaced by the song lookup
+songplay_table_insert_title_join = ("""
+    INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+    SELECT DISTINCT
+        se.ts AS start_time,
+        se.userId AS user_id,
+        se.level,
+        ss.song_id,
+        ss.artist_id,
+        se.sessionId AS session_id,
+        se.location,
+        se.userAgent AS user_agent
+    FROM
+        staging_events se
+        INNER JOIN staging_songs ss ON se.song = ss.title
+    WHERE se.page = 'NextSong'
+""")
+
+# rows of the title join before DISTINCT, and those attaching a song of another artist than the event's
+title_join_rows_select = ("""
+    SELECT count(*), count(CASE WHEN ss.artist_name <> se.artist THEN 1 END)
+    FROM
+        staging_events se
+        INNER JOIN staging_songs ss ON se.song = ss.title
+    WHERE se.page = 'NextSong'
+""")
+
+# songplays whose song is not the one played, by artist name and duration
+songplay_mismatch_select = ("""
+    SELECT count(*)
+    FROM (
+        SELECT DISTINCT sp.songplay_id
+        FROM
+            songplays sp
+            INNER JOIN staging_events se
+                ON se.ts = sp.start_time AND se.userId = sp.user_id AND se.sessionId = sp.session_id
+            INNER JOIN staging_songs ss ON ss.song_id = sp.song_id
+        WHERE se.page = 'NextSong' AND (ss.artist_name <> se.artist OR ss.duration <> se.length)
+    ) mismatches
+""")
+
+# songs sharing titles across artists, some staged twice with another song_id, and events playing them
+staging_songs_generate = ("""
+    INSERT INTO staging_songs (num_songs, artist_id, artist_latitude, artist_longitude, artist_location,
+                               artist_name, song_id, title, duration, year)
+    SELECT
+        1,
+        'AR' || lpad((k %% %(artists)s)::text, 16, '0'),
+        NULL,
+        NULL,
+        NULL,
+        'Artist ' || (k %% %(artists)s),
+        'SO' || lpad(i::text, 16, '0'),
+        'Song ' || (k %% %(titles)s),
+        100 + k / 1000.0,
+        1950 + k %% 70
+    FROM (SELECT i, i %% %(distinct_songs)s AS k FROM generate_series(1, %(songs)s) i) songs
+""")
+
+staging_events_generate = ("""
+    INSERT INTO staging_events (artist, auth, firstName, gender, itemInSession, lastName, length, level, location,
+                                method, page, registration, sessionId, song, status, ts, userAgent, userId)
+    SELECT
+        'Artist ' || (k %% %(artists)s),
+        'Logged In',
+        'First ' || (i %% %(users)s),
+        CASE WHEN i %% %(users)s %% 2 = 0 THEN 'F' ELSE 'M' END,
+        i %% 50,
+        'Last ' || (i %% %(users)s),
+        100 + k / 1000.0,
+        CASE WHEN i %% %(users)s %% 3 = 0 THEN 'paid' ELSE 'free' END,
+        'Town ' || (i %% %(users)s),
+        'PUT',
+        CASE WHEN i %% 5 = 0 THEN 'Home' ELSE 'NextSong' END,
+        0,
+        i / 20,
+        'Song ' || (k %% %(titles)s),
+        200,
+        timestamp '2018-11-01' + i * interval '1 second',
+        'Mozilla/5.0',
+        i %% %(users)s
+    FROM (SELECT i, i * 7 %% (%(distinct_songs)s + %(distinct_songs)s / 10) AS k
+          FROM generate_series(1, %(events)s) i) events
+""")
+
+
+def timed(cur, query):
+    """
+    This function runs a query and returns its wall time in seconds.
+    """
+    start = time.perf_counter()
+    cur.execute(query)
+    return time.perf_counter() - start
+
+
+def count_rows(cur, table):
+    """
+    This function returns the number of rows of a table.
+    """
+    cur.execute('SELECT count(*) FROM {}'.format(table))
+    return cur.fetchone()[0]
+
+
+def main():
+    """
+    Loads songplays from generated staging data with the title join and with the song lookup, then prints
+    the rows and wall time of every stage and the songplays attached to the wrong song.
+    """
+    parser = argparse.ArgumentParser(description='Compare the title join and the song lookup join building songplays '
+                                                 'against a local Postgres stand-in.')
+    parser.add_argument('--dsn', default=DSN, help='connection string of the local Postgres database')
+    parser.add_argument('--events', type=int, default=200000, help='number of staged events generated')
+    parser.add_argument('--songs', type=int, default=100000, help='number of staged songs generated')
+    parser.add_argument('--duplicate-share', type=float, default=0.1,
+                        help='share of the staged songs repeating another song with a new song_id')
+    parser.add_argument('--titles', type=int, default=5000, help='number of distinct song titles')
+    parser.add_argument('--artists', type=int, default=20000, help='number of artists of the staged songs')
+    parser.add_argument('--users', type=int, default=100, help='number of users of the staged events')
+    args = parser.parse_args()
+
+    parameters = dict(vars(args), distinct_songs=int(args.songs * (1 - args.duplicate_share)))
+    dsn = "{} options='-c search_path={}'".format(args.dsn, SCHEMA)
+    reset_tables(dsn, False)
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+    cur.execute(staging_songs_generate % parameters)
+    cur.execute(staging_events_generate % parameters)
+    cur.execute('ANALYZE staging_songs; ANALYZE staging_events')
+    conn.commit()
+
+    cur.execute("SELECT count(*) FROM staging_events WHERE page = 'NextSong'")
+    plays = cur.fetchone()[0]
+    print('{} staged songs, {} song plays.'.format(count_rows(cur, 'staging_songs'), plays))
+    print()
+    print('{:<12} {:<28} {:>10} {:>9}'.format('query', 'stage', 'rows', 'seconds'))
+
+    cur.execute(title_join_rows_select)
+    join_rows, other_artist_rows = cur.fetchone()
+    seconds = timed(cur, postgres_query(songplay_table_insert_title_join))
+    print('{:<12} {:<28} {:10d} {:>9}'.format('title join', 'join before DISTINCT', join_rows, ''))
+    print('{:<12} {:<28} {:10d} {:>9}'.format('title join', 'of another artist', other_artist_rows, ''))
+    print('{:<12} {:<28} {:10d} {:9.2f}'.format('title join', 'songplays', count_rows(cur, 'songplays'), seconds))
+    cur.execute(songplay_mismatch_select)
+    print('{:<12} {:<28} {:10d} {:>9}'.format('title join', 'songplays of the wrong song', cur.fetchone()[0], ''))
+    conn.rollback()
+
+    lookup_seconds = timed(cur, postgres_query(staging_song_lookup_insert))
+    print('{:<12} {:<28} {:10d} {:9.2f}'.format('lookup', 'song lookup', count_rows(cur, 'staging_song_lookup'),
+                                                lookup_seconds))
+    seconds = timed(cur, postgres_query(songplay_table_insert))
+    print('{:<12} {:<28} {:10d} {:9.2f}'.format('lookup', 'songplays', count_rows(cur, 'songplays'), seconds))
+    cur.execute(songplay_mismatch_select)
+    print('{:<12} {:<28} {:10d} {:>9}'.format('lookup', 'songplays of the wrong song', cur.fetchone()[0], ''))
+    print('{:<12} {:<28} {:>10} {:9.2f}'.format('lookup', 'total', '', lookup_seconds + seconds))
+    conn.rollback()
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
+import argparse
 import configparser
 import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+from sql_queries import create_table_queries, drop_table_queries, create_table_queries_surrogate
+from table_specs import create_table
 
 
 def drop_tables(cur, conn):
@@ -22,9 +24,12 @@ def drop_tables(cur, conn):
         print('  Done.')
     print('***************************************************************************', end='\n\n')
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, surrogate_keys=False, dialect='redshift'):
     """
-    Creates each table using the queries in `create_table_queries` list.
+    Creates each table using the queries in `create_table_queries` list,
+    or `create_table_queries_surrogate` list if `surrogate_keys` is set.
+    With the `postgres` dialect, the tables are created from their specs without distribution styles
+    and encodings, and their sort and distribution keys are indexed instead.
     
     Parameters
     ----------
@@ -32,22 +37,26 @@ def create_tables(cur, conn):
                     Cursor connected to a database session
     conn        : Connection object
                     Session connection to a database
+    surrogate_keys : boolean
+                    If set, songs and artists have integer surrogate keys stored by songplays
+    dialect     : string
+                    `redshift` or `postgres`
     """
     print('***************************** Creating Tables *****************************')
-    for table in create_table_queries:
+    for table in create_table_queries_surrogate if surrogate_keys else create_table_queries:
         print('- Creating {} Table'.format(table['name']))
-        cur.execute(table['query'])
+        cur.execute(table['query'] if dialect == 'redshift' else create_table(table['spec'], dialect))
         conn.commit()
         print('  Done.')
     print('***************************************************************************', end='\n\n')
 
-def main():
+def main(surrogate_keys=False, dialect='redshift'):
     """
     - Establishs database connection and gets cursor to it.
     
     - Drops all the tables.  
     
-    - Creates all tables needed. 
+    - Creates all tables needed, with surrogate keys if `surrogate_keys` is set, in the SQL `dialect` of the database. 
     
     - Finally, closes the connection. 
     """
@@ -58,10 +67,17 @@ def main():
     cur = conn.cursor()
 
     drop_tables(cur, conn)
-    create_tables(cur, conn)
+    create_tables(cur, conn, surrogate_keys, dialect)
 
     conn.close()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Drop and create the staging, fact and dimension tables.')
+    parser.add_argument('--surrogate-keys', action='store_true',
+                        help='give songs and artists integer surrogate keys and store them in songplays')
+    parser.add_argument('--dialect', choices=['redshift', 'postgres'], default='redshift',
+                        help='create the tables for Redshift, or for a Postgres database with indexes '
+                             'in place of the sort and distribution keys')
+    args = parser.parse_args()
+    main(surrogate_keys=args.surrogate_keys, dialect=args.dialect)
\ No newline at end of file
@@ -1,9 +1,36 @@
+import argparse
 import configparser
 import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries
+from sql_queries import copy_table_queries, insert_table_queries, insert_table_queries_surrogate, \
+    copy_table_queries_incremental, insert_table_queries_incremental, insert_table_queries_incremental_surrogate, \
+    copy_table_queries_shards, copy_table_queries_shards_incremental
+from scheduler import run_dag, write_report
 
 
-def load_staging_tables(cur, conn):
+def table_queries(surrogate_keys=False, incremental=False, shards=False):
+    """
+    This function returns the copy and insert query lists of a load.
+
+    Parameters
+    ----------
+    surrogate_keys : boolean
+                    If set, tables were created with surrogate keys
+    incremental : boolean
+                    If set, staging tables are emptied before being copied and only the staged events later than
+                    the high-water mark of every table are loaded, dimensions replacing the rows they load again
+    shards      : boolean
+                    If set, staging tables are copied from the shards written by prepare_copy_input.py
+                    instead of the json files
+    """
+    if incremental:
+        copies = copy_table_queries_shards_incremental if shards else copy_table_queries_incremental
+        return copies, (insert_table_queries_incremental_surrogate if surrogate_keys
+                        else insert_table_queries_incremental)
+    copies = copy_table_queries_shards if shards else copy_table_queries
+    return copies, insert_table_queries_surrogate if surrogate_keys else insert_table_queries
+
+
+def load_staging_tables(cur, conn, incremental=False, shards=False):
     """
     This function loads staging_songs, staging_events tables by copping data from s3 bucket file data.
     
@@ -13,17 +40,21 @@ def load_staging_tables(cur, conn):
                     Cursor connected to a database session
     conn        : Connection object
                     Session connection to a database
+    incremental : boolean
+                    If set, staging tables are emptied before being copied
+    shards      : boolean
+                    If set, staging tables are copied from the shards listed by their manifests
     """
     
     print('************************* Loading Staging Tables **************************')
-    for table in copy_table_queries:
+    for table in table_queries(incremental=incremental, shards=shards)[0]:
         print('- Loading data into {} Table'.format(table['name']))
         cur.execute(table['query'])
         conn.commit()
         print('  Done.')
     print('***************************************************************************', end='\n\n')
 
-def insert_tables(cur, conn):
+def insert_tables(cur, conn, surrogate_keys=False, incremental=False):
     """
     This function insertes data form staging tables into fact and dimension tables
     
@@ -33,37 +64,95 @@ def insert_tables(cur, conn):
                     Cursor connected to a database session
     conn        : Connection object
                     Session connection to a database
+    surrogate_keys : boolean
+                    If set, tables were created with surrogate keys, songs and artists are inserted
+                    before songplays so that their keys are looked up
+    incremental : boolean
+                    If set, only the staged events later than the high-water mark of every table are loaded,
+                    each table in one transaction
     """
     
     print('************** Inserting Data Into Fact and Dimension Tables **************')
-    for table in insert_table_queries:
+    for table in table_queries(surrogate_keys, incremental)[1]:
         print('- Inserting data into {} Table'.format(table['name']))
         cur.execute(table['query'])
         conn.commit()
         print('  Done.')
     print('***************************************************************************', end='\n\n')
 
-def main():
+def run_steps(dsn, surrogate_keys=False, workers=4, report=None, incremental=False, shards=False):
+    """
+    This function runs the copies and inserts as a graph of steps, each step starting once the staging or dimension
+    tables it reads are loaded, up to `workers` steps at once on separate connections.
+
+    In incremental loads, the songplays, users and time steps each read and move their high-water mark in
+    load_state. Each starts with LOCK load_state so that, running concurrently, they wait for one another instead
+    of failing with a serializable isolation violation (Redshift error 1023).
+
+    Parameters
+    ----------
+    dsn         : string
+                    Connection string of the database
+    surrogate_keys : boolean
+                    If set, tables were created with surrogate keys, songplays waits for songs and artists
+    workers     : integer
+                    Maximum number of steps running at once
+    report      : string
+                    Path to the JSON file the wall time of every step and the critical path are written to
+    incremental : boolean
+                    If set, only the staged events later than the high-water mark of every table are loaded
+    shards      : boolean
+                    If set, staging tables are copied from the shards listed by their manifests
+    """
+
+    print('********************* Loading Tables ({} steps at once) ********************'.format(workers))
+    copies, inserts = table_queries(surrogate_keys, incremental, shards)
+    steps = copies + inserts
+    timings = run_dag(steps, dsn, workers)
+    write_report(report, steps, timings)
+    print('***************************************************************************', end='\n\n')
+
+def main(surrogate_keys=False, workers=1, report=None, incremental=False, shards=False):
     """
     - Establishs database connection and gets cursor to it.
     
-    - Load staging tables.  
+    - Load staging tables, from the shards of prepare_copy_input.py if `shards` is set.  
     
-    - Insert data into tables. 
+    - Insert data into tables, with surrogate keys if `surrogate_keys` is set, and only the events later than
+      the last load if `incremental` is set. 
+    
+    - Or, with more than one worker, runs the copies and inserts concurrently as their dependencies allow.
     
     - Finally, closes the connection. 
     """
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
+    dsn = "host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values())
+
+    if workers > 1:
+        run_steps(dsn, surrogate_keys, workers, report, incremental, shards)
+        return
 
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+    conn = psycopg2.connect(dsn)
     cur = conn.cursor()
     
-    load_staging_tables(cur, conn)
-    insert_tables(cur, conn)
+    load_staging_tables(cur, conn, incremental, shards)
+    insert_tables(cur, conn, surrogate_keys, incremental)
 
     conn.close()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Load the staging tables then the fact and dimension tables.')
+    parser.add_argument('--surrogate-keys', action='store_true',
+                        help='tables were created with surrogate keys by `create_tables.py --surrogate-keys`')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='maximum number of copies and inserts running at once, each on its own connection')
+    parser.add_argument('--report', help='JSON file the wall time of every step and the critical path are written to')
+    parser.add_argument('--incremental', action='store_true',
+                        help='load only the staged events later than the last load, replacing reloaded dimension rows')
+    parser.add_argument('--shards', action='store_true',
+                        help='copy the staging tables from the shards of prepare_copy_input.py instead of the json files')
+    args = parser.parse_args()
+    main(surrogate_keys=args.surrogate_keys, workers=args.workers, report=args.report, incremental=args.incremental,
+         shards=args.shards)
\ No newline at end of file
@@ -0,0 +1,268 @@
+import os
+import csv
+import glob
+import gzip
+import json
+import time
+import heapq
+import shutil
+import argparse
+import datetime
+import configparser
+from table_specs import staging_events_spec, staging_songs_spec
+
+
+# text written for missing values in csv shards, the default NULL AS of Redshift COPY
+NULL = '\\N'
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def list_json_files(directory):
+    """
+    This function returns the paths of the json files of a directory and its subdirectories, sorted by name
+    so that the shards are the same on every run.
+
+    Parameters
+    ----------
+    directory   : string
+                    Path to the log_data or song_data directory
+    """
+    return sorted(glob.glob(os.path.join(directory, '**', '*.json'), recursive=True))
+
+
+def read_json_records(filepaths):
+    """
+    This function yields the records of json files holding one record per line, file after file.
+
+    Parameters
+    ----------
+    filepaths   : list
+                    Paths to json files
+    """
+    for filepath in filepaths:
+        with open(filepath, 'r', encoding='utf8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def format_timestamp(ms):
+    """
+    This function returns the UTC timestamp of epoch milliseconds as text both Redshift and Postgres COPY read.
+    """
+    return (EPOCH + datetime.timedelta(milliseconds=ms)).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+
+
+def staging_row(record, spec):
+    """
+    This function returns the values of a json record in the order and types of the columns of a staging table,
+    None for missing values. Timestamps are epoch milliseconds, as in the log files.
+
+    Parameters
+    ----------
+    record      : dictionary
+                    Log event or song read from a json file
+    spec        : TableSpec
+                    Staging table the record is copied to
+    """
+    row = []
+    for column in spec.columns:
+        value = record.get(column.name)
+        if value is None or (value == '' and column.type != 'VARCHAR'):
+            row.append(None)
+        elif column.type in ('INTEGER', 'TIMESTAMP'):
+            row.append(int(value))
+        elif column.type == 'FLOAT':
+            row.append(float(value))
+        else:
+            row.append(str(value))
+    return row
+
+
+class CsvShardWriter:
+    """
+    Writes rows to a gzip compressed csv shard without header, missing values written as `\\N`
+    and timestamps as text.
+
+    Parameters
+    ----------
+    filepath    : string
+                    Path to the shard written
+    spec        : TableSpec
+                    Staging table of the rows
+    """
+
+    extension = '.csv.gz'
+
+    def __init__(self, filepath, spec):
+        self.file = gzip.open(filepath, 'wt', encoding='utf8', newline='')
+        self.writer = csv.writer(self.file)
+        self.timestamps = [column.type == 'TIMESTAMP' for column in spec.columns]
+
+    def write(self, row):
+        self.writer.writerow([NULL if value is None else format_timestamp(value) if timestamp else value
+                              for value, timestamp in zip(row, self.timestamps)])
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetShardWriter:
+    """
+    Writes rows to a Parquet shard with the column types of the staging table, in row groups of up to
+    `row_group_size` rows.
+
+    Parameters
+    ----------
+    filepath    : string
+                    Path to the shard written
+    spec        : TableSpec
+                    Staging table of the rows
+    row_group_size : integer
+                    Maximum number of rows of a row group, held in memory until written
+    """
+
+    extension = '.parquet'
+
+    def __init__(self, filepath, spec, row_group_size=50000):
+        # pyarrow is only needed for the columnar output
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        types = {'INTEGER': pa.int32(), 'FLOAT': pa.float64(), 'TIMESTAMP': pa.timestamp('ms')}
+        self.schema = pa.schema([(column.name, types.get(column.type, pa.string())) for column in spec.columns])
+        self.row_group_size = row_group_size
+        self.writer = pq.ParquetWriter(filepath, self.schema, compression='snappy')
+        self.columns = [[] for column in spec.columns]
+
+    def write(self, row):
+        for values, value in zip(self.columns, row):
+            values.append(value)
+        if len(self.columns[0]) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if self.columns[0]:
+            self.writer.write_batch(self.pa.RecordBatch.from_arrays(
+                [self.pa.array(values, type=field.type) for values, field in zip(self.columns, self.schema)],
+                schema=self.schema))
+            self.columns = [[] for column in self.columns]
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+SHARD_WRITERS = {'csv': CsvShardWriter, 'parquet': ParquetShardWriter}
+
+
+def prepare_table(filepaths, spec, output, prefix, slices, file_format='csv', row_group_size=50000):
+    """
+    This function converts json files into `slices` shards of a staging table and writes the COPY manifest
+    listing them.
+
+    Every row goes to the shard with the fewest bytes so far, so the shards are evenly sized and every slice
+    of the cluster loads the same amount of data. The shards are written to `output`/<table>/ and the manifest
+    to `output`/<table>.manifest, its urls pointing to the same paths under `prefix`, where `output` is uploaded.
+    They are written to a hidden temporary directory renamed once complete, so an interrupted run leaves
+    the previous shards in place.
+
+    Parameters
+    ----------
+    filepaths   : list
+                    Paths to the json files, read in this order
+    spec        : TableSpec
+                    Staging table the shards are copied to
+    output      : string
+                    Local directory of the shards and manifests
+    prefix      : string
+                    S3 prefix `output` is uploaded to
+    slices      : integer
+                    Number of shards, the number of slices of the cluster
+    file_format : string
+                    `csv` for gzip compressed csv shards or `parquet`
+    row_group_size : integer
+                    Maximum number of rows of a Parquet row group
+
+    Returns
+    -------
+    Dictionary of the number of 'files' read, of 'rows', and of the 'rows' and 'bytes' of every shard
+    """
+    if file_format not in SHARD_WRITERS:
+        raise ValueError('unknown shard format {}'.format(file_format))
+    writer_class = SHARD_WRITERS[file_format]
+    options = dict(row_group_size=row_group_size) if writer_class is ParquetShardWriter else {}
+    directory = os.path.join(output, spec.name)
+    tmp = os.path.join(output, '.' + spec.name + '.tmp')
+    names = ['part-{:05d}{}'.format(shard, writer_class.extension) for shard in range(slices)]
+    os.makedirs(output, exist_ok=True)
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+
+    writers = [writer_class(os.path.join(tmp, name), spec, **options) for name in names]
+    rows = [0] * slices
+    try:
+        # uncompressed size of the rows written to every shard, the smallest first
+        sizes = [(0, shard) for shard in range(slices)]
+        for record in read_json_records(filepaths):
+            row = staging_row(record, spec)
+            size, shard = sizes[0]
+            writers[shard].write(row)
+            rows[shard] += 1
+            heapq.heapreplace(sizes, (size + sum(len(str(value)) + 1 for value in row), shard))
+    finally:
+        for writer in writers:
+            writer.close()
+
+    sizes = [os.path.getsize(os.path.join(tmp, name)) for name in names]
+    manifest = {'entries': [{'url': '{}/{}/{}'.format(prefix.rstrip('/'), spec.name, name), 'mandatory': True,
+                             'meta': {'content_length': size}}
+                            for name, size in zip(names, sizes)]}
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.rename(tmp, directory)
+    with open(os.path.join(output, spec.name + '.manifest'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return dict(files=len(filepaths), rows=sum(rows), shards=[dict(rows=count, bytes=size)
+                                                              for count, size in zip(rows, sizes)])
+
+
+def main():
+    """
+    Converts the log and song json files into shards of the staging tables and their COPY manifests,
+    and prints the rows and sizes of the shards.
+    """
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    parser = argparse.ArgumentParser(description='Convert the log and song json files into evenly sized shards '
+                                                 'of the staging tables and the manifests COPY loads them from.')
+    parser.add_argument('--log-data', default='log_data', help='directory of the log json files')
+    parser.add_argument('--song-data', default='song_data', help='directory of the song json files')
+    parser.add_argument('--output', default='copy_input', help='directory the shards and manifests are written to')
+    parser.add_argument('--prefix', default=config['SHARDS']['PREFIX'],
+                        help='S3 prefix the output directory is uploaded to, used in the manifests')
+    parser.add_argument('--slices', type=int, default=int(config['SHARDS']['SLICES']),
+                        help='number of shards of every table, the number of slices of the cluster')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default=config['SHARDS']['FORMAT'],
+                        help='gzip compressed csv or Parquet shards')
+    parser.add_argument('--row-group-size', type=int, default=50000,
+                        help='maximum number of rows of a Parquet row group')
+    args = parser.parse_args()
+
+    for directory, spec in [(args.log_data, staging_events_spec), (args.song_data, staging_songs_spec)]:
+        filepaths = list_json_files(directory)
+        start = time.perf_counter()
+        result = prepare_table(filepaths, spec, args.output, args.prefix, args.slices, args.format,
+                               args.row_group_size)
+        sizes = [shard['bytes'] for shard in result['shards']]
+        print('{}: {} rows of {} files into {} shards of {} to {} bytes in {:.2f}s.'.format(
+            spec.name, result['rows'], result['files'], args.slices, min(sizes), max(sizes),
+            time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from psycopg2.pool import ThreadedConnectionPool
+
+
+def order_steps(steps):
+    """
+    This function checks the steps and returns their names in an order where every step comes after the steps
+    it depends on.
+
+    Parameters
+    ----------
+    steps       : list
+                    Dictionaries with the 'name', 'query' and 'depends' of every step
+
+    Raises
+    ------
+    ValueError if two steps have the same name, a step depends on an unknown step or the dependencies have a cycle
+    """
+    depends = {}
+    for step in steps:
+        if step['name'] in depends:
+            raise ValueError('step {} is declared twice'.format(step['name']))
+        depends[step['name']] = step.get('depends', [])
+    for name, dependencies in depends.items():
+        for dependency in dependencies:
+            if dependency not in depends:
+                raise ValueError('step {} depends on unknown step {}'.format(name, dependency))
+
+    order = []
+    visiting = set()
+
+    def visit(name, path):
+        if name in order:
+            return
+        if name in visiting:
+            raise ValueError('steps have a dependency cycle: {}'.format(' -> '.join(path + [name])))
+        visiting.add(name)
+        for dependency in depends[name]:
+            visit(dependency, path + [name])
+        visiting.remove(name)
+        order.append(name)
+
+    for step in steps:
+        visit(step['name'], [])
+    return order
+
+
+def critical_path(steps, timings):
+    """
+    This function returns the chain of dependent steps with the largest total wall time, which bounds the wall time
+    of the whole run however many steps run concurrently.
+
+    Parameters
+    ----------
+    steps       : list
+                    Dictionaries with the 'name' and 'depends' of every step
+    timings     : dictionary
+                    Dictionaries with the 'seconds' of every step run, by name
+
+    Returns
+    -------
+    Names of the steps of the path, in run order, and its total wall time in seconds
+    """
+    depends = {step['name']: step.get('depends', []) for step in steps}
+    longest = {}
+    for name in order_steps(steps):
+        if name not in timings:
+            continue
+        seconds, path = max((longest[dependency] for dependency in depends[name] if dependency in longest),
+                            default=(0.0, []))
+        longest[name] = (seconds + timings[name]['seconds'], path + [name])
+    if not longest:
+        return [], 0.0
+    seconds, path = max(longest.values())
+    return path, seconds
+
+
+def run_dag(steps, dsn, workers=4):
+    """
+    This function runs the query of every step once the steps it depends on are done, running up to `workers` steps
+    concurrently, each on its own connection of a pool and committed when done.
+
+    When a step fails, no other step is started, the steps running are waited for and the error is raised.
+
+    Parameters
+    ----------
+    steps       : list
+                    Dictionaries with the 'name', 'query' and 'depends' of every step
+    dsn         : string
+                    Connection string of the database
+    workers     : integer
+                    Maximum number of steps running at once
+
+    Returns
+    -------
+    Dictionary of the 'start', 'end' and 'seconds' of every step, by name, times being relative to the start of the run
+    """
+    order_steps(steps)
+    remaining = {step['name']: set(step.get('depends', [])) for step in steps}
+    queries = {step['name']: step['query'] for step in steps}
+    timings = {}
+    lock = threading.Lock()
+    pool = ThreadedConnectionPool(1, workers, dsn)
+    start = time.perf_counter()
+
+    def run(name):
+        conn = pool.getconn()
+        try:
+            step_start = time.perf_counter() - start
+            with lock:
+                print('- Running {} step'.format(name))
+            with conn.cursor() as cur:
+                cur.execute(queries[name])
+            conn.commit()
+            step_end = time.perf_counter() - start
+            with lock:
+                timings[name] = dict(start=step_start, end=step_end, seconds=step_end - step_start)
+                print('  Done {} in {:.2f}s.'.format(name, step_end - step_start))
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            pool.putconn(conn)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            running = {}
+            queued = []
+            error = None
+            while True:
+                if error is None:
+                    # steps whose dependencies are done start in declaration order as workers become free
+                    for name in [name for name, dependencies in remaining.items() if not dependencies]:
+                        del remaining[name]
+                        queued.append(name)
+                    while queued and len(running) < workers:
+                        name = queued.pop(0)
+                        running[executor.submit(run, name)] = name
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    if future.exception() is not None:
+                        error = error or future.exception()
+                        print('  Failed {}: {}'.format(name, str(future.exception()).strip()))
+                        continue
+                    for dependencies in remaining.values():
+                        dependencies.discard(name)
+            if error is not None:
+                print('  Not run: {}'.format(', '.join(queued + list(remaining)) or 'none'))
+                raise error
+    finally:
+        pool.closeall()
+    return timings
+
+
+def write_report(filepath, steps, timings):
+    """
+    This function writes the wall time of every step and the critical path of a run to a JSON file,
+    and prints the critical path.
+
+    Parameters
+    ----------
+    filepath    : string
+                    Path to the report written, None to only print the critical path
+    steps       : list
+                    Dictionaries with the 'name' and 'depends' of every step
+    timings     : dictionary
+                    Dictionaries with the 'start', 'end' and 'seconds' of every step run, by name
+    """
+    path, seconds = critical_path(steps, timings)
+    elapsed = max((timing['end'] for timing in timings.values()), default=0.0)
+    print('Critical path: {} ({:.2f}s of {:.2f}s).'.format(' -> '.join(path), seconds, elapsed))
+    if filepath is None:
+        return
+    report = dict(
+        elapsed=elapsed,
+        steps=[dict(name=step['name'], depends=step.get('depends', []), **timings[step['name']])
+               for step in steps if step['name'] in timings],
+        critical_path=dict(steps=path, seconds=seconds),
+    )
+    with open(filepath, 'w') as f:
+        json.dump(report, f, indent=2)
@@ -1,4 +1,7 @@
 import configparser
+from table_specs import (create_table, staging_events_spec, staging_songs_spec, staging_song_lookup_spec,
+                         songplay_spec, user_spec, song_spec, artist_spec, time_spec, load_state_spec,
+                         songplay_spec_surrogate, song_spec_surrogate, artist_spec_surrogate)
 
 
 # CONFIG
@@ -10,112 +13,43 @@ SONG_DATA_BUCKET=config['S3']['SONG_DATA']
 ROLE_ARN=config['IAM_ROLE']['ARN']
 LOG_JSON_PATH=config['S3']['LOG_JSONPATH']
 REGION=config['REGIONS']['REGION']
+SHARDS_PREFIX=config['SHARDS']['PREFIX']
+SHARDS_FORMAT=config['SHARDS']['FORMAT']
 
 # DROP TABLES
 
 staging_events_table_drop = "DROP TABLE IF EXISTS staging_events"
 staging_songs_table_drop = "DROP TABLE IF EXISTS staging_songs"
+staging_song_lookup_table_drop = "DROP TABLE IF EXISTS staging_song_lookup"
 songplay_table_drop = "DROP TABLE IF EXISTS songplays"
 user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS songs"
 artist_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS time"
+load_state_table_drop = "DROP TABLE IF EXISTS load_state"
 
 # CREATE TABLES
+# statements are generated from the table specs of table_specs.py, which set the distribution style, sort key
+# and column encodings of every table
 
-staging_events_table_create= ("""
-    CREATE TABLE IF NOT EXISTS staging_events(
-        artist              VARCHAR,
-        auth                VARCHAR,
-        firstName           VARCHAR,
-        gender              VARCHAR,
-        itemInSession       INTEGER,
-        lastName            VARCHAR,
-        length              FLOAT,
-        level               VARCHAR,
-        location            VARCHAR,
-        method              VARCHAR,
-        page                VARCHAR,
-        registration        FLOAT,
-        sessionId           INTEGER,
-        song                VARCHAR,
-        status              INTEGER,
-        ts                  TIMESTAMP,
-        userAgent           VARCHAR,
-        userId              INTEGER 
-    )
-""")
-
-staging_songs_table_create = ("""
-    CREATE TABLE IF NOT EXISTS staging_songs(
-        num_songs           INTEGER,
-        artist_id           VARCHAR,
-        artist_latitude     FLOAT,
-        artist_longitude    FLOAT,
-        artist_location     VARCHAR,
-        artist_name         VARCHAR,
-        song_id             VARCHAR,
-        title               VARCHAR,
-        duration            FLOAT,
-        year                INTEGER
-    )
-""")
-
-songplay_table_create = ("""
-    CREATE TABLE IF NOT EXISTS songplays(
-        songplay_id         INTEGER         IDENTITY(0,1)   PRIMARY KEY,
-        start_time          TIMESTAMP,
-        user_id             INTEGER ,
-        level               VARCHAR,
-        song_id             VARCHAR,
-        artist_id           VARCHAR ,
-        session_id          INTEGER,
-        location            VARCHAR,
-        user_agent          VARCHAR
-    )
-""")
-
-user_table_create = ("""
-    CREATE TABLE IF NOT EXISTS users(
-        user_id             INTEGER PRIMARY KEY,
-        first_name          VARCHAR,
-        last_name           VARCHAR,
-        gender              VARCHAR,
-        level               VARCHAR
-    )
-""")
+staging_events_table_create = create_table(staging_events_spec)
+staging_songs_table_create = create_table(staging_songs_spec)
+# one song per title, artist name and duration, the keys log events carry, to resolve song plays with a single match
+staging_song_lookup_table_create = create_table(staging_song_lookup_spec)
+songplay_table_create = create_table(songplay_spec)
+user_table_create = create_table(user_spec)
+song_table_create = create_table(song_spec)
+artist_table_create = create_table(artist_spec)
+time_table_create = create_table(time_spec)
+# high-water mark of every table loaded incrementally: the latest staged event time loaded into it
+load_state_table_create = create_table(load_state_spec)
 
-song_table_create = ("""
-    CREATE TABLE IF NOT EXISTS songs(
-        song_id             VARCHAR PRIMARY KEY,
-        title               VARCHAR ,
-        artist_id           VARCHAR ,
-        year                INTEGER ,
-        duration            FLOAT
-    )
-""")
-
-artist_table_create = ("""
-    CREATE TABLE IF NOT EXISTS artists(
-        artist_id           VARCHAR  PRIMARY KEY,
-        name                VARCHAR ,
-        location            VARCHAR,
-        latitude            FLOAT,
-        longitude           FLOAT
-    )
-""")
+# SURROGATE KEYS
+# songs and artists get compact integer keys, songplays stores them instead of the 18-character natural ids
 
-time_table_create = ("""
-    CREATE TABLE IF NOT EXISTS time(
-        start_time          TIMESTAMP       NOT NULL PRIMARY KEY,
-        hour                INTEGER         NOT NULL,
-        day                 INTEGER         NOT NULL,
-        week                INTEGER         NOT NULL,
-        month               INTEGER         NOT NULL,
-        year                INTEGER         NOT NULL,
-        weekday             VARCHAR(20)     NOT NULL
-    )
-""")
+songplay_table_create_surrogate = create_table(songplay_spec_surrogate)
+song_table_create_surrogate = create_table(song_spec_surrogate)
+artist_table_create_surrogate = create_table(artist_spec_surrogate)
 
 # STAGING TABLES
 
@@ -127,22 +61,67 @@ staging_songs_copy = ("""
     copy staging_songs from {} credentials 'aws_iam_role={}' region '{}' format as JSON 'auto';
 """).format(SONG_DATA_BUCKET, ROLE_ARN, REGION)
 
+# shards written by prepare_copy_input.py and uploaded under SHARDS_PREFIX, one per slice and listed by a manifest,
+# csv shards holding timestamps as text and missing values as the default NULL AS '\N'
+shard_copy_formats = {
+    'csv': "format as csv gzip timeformat 'auto'",
+    'parquet': "format as parquet",
+}
+
+staging_events_copy_shards = ("""
+    copy staging_events from '{}/staging_events.manifest' credentials 'aws_iam_role={}' region '{}' manifest {};
+""").format(SHARDS_PREFIX.rstrip('/'), ROLE_ARN, REGION, shard_copy_formats[SHARDS_FORMAT])
+
+staging_songs_copy_shards = ("""
+    copy staging_songs from '{}/staging_songs.manifest' credentials 'aws_iam_role={}' region '{}' manifest {};
+""").format(SHARDS_PREFIX.rstrip('/'), ROLE_ARN, REGION, shard_copy_formats[SHARDS_FORMAT])
+
+# songs staged more than once with the same title, artist name and duration keep their smallest song_id
+staging_song_lookup_insert = ("""
+    INSERT INTO staging_song_lookup (title, artist_name, duration, song_id, artist_id)
+    SELECT
+        title,
+        artist_name,
+        duration,
+        song_id,
+        artist_id
+    FROM (
+        SELECT
+            ss.title,
+            ss.artist_name,
+            ss.duration,
+            ss.song_id,
+            ss.artist_id,
+            ROW_NUMBER() OVER (PARTITION BY ss.title, ss.artist_name, ss.duration ORDER BY ss.song_id) AS song_rank
+        FROM
+            staging_songs ss
+    ) songs
+    WHERE song_rank = 1
+""")
+
+# the lookup is emptied first, full and incremental loads rebuild it from the songs they staged
+staging_song_lookup_rebuild = ("""
+    TRUNCATE staging_song_lookup;
+""") + staging_song_lookup_insert + ";"
+
 # FINAL TABLES
 
+# every event matches at most one song of the lookup, so no row is duplicated and no DISTINCT is needed
 songplay_table_insert = ("""
     INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent) 
-    SELECT DISTINCT
+    SELECT
         se.ts AS start_time,
         se.userId AS user_id,
         se.level,
-        ss.song_id,
-        ss.artist_id,
+        sl.song_id,
+        sl.artist_id,
         se.sessionId AS session_id,
         se.location,
         se.userAgent AS user_agent
     FROM
         staging_events se 
-        INNER JOIN staging_songs ss ON se.song = ss.title
+        INNER JOIN staging_song_lookup sl
+            ON sl.title = se.song AND sl.artist_name = se.artist AND sl.duration = se.length
     WHERE se.page = 'NextSong'
 """)
 
@@ -202,34 +181,306 @@ time_table_insert = ("""
         se.page = 'NextSong'
 """)
 
+# natural ids of the looked up songs are resolved to the keys of the loaded songs and artists,
+# a song or an artist may have several rows with different values so its smallest key is used
+songplay_table_insert_surrogate = ("""
+    INSERT INTO songplays (start_time, user_id, level, song_key, artist_key, session_id, location, user_agent)
+    SELECT
+        se.ts AS start_time,
+        se.userId AS user_id,
+        se.level,
+        s.song_key,
+        a.artist_key,
+        se.sessionId AS session_id,
+        se.location,
+        se.userAgent AS user_agent
+    FROM
+        staging_events se
+        INNER JOIN staging_song_lookup sl
+            ON sl.title = se.song AND sl.artist_name = se.artist AND sl.duration = se.length
+        INNER JOIN (SELECT song_id, MIN(song_key) AS song_key FROM songs GROUP BY song_id) s
+            ON s.song_id = sl.song_id
+        INNER JOIN (SELECT artist_id, MIN(artist_key) AS artist_key FROM artists GROUP BY artist_id) a
+            ON a.artist_id = sl.artist_id
+    WHERE se.page = 'NextSong'
+""")
+
+# INCREMENTAL LOADS
+# staging tables are emptied before every copy, and only the staged events later than the high-water mark of a table
+# are loaded into it. Every statement of a step runs in one transaction: dimensions delete the rows they replace then
+# insert them, and the high-water mark moves to the latest staged event the table was loaded from.
+
+high_water_select = "(SELECT COALESCE(MAX(high_water), '1900-01-01'::TIMESTAMP) FROM load_state WHERE name = '{0}')"
+
+# steps reading then moving a high-water mark lock load_state first: Redshift runs transactions in serializable
+# isolation and would abort concurrent steps reading and writing it (error 1023), so they wait for each other instead
+load_state_lock = ("""
+    LOCK load_state;
+""")
+
+# the mark is only inserted when it moves, then older marks of the table are deleted
+high_water_update = ("""
+    INSERT INTO load_state (name, high_water)
+    SELECT '{0}', MAX(se.ts)
+    FROM staging_events se
+    WHERE {1}
+    HAVING MAX(se.ts) > {2};
+    DELETE FROM load_state
+    WHERE name = '{0}' AND high_water < (SELECT MAX(high_water) FROM load_state WHERE name = '{0}');
+""")
+
+staging_events_copy_incremental = ("""
+    TRUNCATE staging_events;
+""") + staging_events_copy
+
+staging_songs_copy_incremental = ("""
+    TRUNCATE staging_songs;
+""") + staging_songs_copy
+
+staging_events_copy_shards_incremental = ("""
+    TRUNCATE staging_events;
+""") + staging_events_copy_shards
+
+staging_songs_copy_shards_incremental = ("""
+    TRUNCATE staging_songs;
+""") + staging_songs_copy_shards
+
+songplay_table_insert_incremental = load_state_lock + ("""
+    INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+    SELECT
+        se.ts AS start_time,
+        se.userId AS user_id,
+        se.level,
+        sl.song_id,
+        sl.artist_id,
+        se.sessionId AS session_id,
+        se.location,
+        se.userAgent AS user_agent
+    FROM
+        staging_events se
+        INNER JOIN staging_song_lookup sl
+            ON sl.title = se.song AND sl.artist_name = se.artist AND sl.duration = se.length
+    WHERE se.page = 'NextSong' AND se.ts > {high_water};
+    {update}
+""").format(high_water=high_water_select.format('songplays'),
+            update=high_water_update.format('songplays', "se.page = 'NextSong'", high_water_select.format('songplays')))
+
+# a user keeps the names and level of their latest event
+user_table_insert_incremental = load_state_lock + ("""
+    CREATE TEMP TABLE new_users AS
+    SELECT user_id, first_name, last_name, gender, level
+    FROM (
+        SELECT
+            se.userId AS user_id,
+            se.firstName AS first_name,
+            se.lastName AS last_name,
+            se.gender,
+            se.level,
+            ROW_NUMBER() OVER (PARTITION BY se.userId ORDER BY se.ts DESC, se.level DESC) AS user_rank
+        FROM
+            staging_events se
+        WHERE se.userId IS NOT NULL AND se.ts > {high_water}
+    ) users
+    WHERE user_rank = 1;
+    DELETE FROM users USING new_users WHERE users.user_id = new_users.user_id;
+    INSERT INTO users (user_id, first_name, last_name, gender, level)
+    SELECT user_id, first_name, last_name, gender, level FROM new_users;
+    DROP TABLE new_users;
+    {update}
+""").format(high_water=high_water_select.format('users'),
+            update=high_water_update.format('users', 'se.userId IS NOT NULL', high_water_select.format('users')))
+
+song_table_insert_incremental = ("""
+    CREATE TEMP TABLE new_songs AS
+    SELECT DISTINCT
+        ss.song_id,
+        ss.title,
+        ss.artist_id,
+        ss.year,
+        ss.duration
+    FROM
+        staging_songs ss;
+    DELETE FROM songs USING new_songs WHERE songs.song_id = new_songs.song_id;
+    INSERT INTO songs (song_id, title, artist_id, year, duration)
+    SELECT song_id, title, artist_id, year, duration FROM new_songs;
+    DROP TABLE new_songs;
+""")
+
+artist_table_insert_incremental = ("""
+    CREATE TEMP TABLE new_artists AS
+    SELECT DISTINCT
+        ss.artist_id,
+        ss.artist_name AS name,
+        CASE WHEN ss.artist_location IS NULL THEN 'N/A' ELSE ss.artist_location END AS location,
+        CASE WHEN ss.artist_latitude IS NULL THEN 0.0 ELSE ss.artist_latitude END AS latitude,
+        CASE WHEN ss.artist_longitude IS NULL THEN 0.0 ELSE ss.artist_longitude END AS longitude
+    FROM
+        staging_songs ss
+    WHERE
+        ss.artist_id IS NOT NULL;
+    DELETE FROM artists USING new_artists WHERE artists.artist_id = new_artists.artist_id;
+    INSERT INTO artists (artist_id, name, location, latitude, longitude)
+    SELECT artist_id, name, location, latitude, longitude FROM new_artists;
+    DROP TABLE new_artists;
+""")
+
+time_table_insert_incremental = load_state_lock + ("""
+    CREATE TEMP TABLE new_time AS
+    SELECT DISTINCT
+        se.ts AS start_time,
+        extract(hour from se.ts) AS hour,
+        extract(day from se.ts) AS day,
+        extract(week from se.ts) AS week,
+        extract(month from se.ts) AS month,
+        extract(year from se.ts) AS year,
+        extract(dayofweek from se.ts) AS weekday
+    FROM
+        staging_events se
+    WHERE se.page = 'NextSong' AND se.ts > {high_water};
+    DELETE FROM time USING new_time WHERE time.start_time = new_time.start_time;
+    INSERT INTO time (start_time, hour, day, week, month, year, weekday)
+    SELECT start_time, hour, day, week, month, year, weekday FROM new_time;
+    DROP TABLE new_time;
+    {update}
+""").format(high_water=high_water_select.format('time'),
+            update=high_water_update.format('time', "se.page = 'NextSong'", high_water_select.format('time')))
+
+# with surrogate keys, songs and artists already loaded keep their rows and keys, only new natural ids are inserted
+song_table_insert_incremental_surrogate = ("""
+    INSERT INTO songs (song_id, title, artist_id, year, duration)
+    SELECT DISTINCT
+        ss.song_id,
+        ss.title,
+        ss.artist_id,
+        ss.year,
+        ss.duration
+    FROM
+        staging_songs ss
+    WHERE NOT EXISTS (SELECT 1 FROM songs s WHERE s.song_id = ss.song_id)
+""")
+
+artist_table_insert_incremental_surrogate = ("""
+    INSERT INTO artists (artist_id, name, location, latitude, longitude)
+    SELECT DISTINCT
+        ss.artist_id,
+        ss.artist_name AS name,
+        CASE WHEN ss.artist_location IS NULL THEN 'N/A' ELSE ss.artist_location END AS location,
+        CASE WHEN ss.artist_latitude IS NULL THEN 0.0 ELSE ss.artist_latitude END AS latitude,
+        CASE WHEN ss.artist_longitude IS NULL THEN 0.0 ELSE ss.artist_longitude END AS longitude
+    FROM
+        staging_songs ss
+    WHERE
+        ss.artist_id IS NOT NULL
+        AND NOT EXISTS (SELECT 1 FROM artists a WHERE a.artist_id = ss.artist_id)
+""")
+
+songplay_table_insert_incremental_surrogate = load_state_lock + ("""
+    INSERT INTO songplays (start_time, user_id, level, song_key, artist_key, session_id, location, user_agent)
+    SELECT
+        se.ts AS start_time,
+        se.userId AS user_id,
+        se.level,
+        s.song_key,
+        a.artist_key,
+        se.sessionId AS session_id,
+        se.location,
+        se.userAgent AS user_agent
+    FROM
+        staging_events se
+        INNER JOIN staging_song_lookup sl
+            ON sl.title = se.song AND sl.artist_name = se.artist AND sl.duration = se.length
+        INNER JOIN (SELECT song_id, MIN(song_key) AS song_key FROM songs GROUP BY song_id) s
+            ON s.song_id = sl.song_id
+        INNER JOIN (SELECT artist_id, MIN(artist_key) AS artist_key FROM artists GROUP BY artist_id) a
+            ON a.artist_id = sl.artist_id
+    WHERE se.page = 'NextSong' AND se.ts > {high_water};
+    {update}
+""").format(high_water=high_water_select.format('songplays'),
+            update=high_water_update.format('songplays', "se.page = 'NextSong'", high_water_select.format('songplays')))
+
 # QUERY LISTS
+# copy and insert steps declare the steps they read from in 'depends', so that etl.py can run independent steps
+# concurrently
 
 create_table_queries = [
-    {'name': 'staging_events', 'query': staging_events_table_create},
-    {'name': 'staging_songs', 'query': staging_songs_table_create},
-    {'name': 'songplay', 'query': songplay_table_create},
-    {'name': 'user', 'query': user_table_create},
-    {'name': 'song', 'query': song_table_create},
-    {'name': 'artist', 'query': artist_table_create},
-    {'name': 'time', 'query': time_table_create}
+    {'name': 'staging_events', 'query': staging_events_table_create, 'spec': staging_events_spec},
+    {'name': 'staging_songs', 'query': staging_songs_table_create, 'spec': staging_songs_spec},
+    {'name': 'staging_song_lookup', 'query': staging_song_lookup_table_create, 'spec': staging_song_lookup_spec},
+    {'name': 'songplay', 'query': songplay_table_create, 'spec': songplay_spec},
+    {'name': 'user', 'query': user_table_create, 'spec': user_spec},
+    {'name': 'song', 'query': song_table_create, 'spec': song_spec},
+    {'name': 'artist', 'query': artist_table_create, 'spec': artist_spec},
+    {'name': 'time', 'query': time_table_create, 'spec': time_spec},
+    {'name': 'load_state', 'query': load_state_table_create, 'spec': load_state_spec}
 ]
 drop_table_queries = [
     {'name':'staging_events','query':staging_events_table_drop},
     {'name':'staging_songs','query':staging_songs_table_drop},
+    {'name':'staging_song_lookup','query':staging_song_lookup_table_drop},
     {'name':'songplay','query':songplay_table_drop},
     {'name':'user','query':user_table_drop},
     {'name':'song','query':song_table_drop},
     {'name':'artist','query':artist_table_drop},
-    {'name':'time','query':time_table_drop}
+    {'name':'time','query':time_table_drop},
+    {'name':'load_state','query':load_state_table_drop}
 ]
 copy_table_queries = [
-    {'name':'staging_events','query':staging_events_copy},
-    {'name':'staging_songs','query':staging_songs_copy}
+    {'name':'staging_events','query':staging_events_copy,'depends':[]},
+    {'name':'staging_songs','query':staging_songs_copy,'depends':[]}
+]
+copy_table_queries_shards = [
+    {'name':'staging_events','query':staging_events_copy_shards,'depends':[]},
+    {'name':'staging_songs','query':staging_songs_copy_shards,'depends':[]}
 ]
 insert_table_queries = [
-    {'name':'songplay','query':songplay_table_insert},
-    {'name':'user','query':user_table_insert},
-    {'name':'song','query':song_table_insert},
-    {'name':'artist','query':artist_table_insert},
-    {'name':'time','query':time_table_insert}
+    {'name':'song_lookup','query':staging_song_lookup_rebuild,'depends':['staging_songs']},
+    {'name':'songplay','query':songplay_table_insert,'depends':['staging_events','song_lookup']},
+    {'name':'user','query':user_table_insert,'depends':['staging_events']},
+    {'name':'song','query':song_table_insert,'depends':['staging_songs']},
+    {'name':'artist','query':artist_table_insert,'depends':['staging_songs']},
+    {'name':'time','query':time_table_insert,'depends':['staging_events']}
+]
+create_table_queries_surrogate = [
+    {'name': 'staging_events', 'query': staging_events_table_create, 'spec': staging_events_spec},
+    {'name': 'staging_songs', 'query': staging_songs_table_create, 'spec': staging_songs_spec},
+    {'name': 'staging_song_lookup', 'query': staging_song_lookup_table_create, 'spec': staging_song_lookup_spec},
+    {'name': 'songplay', 'query': songplay_table_create_surrogate, 'spec': songplay_spec_surrogate},
+    {'name': 'user', 'query': user_table_create, 'spec': user_spec},
+    {'name': 'song', 'query': song_table_create_surrogate, 'spec': song_spec_surrogate},
+    {'name': 'artist', 'query': artist_table_create_surrogate, 'spec': artist_spec_surrogate},
+    {'name': 'time', 'query': time_table_create, 'spec': time_spec},
+    {'name': 'load_state', 'query': load_state_table_create, 'spec': load_state_spec}
+]
+# songs and artists are inserted first so that songplays can look up their keys
+insert_table_queries_surrogate = [
+    {'name':'song_lookup','query':staging_song_lookup_rebuild,'depends':['staging_songs']},
+    {'name':'song','query':song_table_insert,'depends':['staging_songs']},
+    {'name':'artist','query':artist_table_insert,'depends':['staging_songs']},
+    {'name':'songplay','query':songplay_table_insert_surrogate,'depends':['staging_events','song_lookup','song','artist']},
+    {'name':'user','query':user_table_insert,'depends':['staging_events']},
+    {'name':'time','query':time_table_insert,'depends':['staging_events']}
+]
+copy_table_queries_incremental = [
+    {'name':'staging_events','query':staging_events_copy_incremental,'depends':[]},
+    {'name':'staging_songs','query':staging_songs_copy_incremental,'depends':[]}
+]
+copy_table_queries_shards_incremental = [
+    {'name':'staging_events','query':staging_events_copy_shards_incremental,'depends':[]},
+    {'name':'staging_songs','query':staging_songs_copy_shards_incremental,'depends':[]}
+]
+insert_table_queries_incremental = [
+    {'name':'song_lookup','query':staging_song_lookup_rebuild,'depends':['staging_songs']},
+    {'name':'songplay','query':songplay_table_insert_incremental,'depends':['staging_events','song_lookup']},
+    {'name':'user','query':user_table_insert_incremental,'depends':['staging_events']},
+    {'name':'song','query':song_table_insert_incremental,'depends':['staging_songs']},
+    {'name':'artist','query':artist_table_insert_incremental,'depends':['staging_songs']},
+    {'name':'time','query':time_table_insert_incremental,'depends':['staging_events']}
+]
+insert_table_queries_incremental_surrogate = [
+    {'name':'song_lookup','query':staging_song_lookup_rebuild,'depends':['staging_songs']},
+    {'name':'song','query':song_table_insert_incremental_surrogate,'depends':['staging_songs']},
+    {'name':'artist','query':artist_table_insert_incremental_surrogate,'depends':['staging_songs']},
+    {'name':'songplay','query':songplay_table_insert_incremental_surrogate,'depends':['staging_events','song_lookup','song','artist']},
+    {'name':'user','query':user_table_insert_incremental,'depends':['staging_events']},
+    {'name':'time','query':time_table_insert_incremental,'depends':['staging_events']}
 ]
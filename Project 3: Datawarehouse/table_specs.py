@@ -0,0 +1,217 @@
+from collections import namedtuple
+
+
+# a column of a table: its type, its Redshift compression encoding and its constraints
+Column = namedtuple("Column", ["name", "type", "encode", "not_null", "primary_key", "identity"],
+                    defaults=[False, False, False])
+
+# a table: its columns, how Redshift distributes its rows over the slices (EVEN, ALL or KEY on `distkey`)
+# and the columns of its compound sort key
+TableSpec = namedtuple("TableSpec", ["name", "columns", "diststyle", "distkey", "sortkey"],
+                       defaults=["EVEN", None, ()])
+
+# encodings used below: the leading sort key column is left RAW so that its zone maps stay precise,
+# integers and timestamps use AZ64, text and floats ZSTD, and low-cardinality text BYTEDICT
+
+
+# STAGING TABLES
+# songs are distributed on the song title so that building the song lookup does not redistribute rows.
+# Events are spread evenly: events other than NextSong have no song and would all land on one slice,
+# skewing the COPY and the join, which redistributes the plays instead
+
+staging_events_spec = TableSpec('staging_events', [
+    Column('artist', 'VARCHAR', 'ZSTD'),
+    Column('auth', 'VARCHAR', 'BYTEDICT'),
+    Column('firstName', 'VARCHAR', 'ZSTD'),
+    Column('gender', 'VARCHAR', 'BYTEDICT'),
+    Column('itemInSession', 'INTEGER', 'AZ64'),
+    Column('lastName', 'VARCHAR', 'ZSTD'),
+    Column('length', 'FLOAT', 'ZSTD'),
+    Column('level', 'VARCHAR', 'BYTEDICT'),
+    Column('location', 'VARCHAR', 'ZSTD'),
+    Column('method', 'VARCHAR', 'BYTEDICT'),
+    Column('page', 'VARCHAR', 'BYTEDICT'),
+    Column('registration', 'FLOAT', 'ZSTD'),
+    Column('sessionId', 'INTEGER', 'AZ64'),
+    Column('song', 'VARCHAR', 'ZSTD'),
+    Column('status', 'INTEGER', 'AZ64'),
+    Column('ts', 'TIMESTAMP', 'AZ64'),
+    Column('userAgent', 'VARCHAR', 'ZSTD'),
+    Column('userId', 'INTEGER', 'AZ64'),
+], 'EVEN')
+
+staging_songs_spec = TableSpec('staging_songs', [
+    Column('num_songs', 'INTEGER', 'AZ64'),
+    Column('artist_id', 'VARCHAR', 'ZSTD'),
+    Column('artist_latitude', 'FLOAT', 'ZSTD'),
+    Column('artist_longitude', 'FLOAT', 'ZSTD'),
+    Column('artist_location', 'VARCHAR', 'ZSTD'),
+    Column('artist_name', 'VARCHAR', 'ZSTD'),
+    Column('song_id', 'VARCHAR', 'ZSTD'),
+    Column('title', 'VARCHAR', 'ZSTD'),
+    Column('duration', 'FLOAT', 'ZSTD'),
+    Column('year', 'INTEGER', 'AZ64'),
+], 'KEY', 'title')
+
+staging_song_lookup_spec = TableSpec('staging_song_lookup', [
+    Column('title', 'VARCHAR', 'ZSTD'),
+    Column('artist_name', 'VARCHAR', 'ZSTD'),
+    Column('duration', 'FLOAT', 'ZSTD'),
+    Column('song_id', 'VARCHAR', 'ZSTD'),
+    Column('artist_id', 'VARCHAR', 'ZSTD'),
+], 'KEY', 'title')
+
+# FACT AND DIMENSION TABLES
+# songplays and songs, the largest dimension, are distributed on song_id so that their join stays on each slice,
+# the small dimensions are copied to every node, and songplays are sorted by time for range scans
+
+songplay_spec = TableSpec('songplays', [
+    Column('songplay_id', 'INTEGER', 'AZ64', primary_key=True, identity=True),
+    Column('start_time', 'TIMESTAMP', 'RAW'),
+    Column('user_id', 'INTEGER', 'AZ64'),
+    Column('level', 'VARCHAR', 'BYTEDICT'),
+    Column('song_id', 'VARCHAR', 'ZSTD'),
+    Column('artist_id', 'VARCHAR', 'ZSTD'),
+    Column('session_id', 'INTEGER', 'AZ64'),
+    Column('location', 'VARCHAR', 'ZSTD'),
+    Column('user_agent', 'VARCHAR', 'ZSTD'),
+], 'KEY', 'song_id', ('start_time', 'user_id'))
+
+user_spec = TableSpec('users', [
+    Column('user_id', 'INTEGER', 'RAW', primary_key=True),
+    Column('first_name', 'VARCHAR', 'ZSTD'),
+    Column('last_name', 'VARCHAR', 'ZSTD'),
+    Column('gender', 'VARCHAR', 'BYTEDICT'),
+    Column('level', 'VARCHAR', 'BYTEDICT'),
+], 'ALL', None, ('user_id',))
+
+song_spec = TableSpec('songs', [
+    Column('song_id', 'VARCHAR', 'RAW', primary_key=True),
+    Column('title', 'VARCHAR', 'ZSTD'),
+    Column('artist_id', 'VARCHAR', 'ZSTD'),
+    Column('year', 'INTEGER', 'AZ64'),
+    Column('duration', 'FLOAT', 'ZSTD'),
+], 'KEY', 'song_id', ('song_id',))
+
+artist_spec = TableSpec('artists', [
+    Column('artist_id', 'VARCHAR', 'RAW', primary_key=True),
+    Column('name', 'VARCHAR', 'ZSTD'),
+    Column('location', 'VARCHAR', 'ZSTD'),
+    Column('latitude', 'FLOAT', 'ZSTD'),
+    Column('longitude', 'FLOAT', 'ZSTD'),
+], 'ALL', None, ('artist_id',))
+
+time_spec = TableSpec('time', [
+    Column('start_time', 'TIMESTAMP', 'RAW', not_null=True, primary_key=True),
+    Column('hour', 'INTEGER', 'AZ64', not_null=True),
+    Column('day', 'INTEGER', 'AZ64', not_null=True),
+    Column('week', 'INTEGER', 'AZ64', not_null=True),
+    Column('month', 'INTEGER', 'AZ64', not_null=True),
+    Column('year', 'INTEGER', 'AZ64', not_null=True),
+    Column('weekday', 'VARCHAR(20)', 'BYTEDICT', not_null=True),
+], 'ALL', None, ('start_time',))
+
+load_state_spec = TableSpec('load_state', [
+    Column('name', 'VARCHAR', 'RAW', not_null=True),
+    Column('high_water', 'TIMESTAMP', 'AZ64', not_null=True),
+], 'ALL')
+
+# SURROGATE KEYS
+# songplays and songs are distributed on the integer song key instead
+
+songplay_spec_surrogate = TableSpec('songplays', [
+    Column('songplay_id', 'INTEGER', 'AZ64', primary_key=True, identity=True),
+    Column('start_time', 'TIMESTAMP', 'RAW'),
+    Column('user_id', 'INTEGER', 'AZ64'),
+    Column('level', 'VARCHAR', 'BYTEDICT'),
+    Column('song_key', 'INTEGER', 'AZ64'),
+    Column('artist_key', 'INTEGER', 'AZ64'),
+    Column('session_id', 'INTEGER', 'AZ64'),
+    Column('location', 'VARCHAR', 'ZSTD'),
+    Column('user_agent', 'VARCHAR', 'ZSTD'),
+], 'KEY', 'song_key', ('start_time', 'user_id'))
+
+song_spec_surrogate = TableSpec('songs', [
+    Column('song_key', 'INTEGER', 'RAW', primary_key=True, identity=True),
+    Column('song_id', 'VARCHAR', 'ZSTD', not_null=True),
+    Column('title', 'VARCHAR', 'ZSTD'),
+    Column('artist_id', 'VARCHAR', 'ZSTD'),
+    Column('year', 'INTEGER', 'AZ64'),
+    Column('duration', 'FLOAT', 'ZSTD'),
+], 'KEY', 'song_key', ('song_key',))
+
+artist_spec_surrogate = TableSpec('artists', [
+    Column('artist_key', 'INTEGER', 'RAW', primary_key=True, identity=True),
+    Column('artist_id', 'VARCHAR', 'ZSTD', not_null=True),
+    Column('name', 'VARCHAR', 'ZSTD'),
+    Column('location', 'VARCHAR', 'ZSTD'),
+    Column('latitude', 'FLOAT', 'ZSTD'),
+    Column('longitude', 'FLOAT', 'ZSTD'),
+], 'ALL', None, ('artist_key',))
+
+
+def column_definition(column, dialect):
+    """
+    This function returns the definition of a column in a CREATE TABLE statement.
+    """
+    parts = []
+    if column.identity:
+        parts.append('IDENTITY(0,1)' if dialect == 'redshift'
+                     else 'GENERATED BY DEFAULT AS IDENTITY (MINVALUE 0 START WITH 0)')
+    if dialect == 'redshift':
+        parts.append('ENCODE {}'.format(column.encode))
+    if column.not_null:
+        parts.append('NOT NULL')
+    if column.primary_key:
+        parts.append('PRIMARY KEY')
+    return ('{:<20}{:<16}'.format(column.name, column.type) + ' '.join(parts)).rstrip()
+
+
+def index_statements(spec):
+    """
+    This function returns the CREATE INDEX statements standing in for the sort and distribution keys of a table
+    in Postgres: an index on the sort key columns, for range scans, and one on the distribution key, for joins on it,
+    each unless the primary key or another index already starts with them.
+    """
+    primary_keys = [column.name for column in spec.columns if column.primary_key]
+    indexes = []
+    if spec.sortkey and list(spec.sortkey) != primary_keys[:len(spec.sortkey)]:
+        indexes.append(list(spec.sortkey))
+    if spec.diststyle == 'KEY' and all(columns[0] != spec.distkey for columns in indexes + [primary_keys] if columns):
+        indexes.append([spec.distkey])
+    return ['CREATE INDEX IF NOT EXISTS {}_{}_idx ON {} ({})'.format(spec.name, '_'.join(columns).lower(), spec.name,
+                                                                     ', '.join(columns))
+            for columns in indexes]
+
+
+def create_table(spec, dialect='redshift'):
+    """
+    This function returns the statement creating a table from its spec.
+
+    With the `redshift` dialect, columns get their compression encoding and the table its distribution style
+    and compound sort key. With the `postgres` dialect, which has neither, the sort and distribution keys are
+    replaced by indexes, created by statements following the CREATE TABLE.
+
+    Parameters
+    ----------
+    spec        : TableSpec
+                    Table to create
+    dialect     : string
+                    `redshift` or `postgres`
+
+    Returns
+    -------
+    SQL statements separated by semicolons
+    """
+    if dialect not in ('redshift', 'postgres'):
+        raise ValueError('unknown dialect {}'.format(dialect))
+    columns = ',\n'.join('        ' + column_definition(column, dialect) for column in spec.columns)
+    query = '\n    CREATE TABLE IF NOT EXISTS {}(\n{}\n    )'.format(spec.name, columns)
+    if dialect == 'redshift':
+        query += '\n    DISTSTYLE {}'.format(spec.diststyle)
+        if spec.diststyle == 'KEY':
+            query += '\n    DISTKEY ({})'.format(spec.distkey)
+        if spec.sortkey:
+            query += '\n    COMPOUND SORTKEY ({})'.format(', '.join(spec.sortkey))
+        return query + '\n'
+    return ';\n'.join([query] + ['    ' + index for index in index_statements(spec)]) + '\n'
@@ -0,0 +1,111 @@
+import re
+import pytest
+import table_specs
+from table_specs import (create_table, index_statements, staging_events_spec, staging_songs_spec,
+                         staging_song_lookup_spec, songplay_spec, user_spec, song_spec, artist_spec, time_spec,
+                         load_state_spec, songplay_spec_surrogate, song_spec_surrogate, artist_spec_surrogate)
+
+
+ALL_SPECS = [staging_events_spec, staging_songs_spec, staging_song_lookup_spec, songplay_spec, user_spec, song_spec,
+             artist_spec, time_spec, load_state_spec, songplay_spec_surrogate, song_spec_surrogate,
+             artist_spec_surrogate]
+
+
+def column_lines(query):
+    """
+    This function returns the column definitions of a CREATE TABLE statement.
+    """
+    body = query[query.index('(') + 1:query.index('\n    )')]
+    return [line.strip().rstrip(',') for line in body.strip().split('\n')]
+
+
+@pytest.mark.parametrize('spec', [user_spec, artist_spec, time_spec, artist_spec_surrogate])
+def test_small_dimensions_are_copied_to_every_node(spec):
+    query = create_table(spec)
+    assert 'DISTSTYLE ALL' in query
+    assert 'DISTKEY' not in query
+
+
+def test_staging_events_spread_evenly():
+    query = create_table(staging_events_spec)
+    assert 'DISTSTYLE EVEN' in query
+    assert 'DISTKEY' not in query
+
+
+def test_songplays_distributed_on_song_id_and_sorted_by_time():
+    query = create_table(songplay_spec)
+    assert 'DISTSTYLE KEY' in query
+    assert 'DISTKEY (song_id)' in query
+    assert 'COMPOUND SORTKEY (start_time, user_id)' in query
+
+
+def test_surrogate_songplays_and_songs_distributed_on_song_key():
+    assert 'DISTKEY (song_key)' in create_table(songplay_spec_surrogate)
+    assert 'DISTKEY (song_key)' in create_table(song_spec_surrogate)
+    assert 'COMPOUND SORTKEY (start_time, user_id)' in create_table(songplay_spec_surrogate)
+
+
+@pytest.mark.parametrize('spec', [spec for spec in ALL_SPECS if spec.sortkey], ids=lambda spec: spec.name)
+def test_leading_sort_key_column_is_raw(spec):
+    lines = {line.split()[0]: line for line in column_lines(create_table(spec))}
+    assert 'ENCODE RAW' in lines[spec.sortkey[0]]
+
+
+@pytest.mark.parametrize('spec', ALL_SPECS, ids=lambda spec: spec.name)
+def test_every_redshift_column_is_encoded(spec):
+    lines = column_lines(create_table(spec))
+    assert len(lines) == len(spec.columns)
+    assert all(re.search(r'\bENCODE (RAW|AZ64|ZSTD|BYTEDICT)\b', line) for line in lines)
+
+
+def test_redshift_identity_column():
+    assert re.search(r'songplay_id\s+INTEGER\s+IDENTITY\(0,1\) ENCODE AZ64 PRIMARY KEY', create_table(songplay_spec))
+
+
+@pytest.mark.parametrize('spec', ALL_SPECS, ids=lambda spec: spec.name)
+def test_postgres_has_no_redshift_clauses(spec):
+    query = create_table(spec, 'postgres')
+    for clause in ['ENCODE', 'DISTSTYLE', 'DISTKEY', 'SORTKEY', 'IDENTITY(0,1)']:
+        assert clause not in query
+
+
+def test_postgres_identity_rewrite():
+    query = create_table(song_spec_surrogate, 'postgres')
+    assert re.search(r'song_key\s+INTEGER\s+GENERATED BY DEFAULT AS IDENTITY \(MINVALUE 0 START WITH 0\) PRIMARY KEY',
+                     query)
+
+
+@pytest.mark.parametrize('spec, indexes', [
+    (staging_events_spec, []),
+    (staging_songs_spec, ['CREATE INDEX IF NOT EXISTS staging_songs_title_idx ON staging_songs (title)']),
+    (staging_song_lookup_spec,
+     ['CREATE INDEX IF NOT EXISTS staging_song_lookup_title_idx ON staging_song_lookup (title)']),
+    (songplay_spec, ['CREATE INDEX IF NOT EXISTS songplays_start_time_user_id_idx ON songplays (start_time, user_id)',
+                     'CREATE INDEX IF NOT EXISTS songplays_song_id_idx ON songplays (song_id)']),
+    (songplay_spec_surrogate,
+     ['CREATE INDEX IF NOT EXISTS songplays_start_time_user_id_idx ON songplays (start_time, user_id)',
+      'CREATE INDEX IF NOT EXISTS songplays_song_key_idx ON songplays (song_key)']),
+    # the primary key already covers the sort and distribution keys
+    (user_spec, []),
+    (song_spec, []),
+    (artist_spec, []),
+    (time_spec, []),
+    (song_spec_surrogate, []),
+    (artist_spec_surrogate, []),
+    (load_state_spec, []),
+], ids=lambda value: getattr(value, 'name', ''))
+def test_postgres_indexes(spec, indexes):
+    assert index_statements(spec) == indexes
+    statements = [statement.strip() for statement in create_table(spec, 'postgres').split(';')]
+    assert statements[0].startswith('CREATE TABLE IF NOT EXISTS {}('.format(spec.name))
+    assert statements[1:] == indexes
+
+
+def test_unknown_dialect():
+    with pytest.raises(ValueError):
+        create_table(songplay_spec, 'mysql')
+
+
+def test_every_spec_is_tested():
+    specs = [value for name, value in vars(table_specs).items() if name.endswith(('_spec', '_spec_surrogate'))]
+    assert len(specs) == len(ALL_SPECS)
@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import zipfile
+import argparse
+import tempfile
+import urllib.request
+from pyspark.sql import SparkSession
+from etl import process_song_data, read_log_data, read_song_lookup, build_songplays_table, BROADCAST_THRESHOLD
+
+
+# songplays joining songs on their title and artists on their name separately, replaced by the song lookup
+songplays_table_two_joins = ('''
+    SELECT
+        monotonically_increasing_id() AS songplay_id,
+        log.log_timestamp AS start_time,
+        month(log.log_timestamp) AS month,
+        year(log.log_timestamp) AS year,
+        log.userId AS user_id,
+        log.level,
+        songs.song_id,
+        artists.artist_id,
+        log.sessionId AS session_id,
+        log.location,
+        log.userAgent AS user_agent
+    FROM
+        logs_view log
+        LEFT OUTER JOIN songs_view songs on log.song = songs.title
+        LEFT OUTER JOIN artists_view artists on log.artist = artists.artist_name
+''')
+
+
+def create_local_spark_session(shuffle_partitions):
+    '''
+    This function creates a Spark session in local mode. Tables are only broadcast when a query asks for it,
+    as the sample songs and artists are far smaller than the catalog Spark would not broadcast on S3.
+    '''
+    return SparkSession \
+        .builder \
+        .master('local[*]') \
+        .config('spark.sql.autoBroadcastJoinThreshold', -1) \
+        .config('spark.ui.showConsoleProgress', 'false') \
+        .config('spark.sql.shuffle.partitions', shuffle_partitions) \
+        .getOrCreate()
+
+
+def extract_sample_data(directory):
+    '''
+    This function extracts the zipped sample data of the project into the layout of the S3 bucket.
+    '''
+    data = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+    zipfile.ZipFile(os.path.join(data, 'log-data.zip')).extractall(os.path.join(directory, 'log_data'))
+    zipfile.ZipFile(os.path.join(data, 'song-data.zip')).extractall(directory)
+    return directory
+
+
+def rest_api(spark, path):
+    '''
+    This function returns the response of the monitoring REST API of the Spark application.
+    '''
+    url = '{}/api/v1/applications/{}/{}'.format(spark.sparkContext.uiWebUrl, spark.sparkContext.applicationId, path)
+    with urllib.request.urlopen(url) as response:
+        return json.load(response)
+
+
+def shuffle_bytes(spark, group, timeout=30):
+    '''
+    This function returns the bytes read and written by the shuffles of the jobs of a job group,
+    waiting for the monitoring data of their stages to be complete.
+    '''
+    deadline = time.time() + timeout
+    while True:
+        stage_ids = {stage_id for job in rest_api(spark, 'jobs') if job.get('jobGroup') == group
+                     for stage_id in job['stageIds']}
+        stages = [stage for stage in rest_api(spark, 'stages') if stage['stageId'] in stage_ids]
+        if all(stage['status'] in ('COMPLETE', 'SKIPPED') for stage in stages) or time.time() > deadline:
+            return (sum(stage['shuffleReadBytes'] for stage in stages),
+                    sum(stage['shuffleWriteBytes'] for stage in stages))
+        time.sleep(0.5)
+
+
+def write_songplays(spark, label, build, path):
+    '''
+    This function builds and writes songplays as a job group and returns the wall time, in seconds,
+    and the bytes read and written by its shuffles. Cached tables are dropped first, so every run
+    builds the song lookup again.
+    '''
+    spark.catalog.clearCache()
+    spark.sparkContext.setJobGroup(label, label)
+    start = time.perf_counter()
+    songplays_table = build()
+    songplays_table.write.parquet(path, mode='overwrite', partitionBy=['year', 'month'])
+    seconds = time.perf_counter() - start
+    spark.sparkContext.setJobGroup('check', 'check')
+    return (seconds,) + shuffle_bytes(spark, label)
+
+
+def same_ids(a, b):
+    '''
+    This function returns whether two songplays tables give the same ids to the same song plays.
+    '''
+    columns = ['songplay_id', 'start_time', 'user_id', 'session_id', 'song_id']
+    a, b = a.select(columns), b.select(columns)
+    return a.subtract(b).count() == 0 and b.subtract(a).count() == 0
+
+
+def main():
+    '''
+    Builds songplays with the former two joins, with the song lookup and with the broadcast song lookup
+    in Spark local mode, then prints the rows, wall time and shuffle bytes of each and checks that
+    songplay ids stay the same when the log data is partitioned differently.
+    '''
+    parser = argparse.ArgumentParser(description='Compare the two joins and the song lookup join building songplays '
+                                                 'in Spark local mode.')
+    parser.add_argument('--input', help='directory with log_data and song_data, the zipped sample data by default')
+    parser.add_argument('--output', help='directory the tables are written to, a temporary one by default')
+    parser.add_argument('--shuffle-partitions', type=int, default=8, help='number of partitions of shuffles')
+    args = parser.parse_args()
+
+    input_data = args.input or extract_sample_data(tempfile.mkdtemp(prefix='data_lake_input_'))
+    output_data = args.output or tempfile.mkdtemp(prefix='data_lake_output_')
+    spark = create_local_spark_session(args.shuffle_partitions)
+
+    process_song_data(spark, input_data, output_data)
+    log_df = read_log_data(spark, input_data)
+    log_df.createOrReplaceTempView('logs_view')
+    plays = log_df.count()
+    # also registers songs_view and artists_view read by the two joins
+    lookup = read_song_lookup(spark, output_data)
+
+    runs = [
+        ('two joins', lambda: spark.sql(songplays_table_two_joins)),
+        ('lookup', lambda: build_songplays_table(spark, lookup, 0)[0]),
+        ('broadcast', lambda: build_songplays_table(spark, lookup, BROADCAST_THRESHOLD)[0]),
+    ]
+    results = []
+    for label, build in runs:
+        path = os.path.join(output_data, 'songplays_' + label.replace(' ', '_'))
+        seconds, read_bytes, written_bytes = write_songplays(spark, label, build, path)
+        songplays_table = spark.read.parquet(path)
+        results.append((label, songplays_table.count(), songplays_table.filter('song_id IS NOT NULL').count(),
+                        songplays_table.select('songplay_id').distinct().count(), seconds, read_bytes, written_bytes))
+
+    print()
+    print('{} song plays.'.format(plays))
+    print('{:<10} {:>9} {:>8} {:>9} {:>8} {:>14} {:>14}'.format(
+        'join', 'rows', 'matched', 'ids', 'seconds', 'shuffle read', 'shuffle write'))
+    for result in results:
+        print('{:<10} {:9d} {:8d} {:9d} {:8.2f} {:14d} {:14d}'.format(*result))
+
+    # the same plays read in other partitions get the same ids
+    log_df.repartition(args.shuffle_partitions * 3 + 1).createOrReplaceTempView('logs_view')
+    repartitioned = build_songplays_table(spark, lookup, BROADCAST_THRESHOLD)[0]
+    print('Same songplay ids with other partitions: {}'.format(
+        same_ids(spark.read.parquet(os.path.join(output_data, 'songplays_broadcast')), repartitioned)))
+    spark.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -12,6 +12,10 @@ config.read('dl.cfg')
 os.environ['AWS_ACCESS_KEY_ID']=config['AWS']['AWS_ACCESS_KEY_ID']
 os.environ['AWS_SECRET_ACCESS_KEY']=config['AWS']['AWS_SECRET_ACCESS_KEY']
 
+# largest estimated size in bytes of the song lookup sent whole to every executor, so that joining song plays to it
+# does not shuffle the log data
+BROADCAST_THRESHOLD = 64 * 1024 * 1024
+
 
 def create_spark_session():
     '''
@@ -102,7 +106,150 @@ def process_song_data(spark, input_data, output_data):
     artists_table.write.parquet(artists_path, mode=mode)
     print('   Done.', end=end)
 
-def process_log_data(spark, input_data, output_data):
+def read_log_data(spark, input_data):
+    '''
+    This function reads log_data and returns its song plays, the events of page NextSong,
+    with their timestamp and date.
+    
+    Parameters
+    ----------
+    spark       : object
+                    Spark Session Object
+    input_data  : str
+                    path of log_data to read
+    '''
+    # filepath to log data file
+    log_data_path = os.path.join(input_data, 'log_data/*.json')
+    # read log data file
+    log_df = spark.read.json(log_data_path)
+    
+    # filter by actions for song plays
+    log_df = log_df.filter(log_df.page == 'NextSong')
+    # create timestamp column from original timestamp column
+    log_df = log_df.withColumn('log_timestamp', F.to_timestamp(log_df.ts/1000))
+    # create datetime column from log_timestamp column
+    log_df = log_df.withColumn('log_datetime', F.to_date(log_df.log_timestamp))
+    return log_df
+
+def read_song_lookup(spark, output_data):
+    '''
+    This function reads the songs and artists tables and returns one song per title, artist name and duration,
+    the keys log events carry, so that every song play matches at most one song.
+    Songs sharing all three keep the smallest song_id.
+    
+    Parameters
+    ----------
+    spark       : object
+                    Spark Session Object
+    output_data : str
+                    path to the songs and artists tables
+    '''
+    # read in songs data to use for songplays table
+    songs_path = os.path.join(output_data, 'songs')
+    song_df = spark.read.parquet(songs_path)
+    # create songs view for SQL queries
+    song_df.createOrReplaceTempView("songs_view")
+    
+    # read in artists data to use for songplays table
+    artists_path = os.path.join(output_data, 'artists')
+    artists_df = spark.read.parquet(artists_path)
+    # create artists view for SQL queries
+    artists_df.createOrReplaceTempView('artists_view')
+    
+    # songs joined to their artists once, on the small song catalog instead of the log data
+    return spark.sql('''
+        SELECT
+            lookup.title,
+            lookup.artist_name,
+            lookup.duration,
+            lookup.song_id,
+            lookup.artist_id
+        FROM (
+            SELECT
+                songs.title,
+                artists.artist_name,
+                songs.duration,
+                songs.song_id,
+                songs.artist_id,
+                ROW_NUMBER() OVER (PARTITION BY songs.title, artists.artist_name, songs.duration
+                                   ORDER BY songs.song_id, songs.artist_id) AS song_rank
+            FROM
+                songs_view songs
+                INNER JOIN artists_view artists ON songs.artist_id = artists.artist_id
+        ) lookup
+        WHERE
+            lookup.song_rank = 1
+    ''')
+
+def estimate_size(lookup):
+    '''
+    This function returns an estimate of the size in bytes of the song lookup: its text, missing values counting
+    for none, plus 8 bytes per number.
+    
+    Parameters
+    ----------
+    lookup      : DataFrame
+                    song lookup returned by `read_song_lookup`
+    '''
+    row = lookup.select(
+        F.count(F.lit(1)).alias('rows'),
+        F.sum(sum(F.coalesce(F.length(column), F.lit(0))
+                  for column in ['title', 'artist_name', 'song_id', 'artist_id'])).alias('text_bytes')
+    ).first()
+    return (row['text_bytes'] or 0) + row['rows'] * 8
+
+def build_songplays_table(spark, lookup, broadcast_threshold=BROADCAST_THRESHOLD):
+    '''
+    This function returns the songplays table of the song plays of `logs_view`, joined to the song lookup
+    on song title, artist name and length. Each play matches at most one song, so no row is multiplied,
+    and plays without a match keep null song_id and artist_id.
+    
+    When the lookup is estimated under `broadcast_threshold` bytes it is broadcast to every executor and
+    the log data is joined where it is read, without being shuffled.
+    
+    songplay_id is a hash of the natural key of the event, its time, user, session and item in session,
+    so the same play gets the same id on every run whatever the partitioning of the data.
+    
+    Parameters
+    ----------
+    spark       : object
+                    Spark Session Object
+    lookup      : DataFrame
+                    song lookup returned by `read_song_lookup`
+    broadcast_threshold : integer
+                    largest estimated size in bytes of a broadcast lookup, 0 to never broadcast it
+    
+    Returns
+    -------
+    songplays DataFrame and whether the lookup is broadcast
+    '''
+    # the lookup is read twice, to estimate its size and to join it
+    lookup = lookup.cache()
+    broadcast = estimate_size(lookup) <= broadcast_threshold
+    lookup.createOrReplaceTempView('song_lookup_view')
+    
+    songplays_table = spark.sql('''
+        SELECT {}
+            CAST(conv(substr(sha2(concat_ws('|', log.ts, log.userId, log.sessionId, log.itemInSession), 256), 1, 15),
+                      16, 10) AS BIGINT) AS songplay_id,
+            log.log_timestamp AS start_time, 
+            month(log.log_timestamp) AS month, 
+            year(log.log_timestamp) AS year, 
+            log.userId AS user_id,
+            log.level, 
+            lookup.song_id,
+            lookup.artist_id, 
+            log.sessionId AS session_id,
+            log.location, 
+            log.userAgent AS user_agent
+        FROM 
+            logs_view log
+            LEFT OUTER JOIN song_lookup_view lookup
+                ON log.song = lookup.title AND log.artist = lookup.artist_name AND log.length = lookup.duration
+    '''.format('/*+ BROADCAST(lookup) */' if broadcast else ''))
+    return songplays_table, broadcast
+
+def process_log_data(spark, input_data, output_data, broadcast_threshold=BROADCAST_THRESHOLD):
     '''
     This function reads log_data from S3 then processes it forming users, time and songplay tables
     written into S3 partitioned by some columns if needed in parquet format        
@@ -114,6 +261,8 @@ def process_log_data(spark, input_data, output_data):
                     path of song_data to read
     output_data : str
                     path to the results stored
+    broadcast_threshold : integer
+                    largest estimated size in bytes of the song lookup broadcast to the executors
     '''
     mode='overwrite'
     partitionBy = []
@@ -124,19 +273,9 @@ def process_log_data(spark, input_data, output_data):
     print_header('Reading From S3', char='-')
     
     print(' - Reading log_data files.')
-    # filepath to log data file
-    log_data_path = os.path.join(input_data, 'log_data/*.json')
-    # read log data file
-    log_df = spark.read.json(log_data_path)
+    log_df = read_log_data(spark, input_data)
     print('   Done.',end=end)
     
-    # filter by actions for song plays
-    log_df = log_df.filter(log_df.page == 'NextSong')
-    # create timestamp column from original timestamp column
-    log_df = log_df.withColumn('log_timestamp', F.to_timestamp(log_df.ts/1000))
-    # create datetime column from log_timestamp column
-    log_df = log_df.withColumn('log_datetime', F.to_date(log_df.log_timestamp))
-    
     # create logs view for SQL queries
     log_df.createOrReplaceTempView("logs_view")
     # extract columns for users table    
@@ -186,39 +325,11 @@ def process_log_data(spark, input_data, output_data):
     time_table.write.parquet(time_path, mode=mode, partitionBy=partitionBy)
     print('   Done.', end=end)
     
-    # read in songs data to use for songplays table
-    songs_path = os.path.join(output_data, 'songs')
-    song_df = spark.read.parquet(songs_path)
-    # create songs view for SQL queries
-    song_df.createOrReplaceTempView("songs_view")
-    
-    # read in artists data to use for songplays table
-    artists_path = os.path.join(output_data, 'artists')
-    artists_df = spark.read.parquet(artists_path)
-    # create artists view for SQL queries
-    artists_df.createOrReplaceTempView('artists_view')
-    
-    # extract columns from joined song, artist sand log tables to create songplays table 
-    songplays_table = spark.sql('''
-        SELECT
-            monotonically_increasing_id() AS songplay_id, 
-            log.log_timestamp AS start_time, 
-            month(log.log_timestamp) AS month, 
-            year(log.log_timestamp) AS year, 
-            log.userId AS user_id,
-            log.level, 
-            songs.song_id,
-            artists.artist_id, 
-            log.sessionId AS session_id,
-            log.location, 
-            log.userAgent AS user_agent
-        FROM 
-            logs_view log
-            LEFT OUTER JOIN songs_view songs on log.song = songs.title 
-            LEFT OUTER JOIN artists_view artists on log.artist = artists.artist_name
-    ''')
+    # join song plays to the song lookup to create songplays table
+    songplays_table, broadcast = build_songplays_table(spark, read_song_lookup(spark, output_data),
+                                                       broadcast_threshold)
     
-    print(' - Writing songplays_table in parquet format.')
+    print(' - Writing songplays_table in parquet format{}.'.format(', song lookup broadcast' if broadcast else ''))
     # partition songplays table by: ['year', 'month']
     partitionBy = ['year','month']
     # path for songplays table output results
@@ -0,0 +1,504 @@
+import os
+import csv
+import glob
+import json
+import time
+import heapq
+import hashlib
+import argparse
+import datetime
+from collections import Counter, defaultdict
+import numpy as np
+
+
+# sample data the distributions are learned from. Only the Project 1-a samples are read: the Project 4 zips
+# and the event_data csv files of Project 1-b hold the same 8056 events and 71 songs
+SAMPLE_LOG_DATA = 'Project 1-a: Data Modeling with Postgres/data/log_data'
+SAMPLE_SONG_DATA = 'Project 1-a: Data Modeling with Postgres/data/song_data'
+
+# fields of a log event in the order of the log files, and of the event_data csv files of Project 1-b
+LOG_FIELDS = ["artist", "auth", "firstName", "gender", "itemInSession", "lastName", "length", "level", "location",
+              "method", "page", "registration", "sessionId", "song", "status", "ts", "userAgent", "userId"]
+CSV_FIELDS = ["artist", "auth", "firstName", "gender", "itemInSession", "lastName", "length", "level", "location",
+              "method", "page", "registration", "sessionId", "song", "status", "ts", "userId"]
+
+# end of a session in the page transitions
+END = None
+
+DAY_MS = 24 * 3600 * 1000
+HOUR_MS = 3600 * 1000
+
+
+def get_files(directory):
+    """
+    This function returns the sorted paths of the json files under a directory.
+    """
+    return sorted(glob.glob(os.path.join(directory, '**', '*.json'), recursive=True))
+
+
+def read_records(filepaths):
+    """
+    This function yields the json records of files holding one record per line.
+    """
+    for filepath in filepaths:
+        with open(filepath) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def to_ms(date):
+    """
+    This function returns the epoch milliseconds of the midnight of a date.
+    """
+    return int(datetime.datetime(date.year, date.month, date.day, tzinfo=datetime.timezone.utc).timestamp() * 1000)
+
+
+def weighted_choice(rng, cum_weights):
+    """
+    This function returns the index drawn from cumulative weights.
+    """
+    return int(np.searchsorted(cum_weights, rng.random() * cum_weights[-1], side='right'))
+
+
+class SparkifyModel:
+    """
+    Distributions of the Sparkify sample data the synthetic data is drawn from.
+
+    A session is a walk on the page transitions observed in the sample sessions, a state being
+    (level, page, auth, method, status), so that the `itemInSession` sequences, logins, logouts and level
+    changes after `Submit Upgrade` and `Submit Downgrade` follow the sample. Sessions start at the
+    sample rate of each weekday and hour, by users drawn by their sample activity.
+
+    Attributes
+    ----------
+    start       : date
+                    First day of the sample
+    days        : integer
+                    Number of days of the sample
+    users       : list
+                    (gender, first level, number of sessions) of each sample user
+    songs       : list
+                    Sample song records
+    match_rate  : float
+                    Share of the played songs found in the sample songs
+    """
+
+    def __init__(self):
+        self.start = None
+        self.days = 0
+        self.users = []
+        self.first_names = {}
+        self.last_names = []
+        self.locations = []
+        self.user_agents = []
+        self.registration_ages = []
+        self.hourly_sessions = np.zeros((7, 24))
+        self.start_states = {}
+        self.transitions = {}
+        self.gaps = {}
+        self.played = []
+        self.played_weights = None
+        self.songs = []
+        self.match_rate = 0.0
+
+    @classmethod
+    def learn(cls, log_data, song_data):
+        """
+        Learns the distributions from sample log and song data.
+
+        Parameters
+        ----------
+        log_data    : string
+                        Path to a log_data directory
+        song_data   : string
+                        Path to a song_data directory
+        """
+        model = cls()
+        model.songs = list(read_records(get_files(song_data)))
+
+        sessions = defaultdict(list)
+        for event in read_records(get_files(log_data)):
+            sessions[event['sessionId']].append(event)
+
+        days = set()
+        user_sessions = Counter()
+        user_info = {}
+        first_names = defaultdict(list)
+        played = Counter()
+        starts = defaultdict(Counter)
+        transitions = defaultdict(Counter)
+        gaps = defaultdict(list)
+
+        for session in sessions.values():
+            session.sort(key=lambda event: (event['ts'], event['itemInSession']))
+            first = session[0]
+            start = datetime.datetime.fromtimestamp(first['ts'] / 1000, datetime.timezone.utc)
+            model.hourly_sessions[start.weekday(), start.hour] += 1
+            days.add(start.date())
+
+            states = [(event['level'], event['page'], event['auth'], event['method'], event['status'])
+                      for event in session]
+            starts[first['level']][states[0]] += 1
+            for event, state, following, next_state in zip(session, states, session[1:] + [None], states[1:] + [END]):
+                transitions[state][next_state] += 1
+                if following is not None and event['page'] != 'NextSong':
+                    gaps[event['page']].append(following['ts'] - event['ts'])
+
+            for event in session:
+                if event['page'] == 'NextSong':
+                    played[(event['artist'], event['song'], event['length'])] += 1
+                if event['userId'] and event['userId'] not in user_info:
+                    user_info[event['userId']] = event
+                    first_names[event['gender']].append(event['firstName'])
+                    model.last_names.append(event['lastName'])
+                    model.locations.append(event['location'])
+                    model.user_agents.append(event['userAgent'])
+                    model.registration_ages.append(event['ts'] - int(event['registration']))
+            for user_id in {event['userId'] for event in session if event['userId']}:
+                user_sessions[user_id] += 1
+
+        model.start, model.days = min(days), (max(days) - min(days)).days + 1
+        dates = [model.start + datetime.timedelta(day) for day in range(model.days)]
+        weekdays = Counter(date.weekday() for date in dates)
+        for weekday in range(7):
+            model.hourly_sessions[weekday] /= max(weekdays[weekday], 1)
+
+        model.users = [(user_info[user_id]['gender'], user_info[user_id]['level'], count)
+                       for user_id, count in sorted(user_sessions.items(), key=lambda item: int(item[0]))]
+        model.first_names = dict(first_names)
+        model.start_states = {level: model._distribution(counts) for level, counts in starts.items()}
+        model.transitions = {state: model._distribution(counts) for state, counts in transitions.items()}
+        model.gaps = {page: np.array(values) for page, values in gaps.items()}
+
+        model.played = sorted(played)
+        model.played_weights = np.cumsum([played[song] for song in model.played])
+        catalog = {(song['artist_name'], song['title'], song['duration']) for song in model.songs}
+        model.match_rate = sum(count for song, count in played.items() if song in catalog) / sum(played.values())
+        return model
+
+    @staticmethod
+    def _distribution(counts):
+        """
+        Returns the outcomes of a Counter and their cumulative weights.
+        """
+        outcomes = sorted(counts, key=repr)
+        return outcomes, np.cumsum([counts[outcome] for outcome in outcomes])
+
+
+class SparkifyGenerator:
+    """
+    Streams synthetic log events in `ts` order and song records drawn from a SparkifyModel.
+
+    The catalog and the user base are `scale` times the sample ones, and so is the rate of sessions.
+    Users and catalog songs are derived from their index and the seed, so only the current level of each
+    user and the sessions in progress are held in memory.
+
+    Parameters
+    ----------
+    model       : SparkifyModel
+                    Learned distributions
+    scale       : float
+                    Scale factor of the users, sessions and songs
+    seed        : integer
+                    Seed of the random generators
+    match_rate  : float
+                    Share of the played songs drawn from the song catalog, the sample share by default
+    """
+
+    def __init__(self, model, scale, seed=0, match_rate=None):
+        self.model = model
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        self.match_rate = model.match_rate if match_rate is None else match_rate
+
+        self.num_users = max(int(round(len(model.users) * scale)), 1)
+        self.num_songs = max(int(round(len(model.songs) * scale)), 1)
+        self.scale = scale
+        self.user_weights = np.cumsum([model.users[user % len(model.users)][2] for user in range(self.num_users)])
+        # 0 until a user plays, then 1 for free and 2 for paid
+        self.levels = bytearray(self.num_users)
+        self.session_id = 0
+
+    def song(self, index):
+        """
+        Returns the song record of an index of the catalog, copies of the sample songs with new ids.
+        """
+        record = self.model.songs[index % len(self.model.songs)]
+        copy = index // len(self.model.songs)
+        if copy == 0:
+            return dict(record)
+        suffix = hashlib.md5('{}-{}'.format(self.seed, index).encode()).hexdigest()[:16].upper()
+        return dict(record, song_id='SO' + suffix, artist_id='AR' + suffix,
+                    title='{} ({})'.format(record['title'], copy + 1))
+
+    def songs(self):
+        """
+        Yields (track id, song record) of the whole catalog.
+        """
+        for index in range(self.num_songs):
+            song = self.song(index)
+            yield 'TR' + hashlib.md5('{}-{}'.format(self.seed, index).encode()).hexdigest()[:16].upper(), song
+
+    def user(self, user):
+        """
+        Returns the attributes of a user, drawn from the sample attributes with a generator seeded by the user.
+        """
+        model = self.model
+        rng = np.random.default_rng([self.seed, user])
+        gender, level, sessions = model.users[user % len(model.users)]
+        names = model.first_names[gender]
+        return {
+            "firstName": names[rng.integers(len(names))],
+            "gender": gender,
+            "lastName": model.last_names[rng.integers(len(model.last_names))],
+            "location": model.locations[rng.integers(len(model.locations))],
+            "registration": float(self.start_ms - model.registration_ages[rng.integers(len(model.registration_ages))]),
+            "userAgent": model.user_agents[rng.integers(len(model.user_agents))],
+            "userId": str(user + 1),
+            "level": level,
+        }
+
+    def played_song(self):
+        """
+        Returns (artist, song, length) of a NextSong event.
+        """
+        if self.rng.random() < self.match_rate:
+            song = self.song(int(self.rng.integers(self.num_songs)))
+            return song['artist_name'], song['title'], song['duration']
+        return self.model.played[weighted_choice(self.rng, self.model.played_weights)]
+
+    def session(self, user, ts):
+        """
+        Yields the events of a session of a user starting at `ts`.
+        """
+        model = self.model
+        attributes = self.user(user)
+        level = {1: 'free', 2: 'paid'}.get(self.levels[user], attributes['level'])
+        self.session_id += 1
+        session_id = self.session_id
+
+        outcomes, weights = model.start_states.get(level) or next(iter(model.start_states.values()))
+        state = outcomes[weighted_choice(self.rng, weights)]
+        item = 0
+        while state is not END:
+            level, page, auth, method, status = state
+            logged_in = auth not in ('Logged Out', 'Guest')
+            artist, song, length = self.played_song() if page == 'NextSong' else (None, None, None)
+
+            event = {field: attributes.get(field) if logged_in else None for field in LOG_FIELDS}
+            event.update(artist=artist, auth=auth, itemInSession=item, length=length, level=level, method=method,
+                         page=page, sessionId=session_id, song=song, status=status, ts=ts,
+                         userId=attributes['userId'] if logged_in else '')
+            yield event
+            if logged_in:
+                self.levels[user] = 1 if level == 'free' else 2
+
+            outcomes, weights = model.transitions[state]
+            state = outcomes[weighted_choice(self.rng, weights)]
+            if page == 'NextSong':
+                ts += int(round(length * 1000))
+            else:
+                gaps = model.gaps.get(page)
+                ts += int(gaps[self.rng.integers(len(gaps))]) if gaps is not None and len(gaps) else 1000
+            item += 1
+
+    def session_starts(self, start, days):
+        """
+        Yields (ts, user) of the session starts in `ts` order, hour by hour.
+        """
+        for day in range(days):
+            date = start + datetime.timedelta(day)
+            for hour in range(24):
+                count = self.rng.poisson(self.model.hourly_sessions[date.weekday(), hour] * self.scale)
+                offsets = np.sort(self.rng.integers(0, HOUR_MS, count))
+                users = np.searchsorted(self.user_weights, self.rng.random(count) * self.user_weights[-1],
+                                        side='right')
+                base = to_ms(date) + hour * HOUR_MS
+                for offset, user in zip(offsets.tolist(), users.tolist()):
+                    yield base + offset, user
+
+    def events(self, start, days):
+        """
+        Yields the log events of `days` days from `start` in `ts` order. Sessions in progress are merged
+        on a heap so that memory is bound by the number of concurrent sessions, not the number of events.
+
+        Parameters
+        ----------
+        start       : date
+                        First day
+        days        : integer
+                        Number of days
+        """
+        self.start_ms = to_ms(start)
+        end_ms = self.start_ms + days * DAY_MS
+        heap = []
+        order = 0
+
+        def push(session):
+            nonlocal order
+            event = next(session, None)
+            if event is not None and event['ts'] < end_ms:
+                heapq.heappush(heap, (event['ts'], order, event, session))
+                order += 1
+
+        for ts, user in self.session_starts(start, days):
+            while heap and heap[0][0] <= ts:
+                _, _, event, session = heapq.heappop(heap)
+                yield event
+                push(session)
+            push(self.session(user, ts))
+
+        while heap:
+            _, _, event, session = heapq.heappop(heap)
+            yield event
+            push(session)
+
+
+class DailyFiles:
+    """
+    Writes events in `ts` order to one file per day, closing a day file when the next day starts.
+
+    Parameters
+    ----------
+    path_format : string
+                    Path of a day file, formatted with the date
+    format      : string
+                    'json' for one json record per line or 'csv' for the event_data csv files
+    """
+
+    def __init__(self, path_format, format):
+        self.path_format = path_format
+        self.format = format
+        self.date = None
+        self.file = None
+        self.writer = None
+        self.files = 0
+
+    def write(self, event):
+        date = datetime.datetime.fromtimestamp(event['ts'] / 1000, datetime.timezone.utc).date()
+        if date != self.date:
+            self.open(date)
+        if self.format == 'json':
+            self.file.write(json.dumps(event, separators=(',', ':')) + '\n')
+        else:
+            self.writer.writerow(['' if event[field] is None else event[field] for field in CSV_FIELDS])
+
+    def open(self, date):
+        self.close()
+        path = self.path_format.format(date=date)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, 'w', newline='')
+        if self.format == 'csv':
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(CSV_FIELDS)
+        self.date = date
+        self.files += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+# log file layouts of the projects: Projects 1-a and 3 read log_data/YYYY/MM, Project 4 reads a flat log_data
+# and Project 1-b reads event_data csv files
+LAYOUTS = {
+    'postgres': ('log_data/{date:%Y}/{date:%m}/{date:%Y-%m-%d}-events.json', 'json'),
+    'datalake': ('log_data/{date:%Y-%m-%d}-events.json', 'json'),
+    'cassandra': ('event_data/{date:%Y-%m-%d}-events.csv', 'csv'),
+}
+
+
+def write_songs(generator, output):
+    """
+    This function writes the song catalog as one json file per song in the `song_data/A/B/C/TR....json` layout
+    read by Projects 1-a, 3 and 4.
+
+    Returns
+    -------
+    Number of song files written
+    """
+    count = 0
+    for track_id, song in generator.songs():
+        directory = os.path.join(output, 'song_data', track_id[2], track_id[3], track_id[4])
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, track_id + '.json'), 'w') as f:
+            json.dump(song, f)
+        count += 1
+    return count
+
+
+def write_events(generator, output, layouts, start, days):
+    """
+    This function streams the log events to the day files of each layout.
+
+    Returns
+    -------
+    (number of events written, number of files written)
+    """
+    sinks = [DailyFiles(os.path.join(output, LAYOUTS[layout][0]), LAYOUTS[layout][1]) for layout in layouts]
+    count = 0
+    last_date = None
+    started = time.time()
+    try:
+        for event in generator.events(start, days):
+            for sink in sinks:
+                sink.write(event)
+            count += 1
+            if sinks[0].date != last_date:
+                last_date = sinks[0].date
+                print('{} - {} events written ({:.0f} events/sec).'.format(
+                    last_date, count, count / max(time.time() - started, 1e-9)))
+    finally:
+        for sink in sinks:
+            sink.close()
+    return count, sum(sink.files for sink in sinks)
+
+
+def main():
+    """
+    - Learns the distributions of the sample log and song data.
+
+    - Writes the song catalog and streams the log events, `--scale` times the sample, to the layouts
+    of the projects.
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Generate synthetic Sparkify log and song data at scale. '
+                                                 'Distributions are learned from the Project 1-a samples only, '
+                                                 'the Project 4 and Project 1-b samples hold the same events '
+                                                 'and songs.')
+    parser.add_argument('--output', required=True, help='directory to write the data to')
+    parser.add_argument('--scale', type=float, default=10, help='scale factor of users, sessions and songs')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random generators')
+    parser.add_argument('--layout', nargs='+', choices=sorted(LAYOUTS), default=['postgres'],
+                        help='log layouts to write: postgres (Projects 1-a and 3), datalake (Project 4) '
+                             'and cassandra (Project 1-b)')
+    parser.add_argument('--start-date', type=datetime.date.fromisoformat, help='first day, the sample one by default')
+    parser.add_argument('--days', type=int, help='number of days, the sample one by default')
+    parser.add_argument('--match-rate', type=float,
+                        help='share of the played songs found in the song catalog, the sample share by default')
+    parser.add_argument('--no-songs', action='store_true', help='do not write song files')
+    parser.add_argument('--log-data', default=os.path.join(root, SAMPLE_LOG_DATA), help='sample log_data directory, Project 1-a by default')
+    parser.add_argument('--song-data', default=os.path.join(root, SAMPLE_SONG_DATA), help='sample song_data directory, Project 1-a by default')
+    args = parser.parse_args()
+
+    model = SparkifyModel.learn(args.log_data, args.song_data)
+    print('Learned {} users, {} sessions/day, {} played songs and {} songs ({:.2%} match rate) over {} days.'.format(
+        len(model.users), int(model.hourly_sessions.sum() / 7), len(model.played), len(model.songs),
+        model.match_rate, model.days))
+
+    generator = SparkifyGenerator(model, args.scale, args.seed, args.match_rate)
+    start, days = args.start_date or model.start, args.days or model.days
+
+    started = time.time()
+    if not args.no_songs:
+        print('{} song files written.'.format(write_songs(generator, args.output)))
+    events, files = write_events(generator, args.output, args.layout, start, days)
+    elapsed = time.time() - started
+    print('{} events written to {} log files in {:.2f}s ({:.0f} events/sec).'.format(
+        events, files, elapsed, events / max(elapsed, 1e-9)))
+
+
+if __name__ == "__main__":
+    main()